@@ -0,0 +1,96 @@
+'''同時送出大量 add_item 到同一張訂單，檢查 per-order lock 下沒有遺失的修改
+
+每個使用者以不同的數量新增一次品項 (--submissions 個使用者平均分到 --items 個品項)，全部同時 dispatch 進 slack_order.app，
+完成後檢查:
+    * 記憶體中的訂單及最後一次 chat_update 的 metadata 的每個品項數量、總數量及總金額
+    * chat_update 次數: 至少一次，且不超過 debounce 的次數上限 (送出所需時間 / ORDER_UPDATE_DEBOUNCE_MS + 1)
+
+    python concurrency_test.py --submissions 300 --items 3 --workers 64
+'''
+import argparse
+import concurrent.futures
+import math
+import os
+import threading
+import time
+
+from loadtest import getAddItemPayload, getNewOrderPayload, startFakeSlackApi
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--submissions", type=int, default=300, help="同時送出的 add_item 數量 (每個使用者一次)")
+    parser.add_argument("--items", type=int, default=3, help="品項數量")
+    parser.add_argument("--workers", type=int, default=64, help="同時 dispatch 的 threads 數量")
+    parser.add_argument("--settle-timeout", type=float, default=30, help="等待背景 Web API 呼叫完成的秒數")
+    args = parser.parse_args()
+
+    api = startFakeSlackApi()
+    os.environ["METRICS_PORT"] = "0"
+    import slack_order
+    from slack_bolt.request import BoltRequest
+
+    def dispatch(payload):
+        return slack_order.app.dispatch(BoltRequest(body=payload, mode="socket_mode"))
+
+    channel_id = "CCONCURRENCY"
+    dispatch(getNewOrderPayload("UCREATOR", channel_id, "concurrency test"))
+    while not slack_order.orders:
+        time.sleep(0.01)
+    ts = next(iter(slack_order.orders))
+    time.sleep(0.5)
+    api.reset()
+
+    prices = {f"item { n }": (n + 1) * 10 for n in range(args.items)}
+    submissions = []
+    for n in range(args.submissions):
+        item = f"item { n % args.items }"
+        submissions.append((f"U{ n:05d}", item, n % 3 + 1))
+    expected = {item: 0 for item in prices}
+    for _, item, amount in submissions:
+        expected[item] += amount
+
+    start = threading.Barrier(args.workers)
+
+    def submit(chunk):
+        start.wait()
+        for user_id, item, amount in chunk:
+            payload = getAddItemPayload(user_id, channel_id, ts, item, prices[item])
+            payload["view"]["state"]["values"]["item_amount"]["item_amount_input"]["value"] = str(amount)
+            dispatch(payload)
+
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as executor:
+        for future in [executor.submit(submit, submissions[n::args.workers]) for n in range(args.workers)]:
+            future.result()
+    submitted = time.perf_counter() - started
+
+    deadline = time.monotonic() + args.settle_timeout
+    while time.monotonic() < deadline and (slack_order.pending_order_updates or slack_order.slack_api_dispatcher.getStats()["queue_depth"]):
+        time.sleep(0.05)
+    slack_order.slack_api_dispatcher.drain(max(0, deadline - time.monotonic()))
+    settled = time.perf_counter() - started
+
+    order = slack_order.orders[ts]
+    details = slack_order.order_details[ts]
+    _, message_details = slack_order.getOrderFromMessageMetadataPayload(api.messages[(channel_id, ts)]["metadata"]["event_payload"])
+    updates = api.calls["chat.update"]
+    max_updates = math.ceil(settled * 1000 / slack_order.ORDER_UPDATE_DEBOUNCE_MS) + 1
+
+    print(f"submissions={ args.submissions } items={ args.items } workers={ args.workers }")
+    print(f"submitted in { submitted:.2f} s, settled in { settled:.2f} s, chat.update calls: { updates } (max { max_updates })")
+    for item, amount in expected.items():
+        print(f"  { item:<10} expected { amount:>6} memory { details[item].amount:>6} message { message_details[item].amount:>6}")
+
+    for item, amount in expected.items():
+        assert details[item].amount == amount, f"{ item }: { details[item].amount } != { amount }"
+        assert len(details[item].slack_users) == sum(1 for _, submitted_item, _ in submissions if submitted_item == item)
+        assert message_details[item] == details[item], f"{ item }: order message is stale"
+    assert order.total_amount == sum(expected.values())
+    assert order.total_price == sum(prices[item] * amount for item, amount in expected.items())
+    assert 1 <= updates <= max_updates, f"chat.update calls: { updates }"
+    print("ok")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,290 @@
+'''slack_order.py 的壓力測試
+
+在本機啟動假的 Slack Web API (記錄每個 method 的呼叫次數，可加入延遲及隨機回應 429)，
+並透過 Bolt 的 request dispatch 將合成的 /order command, block_actions, view_submission payloads
+送進 slack_order.app。
+
+    python loadtest.py --users 50 --orders 5 --items 20 --actions 10 --api-latency-ms 50 --rate-limit-ratio 0.01
+
+回報每個 listener 的 handler 延遲 (ack 之後在 listener executor 執行的時間，即 slack_order_listener_seconds)、
+每種 payload 的 ack 延遲 (p50/p95/p99)、每個使用者動作平均的 Web API 呼叫次數及 throughput。
+'''
+import argparse
+import collections
+import concurrent.futures
+import http.server
+import itertools
+import json
+import os
+import random
+import threading
+import time
+import urllib.parse
+
+
+class FakeSlackApi(http.server.ThreadingHTTPServer):
+    '''本機的假 Slack Web API，所有 method 都回應 ok
+
+    會記錄送出的 messages (含 metadata) 及釘選，pins.list 及 conversations.history 以記錄的內容回應
+    '''
+    daemon_threads = True
+
+    def __init__(self, latency, rate_limit_ratio, retry_after):
+        super().__init__(("127.0.0.1", 0), FakeSlackApiHandler)
+        self.latency = latency
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.calls = collections.Counter()
+        self.rate_limited = collections.Counter()
+        self.sequence = itertools.count(1)
+        # (channel, ts) : message
+        self.messages = {}
+        # channel : [ts, ...]
+        self.pins = collections.defaultdict(list)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{ self.server_address[1] }/api/"
+
+    def reset(self):
+        with self.lock:
+            self.calls.clear()
+            self.rate_limited.clear()
+
+
+class FakeSlackApiHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        server = self.server
+        method = self.path.rsplit("/", 1)[-1]
+        data = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            args = json.loads(data or "{}")
+        else:
+            args = {key: value[0] for key, value in urllib.parse.parse_qs(data).items()}
+
+        if server.latency:
+            time.sleep(server.latency)
+
+        if method != "auth.test" and random.random() < server.rate_limit_ratio:
+            with server.lock:
+                server.rate_limited[method] += 1
+            self.respond(429, {"ok": False, "error": "ratelimited"}, {"Retry-After": str(server.retry_after)})
+            return
+
+        response = {"ok": True}
+        with server.lock:
+            server.calls[method] += 1
+            sequence = next(server.sequence)
+        if method == "auth.test":
+            response.update(user_id="UBOT", bot_id="BBOT", team_id="T1", user="loadtest")
+        elif method in ("chat.postMessage", "chat.update"):
+            response.update(channel=args.get("channel"), ts=args.get("ts") or f"{ 1700000000 + sequence }.000100")
+            metadata = args.get("metadata")
+            if not args.get("thread_ts"):
+                with server.lock:
+                    server.messages[(response["channel"], response["ts"])] = {
+                        "type": "message", "ts": response["ts"], "bot_id": "BBOT",
+                        "metadata": json.loads(metadata) if isinstance(metadata, str) else metadata
+                    }
+        elif method in ("pins.add", "pins.remove"):
+            with server.lock:
+                pins = server.pins[args.get("channel")]
+                if method == "pins.add" and args.get("timestamp") not in pins:
+                    pins.append(args.get("timestamp"))
+                elif method == "pins.remove" and args.get("timestamp") in pins:
+                    pins.remove(args.get("timestamp"))
+        elif method == "pins.list":
+            with server.lock:
+                response.update(items=[
+                    {"type": "message", "channel": args.get("channel"), "message": dict(server.messages[(args.get("channel"), ts)], metadata=None)}
+                    for ts in server.pins[args.get("channel")] if (args.get("channel"), ts) in server.messages
+                ])
+        elif method == "conversations.history":
+            with server.lock:
+                message = server.messages.get((args.get("channel"), args.get("latest")))
+            response.update(messages=[message] if message else [], has_more=False)
+        elif method == "views.open":
+            response.update(view={"id": f"V{ sequence }"})
+        self.respond(200, response)
+
+    def respond(self, status, response, headers={}):
+        body = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def startFakeSlackApi(latency=0, rate_limit_ratio=0, retry_after=1):
+    '''啟動假 Slack Web API 並設定 SLACK_API_URL，之後 import slack_order 時會使用它'''
+    api = FakeSlackApi(latency=latency, rate_limit_ratio=rate_limit_ratio, retry_after=retry_after)
+    threading.Thread(target=api.serve_forever, name="fake-slack-api", daemon=True).start()
+    os.environ["SLACK_API_URL"] = api.url
+    os.environ.setdefault("SLACK_BOT_TOKEN", "xoxb-loadtest")
+    return api
+
+
+def getCommandPayload(user_id, channel_id):
+    return {
+        "command": "/order", "text": "", "user_id": user_id, "channel_id": channel_id,
+        "team_id": "T1", "api_app_id": "A1", "trigger_id": f"trigger-{ user_id }"
+    }
+
+
+def getViewSubmissionPayload(user_id, callback_id, private_metadata, values):
+    return {
+        "type": "view_submission", "team": {"id": "T1"}, "user": {"id": user_id}, "api_app_id": "A1",
+        "view": {
+            "id": "V1", "type": "modal", "callback_id": callback_id,
+            "private_metadata": private_metadata, "state": {"values": values}
+        }
+    }
+
+
+def getBlockActionsPayload(user_id, action_id, channel_id, ts):
+    return {
+        "type": "block_actions", "team": {"id": "T1"}, "user": {"id": user_id}, "api_app_id": "A1",
+        "trigger_id": f"trigger-{ user_id }",
+        "container": {"type": "message", "message_ts": ts, "channel_id": channel_id},
+        "channel": {"id": channel_id},
+        "message": {"ts": ts, "metadata": {"event_type": "order", "event_payload": {}}},
+        "actions": [{"action_id": action_id, "block_id": "actions", "type": "button", "value": action_id}]
+    }
+
+
+def getNewOrderPayload(user_id, channel_id, name):
+    return getViewSubmissionPayload(user_id, "open_new_order_modal", channel_id, {
+        "order_name": {"order_name_input": {"value": name}},
+        "order_info": {"order_info_input": {"value": "loadtest"}},
+        "order_img": {"order_img_input": {"value": None}}
+    })
+
+
+def getAddItemPayload(user_id, channel_id, ts, item, price):
+    return getViewSubmissionPayload(user_id, "add_item", f"{ channel_id },{ ts }", {
+        "item_name": {"item_name_input": {"selected_option": {"text": {"type": "plain_text", "text": item}, "value": item}}},
+        "item_price": {"item_price_input": {"value": str(price)}},
+        "item_amount": {"item_amount_input": {"value": "1"}},
+        "item_slack_users": {"item_slack_users_input": {"selected_users": [user_id]}},
+        "item_users": {"item_users_input": {"value": ""}}
+    })
+
+
+def getPercentile(values, percent):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def printLatencies(title, latencies):
+    print(f"{ title:<28}{ 'count':>8}{ 'p50 ms':>10}{ 'p95 ms':>10}{ 'p99 ms':>10}")
+    for kind, values in sorted(latencies.items()):
+        print(f"{ kind:<28}{ len(values):>8}{ getPercentile(values, 50):>10.2f}{ getPercentile(values, 95):>10.2f}{ getPercentile(values, 99):>10.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20, help="同時操作的使用者數量")
+    parser.add_argument("--orders", type=int, default=1, help="訂單數量")
+    parser.add_argument("--items", type=int, default=10, help="每張訂單的品項數量")
+    parser.add_argument("--actions", type=int, default=10, help="每個使用者新增品項的次數")
+    parser.add_argument("--api-latency-ms", type=float, default=0, help="假 Web API 每次呼叫的延遲")
+    parser.add_argument("--rate-limit-ratio", type=float, default=0, help="假 Web API 回應 429 的比例")
+    parser.add_argument("--retry-after", type=int, default=1, help="429 回應的 Retry-After 秒數")
+    parser.add_argument("--settle-timeout", type=float, default=60, help="等待背景 Web API 呼叫完成的秒數")
+    args = parser.parse_args()
+
+    api = startFakeSlackApi(latency=args.api_latency_ms / 1000, rate_limit_ratio=args.rate_limit_ratio, retry_after=args.retry_after)
+
+    # 必須在設定 SLACK_API_URL 之後才 import
+    import slack_order
+    from slack_bolt.request import BoltRequest
+
+    ack_latencies = collections.defaultdict(list)
+    # listener 名稱 : 執行時間，從 slack_order_listener_seconds 的每次觀測值取得
+    handler_latencies = collections.defaultdict(list)
+    latencies_lock = threading.Lock()
+    observe = slack_order.metrics.observe
+
+    def recordObservation(name, value, **labels):
+        if name == "slack_order_listener_seconds":
+            with latencies_lock:
+                handler_latencies[labels["listener"]].append(value * 1000)
+        observe(name, value, **labels)
+
+    slack_order.metrics.observe = recordObservation
+
+    def dispatch(kind, payload):
+        started = time.perf_counter()
+        response = slack_order.app.dispatch(BoltRequest(body=payload, mode="socket_mode"))
+        elapsed = (time.perf_counter() - started) * 1000
+        with latencies_lock:
+            ack_latencies[kind].append(elapsed)
+        return response
+
+    # 建立訂單
+    channel_id = "CLOADTEST"
+    for n in range(args.orders):
+        dispatch("view_submission", getNewOrderPayload("UCREATOR", channel_id, f"loadtest { n }"))
+    while len(slack_order.orders) < args.orders:
+        time.sleep(0.01)
+    order_tss = list(slack_order.orders)
+    items = [(f"item { n }", random.randint(10, 200)) for n in range(args.items)]
+    time.sleep(0.5)
+    api.reset()
+    with latencies_lock:
+        ack_latencies.clear()
+        handler_latencies.clear()
+
+    def runUser(user_id):
+        dispatch("command", getCommandPayload(user_id, channel_id))
+        for _ in range(args.actions):
+            ts = random.choice(order_tss)
+            item, price = random.choice(items)
+            dispatch("block_actions", getBlockActionsPayload(user_id, "new_item", channel_id, ts))
+            dispatch("view_submission", getAddItemPayload(user_id, channel_id, ts, item, price))
+
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.users) as executor:
+        for future in [executor.submit(runUser, f"U{ n:05d}") for n in range(args.users)]:
+            future.result()
+    elapsed = time.perf_counter() - started
+
+    user_actions = sum(len(values) for values in ack_latencies.values())
+
+    # 等待所有 listeners、debounce 的訂單更新及背景 Web API 呼叫完成
+    deadline = time.monotonic() + args.settle_timeout
+    while time.monotonic() < deadline and sum(len(values) for values in handler_latencies.values()) < user_actions:
+        time.sleep(0.05)
+    while time.monotonic() < deadline and (slack_order.pending_order_updates or slack_order.slack_api_dispatcher.getStats()["queue_depth"]):
+        time.sleep(0.05)
+    slack_order.slack_api_dispatcher.drain(max(0, deadline - time.monotonic()))
+    settled = time.perf_counter() - started
+
+    print(f"users={ args.users } orders={ args.orders } items={ args.items } actions/user={ args.actions }")
+    print("handler latency:")
+    printLatencies("listener", handler_latencies)
+    # dispatch 在 ack 後就回傳，listener 在背景執行
+    print("ack latency:")
+    printLatencies("payload", ack_latencies)
+    print(f"throughput: { user_actions / elapsed:.1f} actions/s ({ user_actions } actions in { elapsed:.2f} s, settled in { settled:.2f} s)")
+    print("web api calls per user action:")
+    for method, count in sorted(api.calls.items()):
+        print(f"  { method:<24}{ count:>8}{ count / user_actions:>10.3f}")
+    print(f"  { 'total':<24}{ sum(api.calls.values()):>8}{ sum(api.calls.values()) / user_actions:>10.3f}")
+    if api.rate_limited:
+        print(f"429 responses: { dict(api.rate_limited) }")
+
+
+if __name__ == "__main__":
+    main()
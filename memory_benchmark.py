@@ -0,0 +1,97 @@
+'''比較 orders, order_details 的記憶體用量
+
+建立 --orders 個點餐中的訂單 (每個訂單 --items 個品項、每個品項 --users 個使用者)，以 tracemalloc 量測
+Order/OrderItem 及原本字串 dict 格式每個訂單佔用的記憶體
+
+    python memory_benchmark.py --orders 1000 --items 10 --users 3
+'''
+import argparse
+import os
+import tracemalloc
+
+from loadtest import startFakeSlackApi
+
+
+def measure(build):
+    '''返回 build() 建立的資料佔用的 bytes，建立的資料在量測完之前不會被釋放'''
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    data = build()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    del data
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--orders", type=int, default=1000, help="訂單數量")
+    parser.add_argument("--items", type=int, default=10, help="每張訂單的品項數量")
+    parser.add_argument("--users", type=int, default=3, help="每個品項的使用者數量")
+    args = parser.parse_args()
+
+    startFakeSlackApi()
+    # 量測時不移出訂單
+    os.environ["ORDER_CACHE_MAX_ORDERS"] = "0"
+    import slack_order
+
+    # 名稱字串兩種格式共用，不計入量測
+    tss = [f"{ 1700000000 + n }.000100" for n in range(args.orders)]
+    items = [f"item { n }" for n in range(args.items)]
+    users = [f"U{ n:08d}" for n in range(args.users)]
+    order_record = {
+        "order_name": "lunch",
+        "order_creator": users[0],
+        "order_info": "info",
+        "order_state": slack_order.ORDER_STATE[0],
+        "order_img": slack_order.imgs[0],
+        "channel_id": "C00000000"
+    }
+
+    def buildDicts():
+        # 原本的格式: 金額及數量為字串，總計存在 orders[ts] 中
+        orders = {}
+        order_details = {}
+        for ts in tss:
+            orders[ts] = dict(
+                order_record,
+                order_total_amount=args.items * args.users,
+                order_total_price=args.items * args.users * 100,
+                order_user_totals={f"<@{ user }>": args.items * 100 for user in users}
+            )
+            order_details[ts] = {
+                item: {
+                    "price": "100",
+                    "amount": str(args.users),
+                    "slack_users": {user: "1" for user in users},
+                    "users": {}
+                } for item in items
+            }
+        return orders, order_details
+
+    def buildModels():
+        for ts in tss:
+            slack_order.createOrder(order_record["channel_id"], ts, order_record)
+            for item in items:
+                slack_order.setOrderItem(ts, item, slack_order.OrderItem(
+                    price=100,
+                    amount=args.users,
+                    slack_users={user: 1 for user in users}
+                ))
+        return slack_order.orders, slack_order.order_details
+
+    dict_size = measure(buildDicts)
+    # createOrder 同時建立的存取時間不屬於訂單資料，先建立好 (lock 在使用完後就會移除)
+    for ts in tss:
+        slack_order.touchOrder(ts)
+    model_size = measure(buildModels)
+
+    print(f"orders={ args.orders } items/order={ args.items } users/item={ args.users }")
+    print(f"{ 'format':<22}{ 'total KiB':>12}{ 'bytes/order':>14}")
+    print(f"{ 'dict (strings)':<22}{ dict_size / 1024:>12.1f}{ dict_size / args.orders:>14.0f}")
+    print(f"{ 'Order/OrderItem':<22}{ model_size / 1024:>12.1f}{ model_size / args.orders:>14.0f}")
+
+
+if __name__ == "__main__":
+    main()
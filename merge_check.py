@@ -0,0 +1,141 @@
+'''以隨機產生的修改檢查 mergeOrderStates 的合併結果會收斂
+
+每個 seed 建立 --replicas 份相同的訂單狀態，隨機在各個 replica 修改 (使用者數量、品項金額、訂單欄位)，
+並隨機將某個 replica 的狀態合併進另一個，最後以隨機順序兩兩合併，檢查:
+    * 合併是 commutative、associative 及 idempotent
+    * 所有 replicas 最後的狀態及展開的訂單都相同
+    * 每個使用者的數量等於所有 replicas 對他的修改加總 (同時修改同一個使用者時數量會相加)
+    * 合併所有 replicas 之後的修改一定會生效，不會被之前同時減少的修改抵銷 (例如兩個 replicas 同時移除後再加回)
+
+    python merge_check.py --seeds 500 --replicas 3 --steps 60
+'''
+import argparse
+import copy
+import random
+
+from loadtest import startFakeSlackApi
+
+ITEMS = ["rice", "noodle", "soup", "tea"]
+USERS = ["s:U1", "s:U2", "s:U3", "u:amy", "u:bob"]
+
+
+def getUserCounterAmount(slack_order, state, item, user):
+    '''訂單狀態中使用者的 counter 加總，可能小於 0'''
+    return slack_order.getCounterAmount(state["items"].get(item, {}).get("users", {}).get(user, {}))
+
+
+def setUserAmount(slack_order, state, item, user, amount, replica, clock):
+    '''在 replica 的狀態上將使用者的數量改成 amount'''
+    order, details = slack_order.getOrderFromState(state)
+    before = (order.toRecord(), dict(details))
+    slack_users = [user[2:]] if user.startswith("s:") else []
+    users = [user[2:]] if user.startswith("u:") else []
+    details[item] = slack_order.getMergedOrderItem(details.get(item), 10, amount, slack_users, users)
+    if details[item] is None:
+        details.pop(item)
+    slack_order.recordOrderChanges(state, before, (order.toRecord(), details), replica, clock)
+
+
+def applyRandomChange(slack_order, rng, state, replica, clock, deltas):
+    '''在 replica 的狀態上做一個隨機的修改，deltas 記錄每個 (品項, 使用者) counter 加總的變化'''
+    order, details = slack_order.getOrderFromState(state)
+    before = (order.toRecord(), dict(details))
+    item = rng.choice(ITEMS)
+    kind = rng.random()
+    if kind < 0.1:
+        order.info = f"info { clock }"
+    elif kind < 0.25 and item in details:
+        details[item] = slack_order.OrderItem(**dict(details[item].toRecord(), price=rng.randint(1, 5) * 10))
+    else:
+        user = rng.choice(USERS)
+        current = slack_order.getItemStateAmounts(details.get(item)).get(user, 0)
+        amount = rng.choice([0, 1, 2, 3])
+        # 數量沒有改變時不會記錄，有改變時 counter 的加總會變成 amount
+        if amount != current:
+            deltas[(item, user)] = deltas.get((item, user), 0) + amount - getUserCounterAmount(slack_order, state, item, user)
+        slack_users = [user[2:]] if user.startswith("s:") else []
+        users = [user[2:]] if user.startswith("u:") else []
+        details[item] = slack_order.getMergedOrderItem(details.get(item), rng.randint(1, 5) * 10, amount, slack_users, users)
+        if details[item] is None:
+            details.pop(item)
+    slack_order.recordOrderChanges(state, before, (order.toRecord(), details), replica, clock)
+
+
+def checkSeed(slack_order, seed, args):
+    rng = random.Random(seed)
+    merge = slack_order.mergeOrderStates
+    order = slack_order.Order(name="lunch", creator="U1", info="info", state=slack_order.ORDER_STATE[0], img="", channel_id="C1")
+    initial = slack_order.getOrderStateFromOrder(order, {"rice": slack_order.OrderItem(price=50, amount=1, slack_users={"U1": 1})})
+    states = [copy.deepcopy(initial) for _ in range(args.replicas)]
+    deltas = {("rice", "s:U1"): 1}
+
+    for clock in range(1, args.steps + 1):
+        if rng.random() < 0.3:
+            source, target = rng.sample(range(args.replicas), 2)
+            states[target] = merge(states[target], states[source])
+        else:
+            replica = rng.randrange(args.replicas)
+            applyRandomChange(slack_order, rng, states[replica], f"r{ replica }", clock, deltas)
+
+    a, b, c = (rng.choice(states) for _ in range(3))
+    assert merge(a, b) == merge(b, a), "not commutative"
+    assert merge(merge(a, b), c) == merge(a, merge(b, c)), "not associative"
+    assert merge(a, a) == a, "not idempotent"
+
+    # 以不同的順序合併所有 replicas
+    results = []
+    for _ in range(args.replicas):
+        order = rng.sample(states, len(states))
+        merged = order[0]
+        for state in order[1:]:
+            merged = merge(merged, state)
+        results.append(merged)
+    assert all(result == results[0] for result in results), "replicas did not converge"
+    views = [slack_order.getOrderFromState(result) for result in results]
+    assert all(view == views[0] for view in views), "materialized orders differ"
+
+    _, details = views[0]
+    for (item, user), amount in deltas.items():
+        stored = slack_order.getItemStateAmounts(details.get(item)).get(user, 0)
+        assert stored == max(amount, 0), f"{ item } { user }: { stored } != { amount }"
+
+    # 兩個 replicas 同時移除同一個使用者 (counter 加總小於 0)，合併後再修改的數量一定生效
+    item, user = rng.choice(ITEMS), rng.choice(USERS)
+    first, second = (copy.deepcopy(results[0]) for _ in range(2))
+    setUserAmount(slack_order, first, item, user, 2, "r0", args.steps + 1)
+    removed = [copy.deepcopy(first) for _ in range(2)]
+    for replica, state in enumerate(removed):
+        setUserAmount(slack_order, state, item, user, 0, f"r{ replica }", args.steps + 2)
+    later = merge(merge(removed[0], removed[1]), second)
+    amount = rng.choice([1, 2, 3])
+    setUserAmount(slack_order, later, item, user, amount, "r2", args.steps + 3)
+    for state in (later, merge(later, removed[0]), merge(removed[1], later)):
+        _, details = slack_order.getOrderFromState(state)
+        stored = slack_order.getItemStateAmounts(details.get(item)).get(user, 0)
+        assert stored == amount, f"later write lost: { item } { user }: { stored } != { amount }"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seeds", type=int, default=500, help="隨機測試的次數")
+    parser.add_argument("--replicas", type=int, default=3, help="每次測試的 replicas 數量")
+    parser.add_argument("--steps", type=int, default=60, help="每次測試的修改及合併次數")
+    args = parser.parse_args()
+
+    startFakeSlackApi()
+    import slack_order
+
+    failures = 0
+    for seed in range(args.seeds):
+        try:
+            checkSeed(slack_order, seed, args)
+        except AssertionError as error:
+            failures += 1
+            print(f"seed { seed }: { error }")
+    print(f"{ args.seeds - failures }/{ args.seeds } seeds converged")
+    if failures:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
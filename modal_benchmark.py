@@ -0,0 +1,84 @@
+'''比較每次重建 modal view 及修改 template 副本 (ModalTemplate.patch) 的時間
+
+兩邊都包含相同的每個 request 工作 (private_metadata、查詢訂單、產生品項 options)，只有產生 view 的方式不同
+
+    python modal_benchmark.py --number 10000 --items 50
+'''
+import argparse
+import timeit
+
+from loadtest import startFakeSlackApi
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--number", type=int, default=10000, help="每個 modal 產生的次數")
+    parser.add_argument("--items", type=int, default=50, help="修改品項金額 modal 的品項數量")
+    args = parser.parse_args()
+
+    startFakeSlackApi()
+    import slack_order
+
+    ts = "1700000000.000100"
+    body = {"user": {"id": "U00000001"}, "container": {"message_ts": ts, "channel_id": "C00000000"}, "channel": {"id": "C00000000"}}
+    order = slack_order.Order(name="lunch", creator="U00000001", info="info", state=slack_order.ORDER_STATE[0], img=slack_order.imgs[0])
+    slack_order.orders[ts] = order
+    slack_order.order_details[ts] = {
+        f"item { n }": slack_order.OrderItem(price=100, amount=1, slack_users={"U00000001": 1}) for n in range(args.items)
+    }
+    item = "item 0"
+    getPrivateMetadata = slack_order.getPrivateMetadataFormatString
+
+    def buildChooseItemModal():
+        item_detail = slack_order.order_details[ts][item]
+        return slack_order.buildAddItemModal(
+            getPrivateMetadata(body=body) + f",{ item_detail.price }",
+            item_price_mrkdwn=item_detail.price,
+            item_name=item,
+            item_amount="1",
+            item_slack_users=[body["user"]["id"]],
+            current_item_users=f"目前的使用者: { ','.join(item_detail.users) }"
+        )
+
+    def buildModifyItemPriceModal():
+        options = [{"value": item, "text": {"type": "plain_text", "text": item}} for item in slack_order.order_details[ts]]
+        options.sort(key=lambda item: item["value"], reverse=True)
+        return slack_order.buildModifyItemPriceModal(getPrivateMetadata(body=body), {"options": options})
+
+    modals = [
+        (
+            "open_new_order",
+            lambda: slack_order.buildOpenNewOrderModal(channel_id="C00000000"),
+            lambda: slack_order.getOpenNewOrderModal(channel_id="C00000000")
+        ),
+        (
+            "new_item",
+            lambda: slack_order.buildAddItemModal(getPrivateMetadata(body=body), item_slack_users=[body["user"]["id"]], item_amount="1"),
+            lambda: slack_order.getNewItemModal(body)
+        ),
+        (
+            "choose_item",
+            buildChooseItemModal,
+            lambda: slack_order.getChooseItemModal(body, ts, item)
+        ),
+        (
+            "modify_order_message",
+            lambda: slack_order.buildModifyOrderMessageModal(getPrivateMetadata(body=body), slack_order.orders[ts]),
+            lambda: slack_order.getModifyOrderMessageModal(body, ts)
+        ),
+        (
+            "modify_item_price",
+            buildModifyItemPriceModal,
+            lambda: slack_order.getModifyItemPriceModal(body, ts)
+        )
+    ]
+
+    print(f"{ 'modal':<24}{ 'build us':>10}{ 'template us':>13}{ 'speedup':>9}")
+    for name, build, patch in modals:
+        build_time = timeit.timeit(build, number=args.number) / args.number * 1e6
+        patch_time = timeit.timeit(patch, number=args.number) / args.number * 1e6
+        print(f"{ name:<24}{ build_time:>10.2f}{ patch_time:>13.2f}{ build_time / patch_time:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+'''比較原本的 order message renderer、沒有快取的 getOrderMessageBlocksWithItems 及使用快取只重建有變動的品項的時間
+
+原本的 renderer 每次重建 header/footer (getOrderMessageBlocks)，將品項排序後逐一 blocks.insert 到 header 之後 (O(n^2))，
+品項超過 message blocks 上限時也不會改用精簡的表格，所以 100、500 個品項時產生的 blocks 和新的 renderer 不同。
+每次更新都修改一個品項的數量，新的 renderer 有沒有快取產生相同的 blocks
+
+    python render_benchmark.py --number 2000 --items 10 100 500 --users 3
+'''
+import argparse
+import dataclasses
+import itertools
+import timeit
+
+from loadtest import startFakeSlackApi
+
+
+def getBaselineOrderMessageBlocksWithItems(slack_order, position, **kwargs):
+    '''原本的 getOrderMessageBlocksWithItems，position 為 header 的 blocks 數量 (原本是 5)，品項為 dict'''
+    order_details = kwargs.get("order_details", {})
+
+    blocks = slack_order.getOrderMessageBlocks(kwargs)
+    # blocks 插入目前 order_details 資訊
+    for item in sorted(order_details.keys()):
+        slack_users_detail = '、'.join('<@{}> x{}'.format(*p) for p in order_details[item].get('slack_users', {}).items())
+        users_detail = '、'.join('{} x{}'.format(*p) for p in order_details[item].get('users', {}).items())
+        if slack_users_detail and users_detail:
+            all_users = '、'.join((slack_users_detail, users_detail))
+        else:
+            all_users = slack_users_detail if slack_users_detail else users_detail
+
+        blocks.insert(position, {
+            "type": "section",
+            "text": {
+                "type": "mrkdwn",
+                "text": f"${ order_details[item]['price'] } { item } x{ order_details[item]['amount'] } ({ all_users }) "
+            },
+            "accessory": {
+                "type": "button",
+                "text": {
+                    "type": "plain_text",
+                    "text": "Choose"
+                },
+                "value": item,
+                "action_id": "add_item_action"
+            }
+        })
+    return blocks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--number", type=int, default=2000, help="每種品項數量更新的次數")
+    parser.add_argument("--items", type=int, nargs="+", default=[10, 100, 500], help="訂單的品項數量")
+    parser.add_argument("--users", type=int, default=3, help="每個品項的使用者數量")
+    args = parser.parse_args()
+
+    startFakeSlackApi()
+    import slack_order
+
+    users = {f"U{ n:08d}": 1 for n in range(args.users)}
+    order = slack_order.Order(name="lunch", creator="U00000000", info="info", state=slack_order.ORDER_STATE[0], img=slack_order.imgs[0])
+
+    print(f"users/item={ args.users }")
+    print(f"{ 'items':>6}{ 'baseline us':>13}{ 'full us':>12}{ 'cached us':>12}{ 'speedup':>9}")
+    for item_count in args.items:
+        details = {f"item { n }": slack_order.OrderItem(price=100, amount=args.users, users=dict(users)) for n in range(item_count)}
+        names = itertools.cycle(list(details))
+        amounts = itertools.cycle(range(1, 10))
+
+        def getBlocks(cache):
+            return slack_order.getOrderMessageBlocksWithItems(
+                order_details=details,
+                order_total_price="0",
+                order_total_amount="0",
+                cache=cache,
+                **order.toRecord()
+            )
+
+        baseline_details = {item: dataclasses.asdict(item_detail) for item, item_detail in details.items()}
+        position = len(slack_order.getOrderMessageHeaderBlocks(order.toRecord()))
+
+        def renderBaseline():
+            item = next(names)
+            baseline_details[item] = dict(baseline_details[item], users={"amy": next(amounts)})
+            return getBaselineOrderMessageBlocksWithItems(
+                slack_order,
+                position,
+                order_details=baseline_details,
+                order_total_price="0",
+                order_total_amount="0",
+                **order.toRecord()
+            )
+
+        def render(cache):
+            # 修改一個品項，OrderItem 修改時會被取代
+            item = next(names)
+            details[item] = dataclasses.replace(details[item], users={"amy": next(amounts)})
+            return getBlocks(cache)
+
+        cache = {}
+        render(cache)
+        assert getBlocks(cache) == getBlocks({}), "cached blocks differ"
+        baseline_time = timeit.timeit(renderBaseline, number=args.number) / args.number * 1e6
+        full_time = timeit.timeit(lambda: render({}), number=args.number) / args.number * 1e6
+        cached_time = timeit.timeit(lambda: render(cache), number=args.number) / args.number * 1e6
+        print(f"{ item_count:>6}{ baseline_time:>13.1f}{ full_time:>12.1f}{ cached_time:>12.1f}{ baseline_time / cached_time:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
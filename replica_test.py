@@ -0,0 +1,86 @@
+'''在同一台機器上以多個 processes 模擬多個 bot replicas 同時修改同一張訂單
+
+每個 replica 是獨立的 process (各自 import slack_order)，共用本機的假 Slack Web API 及 ORDER_STORE_PATH 的 SQLite，
+所有使用者同時在同一張訂單新增品項，最後比對 order_store 中的訂單是否包含每一次的修改。
+
+    python replica_test.py --replicas 4 --users 5 --actions 10 --items 3
+    python replica_test.py --order-store sqlite  # 不合併其他 replicas 的修改，會遺失修改
+'''
+import argparse
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+
+from loadtest import getAddItemPayload, getNewOrderPayload, startFakeSlackApi
+
+
+def runReplica(index, ts, args, start, results):
+    import slack_order
+    from slack_bolt.request import BoltRequest
+
+    start.wait()
+    added = []
+    for user in range(args.users):
+        user_id = f"U{ index:02d}{ user:04d}"
+        for _ in range(args.actions):
+            item = f"item { random.randrange(args.items) }"
+            slack_order.app.dispatch(BoltRequest(body=getAddItemPayload(user_id, "CREPLICA", ts, item, 100), mode="socket_mode"))
+            added.append((item, user_id))
+    while slack_order.pending_order_updates:
+        time.sleep(0.05)
+    slack_order.slack_api_dispatcher.drain(10)
+    results.put((index, added))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--replicas", type=int, default=4, help="replica processes 數量")
+    parser.add_argument("--users", type=int, default=5, help="每個 replica 的使用者數量")
+    parser.add_argument("--actions", type=int, default=10, help="每個使用者新增品項的次數")
+    parser.add_argument("--items", type=int, default=3, help="品項數量")
+    parser.add_argument("--order-store", default="shared", choices=("shared", "sqlite"), help="ORDER_STORE")
+    args = parser.parse_args()
+
+    startFakeSlackApi()
+    os.environ["ORDER_STORE"] = args.order_store
+    os.environ["ORDER_STORE_PATH"] = os.path.join(tempfile.mkdtemp(), "slack_order.db")
+    os.environ["METRICS_PORT"] = "0"
+    import slack_order
+    from slack_bolt.request import BoltRequest
+
+    # 由這個 process 建立訂單
+    slack_order.app.dispatch(BoltRequest(body=getNewOrderPayload("UCREATOR", "CREPLICA", "replica test"), mode="socket_mode"))
+    while not slack_order.orders:
+        time.sleep(0.01)
+    ts = next(iter(slack_order.orders))
+    slack_order.order_store.flush()
+
+    context = multiprocessing.get_context("spawn")
+    start = context.Event()
+    results = context.Queue()
+    replicas = [context.Process(target=runReplica, args=(index, ts, args, start, results)) for index in range(args.replicas)]
+    for replica in replicas:
+        replica.start()
+    # 等所有 replicas import 完再同時開始
+    time.sleep(3)
+    started = time.perf_counter()
+    start.set()
+    expected = set()
+    for _ in replicas:
+        index, added = results.get()
+        expected.update(added)
+    elapsed = time.perf_counter() - started
+    for replica in replicas:
+        replica.join()
+
+    _, details = slack_order.order_store.load(ts)
+    stored = {(item, user) for item, item_detail in details.items() for user in item_detail.slack_users}
+    print(f"order_store={ args.order_store } replicas={ args.replicas } users/replica={ args.users } actions/user={ args.actions } items={ args.items }")
+    print(f"item users expected: { len(expected) }, stored: { len(stored) }, lost: { len(expected - stored) }")
+    print(f"elapsed: { elapsed:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+'''比較原本 end_order 中以字串 += 統計個人應付金額及結案引擎 (getOrderLedger + getSettlementLines) 的時間
+
+原本的實作使用字串格式的 order_details (金額及數量為字串)，結案引擎使用 OrderItem 及訂單累計的 user_totals，
+兩邊產生相同的統計文字
+
+    python settlement_benchmark.py --number 200 --users 100 500 1000 --items 20 --items-per-user 3
+'''
+import argparse
+import random
+import timeit
+
+from loadtest import startFakeSlackApi
+
+
+def getLegacySettlement(order_details):
+    '''原本 end_order handler 中的統計'''
+    users_total_aggegations = ""  # 統計個人應付金額及所有品項資訊
+    users_total_amount = {}  # 計算個人應付金額
+    users_total_items = {}  # 個人所點的所有品項
+    for item in order_details:
+
+        item_price = order_details[item].get("price", 0)
+
+        for id in order_details[item].get('slack_users', {}):
+            user_item_amount = int(order_details[item]["slack_users"][id])
+            user = f"<@{ id }>"
+            users_total_amount.setdefault(user, 0)
+            users_total_items.setdefault(user, "")
+            users_total_amount[user] += (int(item_price) * user_item_amount)
+            if users_total_items[user]:
+                users_total_items[user] += f"、{ item }(${ item_price })*{ user_item_amount }"
+            else:
+                users_total_items[user] += f"{ item }(${ item_price })*{ user_item_amount }"
+
+        for user in order_details[item].get('users', {}):
+            user_item_amount = int(order_details[item]["users"][user])
+            users_total_amount.setdefault(user, 0)
+            users_total_items.setdefault(user, "")
+            users_total_amount[user] += (int(item_price) * int(user_item_amount))
+            if users_total_items[user]:
+                users_total_items[user] += f"、{ item }(${ item_price })*{ user_item_amount }"
+            else:
+                users_total_items[user] += f"{ item }(${ item_price })*{ user_item_amount }"
+
+    for user in users_total_items:
+        users_total_aggegations += f"${ users_total_amount[user] } { user } ({ users_total_items[user] })\n"
+    return users_total_aggegations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--number", type=int, default=200, help="每種使用者數量統計的次數")
+    parser.add_argument("--users", type=int, nargs="+", default=[100, 500, 1000], help="訂單的使用者數量")
+    parser.add_argument("--items", type=int, default=20, help="品項數量")
+    parser.add_argument("--items-per-user", type=int, default=3, help="每個使用者點的品項數量")
+    args = parser.parse_args()
+
+    startFakeSlackApi()
+    import slack_order
+
+    rng = random.Random(0)
+    ts = "1700000000.000100"
+    print(f"items={ args.items } items/user={ args.items_per_user }")
+    print(f"{ 'users':>6}{ 'legacy ms':>12}{ 'engine ms':>12}{ 'speedup':>9}")
+    for user_count in args.users:
+        # 一半是 Slack 使用者，一半是手動輸入的使用者
+        details = {f"item { n }": {"price": str(rng.randint(1, 20) * 10), "slack_users": {}, "users": {}} for n in range(args.items)}
+        for n in range(user_count):
+            for item in rng.sample(list(details), args.items_per_user):
+                users = details[item]["slack_users" if n % 2 else "users"]
+                users[f"U{ n:08d}" if n % 2 else f"user { n }"] = str(rng.randint(1, 3))
+
+        slack_order.orders[ts] = slack_order.Order(name="lunch", creator="U00000001", info="", state=slack_order.ORDER_STATE[0], img="")
+        slack_order.order_details[ts] = {}
+        for item, item_detail in details.items():
+            slack_users = {user: int(amount) for user, amount in item_detail["slack_users"].items()}
+            users = {user: int(amount) for user, amount in item_detail["users"].items()}
+            slack_order.setOrderItem(ts, item, slack_order.OrderItem(
+                price=int(item_detail["price"]),
+                amount=sum(slack_users.values()) + sum(users.values()),
+                slack_users=slack_users,
+                users=users
+            ))
+        order = slack_order.orders[ts]
+        order_details = slack_order.order_details[ts]
+
+        def settle():
+            lines = slack_order.getSettlementLines(slack_order.getOrderLedger(order_details), order.user_totals)
+            return ''.join([f"{ line }\n" for line in lines])
+
+        assert settle() == getLegacySettlement(details), "settlement text differs"
+        legacy_time = timeit.timeit(lambda: getLegacySettlement(details), number=args.number) / args.number * 1e3
+        engine_time = timeit.timeit(settle, number=args.number) / args.number * 1e3
+        print(f"{ user_count:>6}{ legacy_time:>12.3f}{ engine_time:>12.3f}{ legacy_time / engine_time:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
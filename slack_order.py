@@ -1,43 +1,276 @@
+import asyncio
+import atexit
+import base64
+import bisect
+import collections
+import concurrent.futures
+import csv
+import fcntl
+import hashlib
+import heapq
+import http.server
+import itertools
+import dataclasses
+import json
+import logging
 import os
+import queue
+import re
 import secrets
+import signal
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import zlib
 from slack_bolt import App
 from slack_bolt.adapter.socket_mode import SocketModeHandler
+from slack_bolt.context.ack import Ack
+from slack_bolt.logger.messages import warning_client_prioritized_and_token_skipped
+from slack_sdk import WebClient
+from slack_sdk.errors import SlackApiError
+from slack_sdk.http_retry.builtin_handlers import RateLimitErrorRetryHandler
+
+
+@dataclasses.dataclass(slots=True)
+class Order:
+    '''訂單資訊，品項另外存在 order_details
+
+    metadata, order_store 及 journal 使用 toRecord()/fromRecord() 的 dict 格式
+    '''
+    name: str
+    creator: str
+    info: str
+    state: str
+    img: str
+    channel_id: str = None
+    # 每次保存加一，存在 order_store 及 metadata，共享的 order_store 以它判斷記憶體中的訂單是否過期 (見 refreshOrder)
+    version: int = 0
+    # 累計的總數、總金額及個人小計，見 addItemToOrderTotals
+    total_amount: int = 0
+    total_price: int = 0
+    # {"<@user1_id>": 50, "user1": 100}
+    user_totals: dict = dataclasses.field(default_factory=dict)
+
+    @classmethod
+    def fromRecord(cls, record):
+        return cls(
+            name=record["order_name"],
+            creator=record["order_creator"],
+            info=record["order_info"],
+            state=record["order_state"],
+            img=record["order_img"],
+            channel_id=record.get("channel_id"),
+            version=record.get("version", 0)
+        )
+
+    def toRecord(self):
+        return {
+            "order_name": self.name,
+            "order_creator": self.creator,
+            "order_info": self.info,
+            "order_state": self.state,
+            "order_img": self.img,
+            "channel_id": self.channel_id,
+            "version": self.version
+        }
+
+
+@dataclasses.dataclass(slots=True)
+class OrderItem:
+    '''訂單中的一個品項，修改時以新的 OrderItem 取代 (見 setOrderItem)，不直接修改欄位'''
+    price: int
+    amount: int = 0
+    # 每個使用者的數量 {"user1_id": 1, "user2_id": 2}
+    slack_users: dict = dataclasses.field(default_factory=dict)
+    # 手動輸入的使用者 {"user1": 1}
+    users: dict = dataclasses.field(default_factory=dict)
+
+    @classmethod
+    def fromRecord(cls, record):
+        '''舊版 metadata 的金額和數量是字串'''
+        slack_users = {id: int(amount) for id, amount in record.get("slack_users", {}).items()}
+        users = {user: int(amount) for user, amount in record.get("users", {}).items()}
+        return cls(
+            price=int(record["price"]),
+            amount=sum(slack_users.values()) + sum(users.values()),
+            slack_users=slack_users,
+            users=users
+        )
+
+    def toRecord(self):
+        return {
+            "price": self.price,
+            "amount": self.amount,
+            "slack_users": dict(self.slack_users),
+            "users": dict(self.users)
+        }
+
 
 # 訂單資訊
-# "ts" : {
-#     "order_name": "XXX",
-#     "order_creator": "user_id",
-#     "order_info": "...",
-#     "order_state": ":large_green_circle: 點餐中",
-#     "order_img": "https://"
-# }
+# "ts" : Order
 orders = {}
 # 訂單詳細資訊
 # "ts" : {
-#     "item_name" : {
-#         "price": "50",
-#         "amount": "3",
-#         slack_users: {
-#             "user1_id": "1",
-#             "user2_id": "2"
-#         },
-#         users: {
-#             "user1": "1",
-#             "user2": "1"
-#         }
-#     }
+#     "item_name" : OrderItem
 # }
 order_details = {}
+# 每個訂單各自的 lock，修改 orders[ts], order_details[ts] 前必須先取得，不同訂單之間不互相等待
+# 只保留正在使用 (持有或等待中) 的 locks，見 OrderLock
+# "ts" : OrderLock
+order_locks = {}
+order_locks_lock = threading.Lock()
+# order message 上次產生的 blocks，見 getOrderMessageBlocksWithItems
+# "ts" : {
+#     "header_key": (...),
+#     "header": [...],
+#     "items": {
+#         "item_name": (item_key, block)
+#     },
+#     "fingerprint": "...",  # 上次送出的 order message 內容 (見 getOrderMessageFingerprint)
+#     ...
+# }
+order_message_caches = {}
+# 共享的 order_store 中可合併的訂單狀態，只在 ORDER_STORE=shared 時使用，格式見 getOrderStateFromOrder
+# "ts" : {"channel_id": ..., "fields": {...}, "items": {...}}
+order_states = {}
 
 ORDER_STATE = (
     ":large_green_circle: 點餐中",
     ":red_circle: 已收單"
 )
 
+# 結案的 order message metadata 中的 "status"
+ORDER_STATUS_CLOSED = "closed"
+
+# Slack message 的 blocks 數量上限
+MAX_MESSAGE_BLOCKS = 50
+# section block 文字長度上限
+MAX_SECTION_TEXT_LENGTH = 3000
+# static_select options 數量上限
+MAX_SELECT_OPTIONS = 100
+# 結案統計每個 thread message 的 text 大小上限 (bytes)
+SETTLEMENT_MESSAGE_MAX_BYTES = int(os.environ.get("SETTLEMENT_MESSAGE_MAX_BYTES", "12000"))
+# actions block elements 數量上限
+MAX_ACTIONS_ELEMENTS = 25
+# external_select options 文字長度上限及 value 長度上限
+MAX_OPTION_TEXT_LENGTH = 75
+MAX_OPTION_VALUE_LENGTH = 150
+# 批次新增品項時最多顯示幾行錯誤
+MAX_BULK_ITEM_ERRORS = 10
+# 批次新增品項中 Slack 使用者的格式 <@U123> 或 <@U123|name>
+SLACK_USER_MENTION = re.compile(r"<@([UW][A-Z0-9]+)(?:\|[^>]*)?>")
+
 imgs = [
   "https://s3-media2.fl.yelpcdn.com/bphoto/DawwNigKJ2ckPeDeDM7jAg/o.jpg"
 ]
 
+# 合併同一個 order message 的 chat_update (毫秒)
+ORDER_UPDATE_DEBOUNCE_MS = int(os.environ.get("ORDER_UPDATE_DEBOUNCE_MS", "300"))
+# 第一次更新後最晚多久一定要送出 chat_update (毫秒)
+ORDER_UPDATE_MAX_LATENCY_MS = int(os.environ.get("ORDER_UPDATE_MAX_LATENCY_MS", "1000"))
+
+# 等待送出的 chat_update
+# "ts" : {
+#     "channel_id": "C123",
+#     "first_scheduled": 0.0,
+#     "timer": threading.Timer
+# }
+pending_order_updates = {}
+pending_order_updates_lock = threading.Lock()
+
+# Message metadata 格式版本，見 getMessageMetadataPayload
+METADATA_VERSION = 2
+# Message metadata 超過這個大小 (bytes) 時壓縮
+METADATA_COMPRESS_BYTES = int(os.environ.get("METADATA_COMPRESS_BYTES", "2000"))
+
+# 背景呼叫 Slack Web API 的 worker 數量，每個 worker 的 queue 大小，及失敗重試次數
+SLACK_API_WORKERS = int(os.environ.get("SLACK_API_WORKERS", "4"))
+SLACK_API_QUEUE_SIZE = int(os.environ.get("SLACK_API_QUEUE_SIZE", "1000"))
+SLACK_API_MAX_RETRIES = int(os.environ.get("SLACK_API_MAX_RETRIES", "3"))
+# 第一次重試前等待的時間 (毫秒)，之後每次加倍
+SLACK_API_RETRY_BACKOFF_MS = int(os.environ.get("SLACK_API_RETRY_BACKOFF_MS", "500"))
+# 每分鐘可呼叫的次數，依 Slack rate limit tiers (Tier 2: 20, Tier 3: 50, Tier 4: 100)
+SLACK_API_RATE_LIMITS = {
+    "chat_update": 50,
+    "chat_postMessage": 300,
+    "chat_postEphemeral": 100,
+    "views_open": 100,
+    "pins_add": 20,
+    "pins_remove": 20,
+    "pins_list": 20,
+    "conversations_history": 50
+}
+SLACK_API_DEFAULT_RATE_LIMIT = 20
+# 每個 channel 每分鐘可呼叫的次數
+SLACK_API_CHANNEL_RATE_LIMITS = {
+    "chat_update": 60,
+    "chat_postMessage": 60
+}
+# 背景 Web API 呼叫的優先順序，數字小的先執行: 更新 order message > 其他 > 通知
+SLACK_API_PRIORITY_UPDATE = 0
+SLACK_API_PRIORITY_DEFAULT = 1
+SLACK_API_PRIORITY_NOTICE = 2
+# 關閉時等待背景 Web API 呼叫完成的時間 (秒)
+SLACK_API_DRAIN_TIMEOUT = int(os.environ.get("SLACK_API_DRAIN_TIMEOUT", "10"))
+
+# 使用 AsyncApp 和 aiohttp 的 AsyncSocketModeHandler 執行
+SLACK_ORDER_ASYNC = os.environ.get("SLACK_ORDER_ASYNC", "") == "1"
+
+# 訂單儲存方式: memory (只存在全域變數)、sqlite 或 shared (多個 replicas 共用的 SQLite，見 SharedSQLiteOrderStore)
+ORDER_STORE = os.environ.get("ORDER_STORE", "memory")
+ORDER_STORE_PATH = os.environ.get("ORDER_STORE_PATH", "slack_order.db")
+# 批次寫入訂單的間隔 (毫秒)
+ORDER_STORE_FLUSH_MS = int(os.environ.get("ORDER_STORE_FLUSH_MS", "200"))
+# 這個 replica 的 id，記錄在共享的 order_store 的訂單狀態中 (見 recordOrderChanges)，每個 replica 必須不同
+REPLICA_ID = os.environ.get("REPLICA_ID") or f"{ socket.gethostname() }-{ os.getpid() }"
+
+# 訂單事件紀錄的目錄，空白表示不記錄
+ORDER_JOURNAL_DIR = os.environ.get("ORDER_JOURNAL_DIR", "")
+# 每個 journal segment 的事件數量，寫滿後換新的 segment 並將舊的合併進 snapshot
+ORDER_JOURNAL_SEGMENT_EVENTS = int(os.environ.get("ORDER_JOURNAL_SEGMENT_EVENTS", "5000"))
+
+# Slack Web API 的 base URL，壓力測試時指向本機的假 Web API (見 loadtest.py)
+SLACK_API_URL = os.environ.get("SLACK_API_URL", WebClient.BASE_URL)
+
+# 訂單閒置多久 (秒) 後移出記憶體，超過這段時間沒有修改的訂單也會從 order_store 刪除，0 表示不限制
+ORDER_CACHE_TTL = int(os.environ.get("ORDER_CACHE_TTL", "21600"))
+# 記憶體中最多保留的訂單數量，0 表示不限制
+ORDER_CACHE_MAX_ORDERS = int(os.environ.get("ORDER_CACHE_MAX_ORDERS", "500"))
+# 檢查閒置訂單的間隔 (秒)
+ORDER_CACHE_SWEEP_INTERVAL = int(os.environ.get("ORDER_CACHE_SWEEP_INTERVAL", "60"))
+
+# 相同的權限提示 (使用者, 訂單, 原因) 在這段時間 (秒) 內只送一次
+NOTICE_DEDUP_SECONDS = int(os.environ.get("NOTICE_DEDUP_SECONDS", "60"))
+# 記錄已送出的提示數量上限，超過時移除最舊的
+NOTICE_DEDUP_MAX_ENTRIES = int(os.environ.get("NOTICE_DEDUP_MAX_ENTRIES", "10000"))
+
+# 啟動時從這些頻道 (逗號分隔) 釘選的 order messages 讀回所有進行中的訂單，空白表示不讀取
+WARM_START_CHANNELS = [channel.strip() for channel in os.environ.get("WARM_START_CHANNELS", "").split(",") if channel.strip()]
+# 啟動時同時讀取 order messages 的數量
+WARM_START_WORKERS = int(os.environ.get("WARM_START_WORKERS", "4"))
+
+# 匯入的菜單 (CSV: channel_id,item,price 或 JSON: {"channel_id": {"品項": 金額}})，channel_id 為 * 或空白表示所有頻道
+MENU_CATALOG_PATH = os.environ.get("MENU_CATALOG_PATH", "")
+# 從結案訂單學到的菜單保存位置 (JSON)，空白表示只保存在記憶體
+MENU_CATALOG_LEARNED_PATH = os.environ.get("MENU_CATALOG_LEARNED_PATH", "")
+# 所有頻道共用的菜單
+MENU_CATALOG_ALL_CHANNELS = "*"
+
+# /metrics endpoint 的位址，port 為 0 時不啟動
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9464"))
+# latency histograms 的 buckets (秒)
+METRICS_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+# 檢查累計的訂單總計是否和重新計算的結果一致
+SLACK_ORDER_DEBUG = os.environ.get("SLACK_ORDER_DEBUG", "") == "1"
+# 執行 slack_order.py 時的 log level，啟動時的 warm start、journal 讀回及 metrics endpoint 等訊息為 INFO
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+
+logger = logging.getLogger(__name__)
+
 
 def isNaturalNumber(n):
     try:
@@ -69,6 +302,11 @@ def getSelectedFromViewState(view, block_id, action_id):
     return view["state"]["values"][block_id][action_id]["selected_option"]["text"]["text"]
 
 
+def getSelectedValueFromViewState(view, block_id, action_id):
+    selected_option = view["state"]["values"][block_id][action_id]["selected_option"]
+    return selected_option["value"] if selected_option else None
+
+
 def getSelectedUserFromViewState(view, block_id, action_id):
     return view["state"]["values"][block_id][action_id]["selected_user"]
 
@@ -103,16 +341,17 @@ def getMetadataEventPayloadFromMessageBody(body):
     return body["message"]["metadata"]["event_payload"]
 
 
-def getOrderStateFromMessageBody(body):
-    return body["message"]["metadata"]["event_payload"]["order_state"]
-
-
 def getChannelIdFromOpenNewOrderModal(view):
     return view["private_metadata"]
 
 
 def getOpenNewOrderModal(channel_id):
     '''開啟新訂單的 modal view'''
+    return OPEN_NEW_ORDER_MODAL_TEMPLATE.patch(private_metadata=channel_id)
+
+
+def buildOpenNewOrderModal(channel_id):
+    '''開啟新訂單的 modal view，只在建立 OPEN_NEW_ORDER_MODAL_TEMPLATE 時使用'''
     return {
         "type": "modal",
         "callback_id": "open_new_order_modal",
@@ -161,14 +400,17 @@ def getOpenNewOrderModal(channel_id):
 
 def getOrderMessageBlocks(kwargs):
     '''Order Message'''
+    return getOrderMessageHeaderBlocks(kwargs) + getOrderMessageFooterBlocks(kwargs)
+
+
+def getOrderMessageHeaderBlocks(kwargs):
+    '''Order Message 品項清單之前的 blocks'''
     global imgs
     order_name = kwargs["order_name"]
     order_creator = kwargs["order_creator"]
     order_info = kwargs["order_info"]
     order_img = kwargs["order_img"] if kwargs["order_img"] else secrets.choice(imgs)
     order_state = kwargs.get("order_state", ORDER_STATE[0])
-    order_total_amount = kwargs.get("order_total_amount", "0")
-    order_total_price = kwargs.get("order_total_price", "0")
 
     return [
         {
@@ -224,13 +466,29 @@ def getOrderMessageBlocks(kwargs):
                             "text": "修改品項金額"
                         },
                         "value": "modify_item_price"
+                    },
+                    {
+                        "text": {
+                            "type": "plain_text",
+                            "text": "批次新增品項"
+                        },
+                        "value": "bulk_add_items"
                     }
                 ]
             }
         },
         {
             "type": "divider"
-        },
+        }
+    ]
+
+
+def getOrderMessageFooterBlocks(kwargs):
+    '''Order Message 品項清單之後的 blocks'''
+    order_total_amount = kwargs.get("order_total_amount", "0")
+    order_total_price = kwargs.get("order_total_price", "0")
+
+    return [
         {
             "type": "divider"
         },
@@ -267,53 +525,271 @@ def getOrderMessageBlocks(kwargs):
     ]
 
 
+def getOrderItemBlock(item, item_detail):
+    '''品項的 section block'''
+    slack_users_detail = '、'.join('<@{}> x{}'.format(*p) for p in item_detail.slack_users.items())
+    users_detail = '、'.join('{} x{}'.format(*p) for p in item_detail.users.items())
+    if slack_users_detail and users_detail:
+        all_users = '、'.join((slack_users_detail, users_detail))
+    else:
+        all_users = slack_users_detail if slack_users_detail else users_detail
+
+    return {
+        "type": "section",
+        "text": {
+            "type": "mrkdwn",
+            "text": f"${ item_detail.price } { item } x{ item_detail.amount } ({ all_users }) "
+        },
+        "accessory": {
+            "type": "button",
+            "text": {
+                "type": "plain_text",
+                "text": "Choose"
+            },
+            "value": item,
+            "action_id": "add_item_action"
+        }
+    }
+
+
+def getOrderItemBlockKey(item_detail):
+    '''品項 block 的內容，用來判斷快取的 block 是否需要重建'''
+    return (
+        item_detail.price,
+        item_detail.amount,
+        tuple(item_detail.slack_users.items()),
+        tuple(item_detail.users.items())
+    )
+
+
 def getOrderMessageBlocksWithItems(**kwargs):
-    '''返回目前 order_message 和訂單清單'''
-    order_details = kwargs.get("order_details", {})
+    '''返回目前 order_message 和訂單清單
 
-    blocks = getOrderMessageBlocks(kwargs)
-    # blocks 插入目前 order_details 資訊
-    for item in sorted(order_details.keys()):
-        slack_users_detail = '、'.join('<@{}> x{}'.format(*p) for p in order_details[item].get('slack_users', {}).items())
-        users_detail = '、'.join('{} x{}'.format(*p) for p in order_details[item].get('users', {}).items())
-        if slack_users_detail and users_detail:
-            all_users = '、'.join((slack_users_detail, users_detail))
+    傳入 cache (dict) 時，會保留上次產生的 header/footer 及每個品項的 block，只重建有變動的部分
+    '''
+    order_details = kwargs.get("order_details", {})
+    cache = kwargs.get("cache", {})
+
+    header_key = tuple(kwargs.get(key) for key in ("order_name", "order_creator", "order_info", "order_img", "order_state"))
+    if cache.get("header_key") != header_key:
+        cache["header_key"] = header_key
+        cache["header"] = getOrderMessageHeaderBlocks(kwargs)
+
+    footer_key = (kwargs.get("order_total_amount", "0"), kwargs.get("order_total_price", "0"))
+    if cache.get("footer_key") != footer_key:
+        cache["footer_key"] = footer_key
+        cache["footer"] = getOrderMessageFooterBlocks(kwargs)
+
+    # 品項依名稱反向排序，品項有增減時才重新排序
+    if cache.get("item_names_key") != order_details.keys():
+        cache["item_names_key"] = set(order_details)
+        cache["item_names"] = sorted(order_details, reverse=True)
+
+    item_blocks = cache.get("items", {})
+    cache["items"] = {}
+    for item in cache["item_names"]:
+        item_key = getOrderItemBlockKey(order_details[item])
+        if item in item_blocks and item_blocks[item][0] == item_key:
+            cache["items"][item] = item_blocks[item]
         else:
-            all_users = slack_users_detail if slack_users_detail else users_detail
+            cache["items"][item] = (item_key, getOrderItemBlock(item, order_details[item]))
+
+    blocks = list(cache["header"])
+    item_blocks = [item_block for _, item_block in cache["items"].values()]
+    max_item_blocks = MAX_MESSAGE_BLOCKS - len(cache["header"]) - len(cache["footer"])
+    if len(item_blocks) <= max_item_blocks:
+        blocks.extend(item_blocks)
+    else:
+        # 品項太多時改用文字表格，Choose 按鈕改成下拉選單
+        blocks.extend(getCompactOrderItemBlocks(
+            item_names=cache["item_names"],
+            item_lines=[item_block["text"]["text"] for item_block in item_blocks],
+            max_blocks=max_item_blocks
+        ))
+    blocks.extend(cache["footer"])
+    return blocks
+
+
+def getCompactOrderItemBlocks(item_names, item_lines, max_blocks):
+    '''品項數量超過 message blocks 上限時，將品項合併成數個文字 section，並以下拉選單選擇品項'''
+    selects = []
+    for start in range(0, len(item_names), MAX_SELECT_OPTIONS):
+        names = item_names[start:start + MAX_SELECT_OPTIONS]
+        selects.append({
+            "type": "static_select",
+            "action_id": f"add_item_select_{ len(selects) }",
+            "placeholder": {
+                "type": "plain_text",
+                "text": f"選擇品項 ({ start + 1 }-{ start + len(names) })"
+            },
+            "options": [
+                {
+                    "text": {
+                        "type": "plain_text",
+                        "text": name[:MAX_OPTION_TEXT_LENGTH]
+                    },
+                    "value": name
+                } for name in names
+            ]
+        })
+    actions_blocks = [
+        {
+            "type": "actions",
+            "elements": selects[start:start + MAX_ACTIONS_ELEMENTS]
+        } for start in range(0, len(selects), MAX_ACTIONS_ELEMENTS)
+    ]
 
-        blocks.insert(5, {
+    sections = []
+    section_lines = []
+    section_length = 0
+    max_sections = max_blocks - len(actions_blocks)
+    truncated = False
+    for line in item_lines:
+        if len(line) >= MAX_SECTION_TEXT_LENGTH:
+            line = line[:MAX_SECTION_TEXT_LENGTH - 1] + "…"
+        if section_lines and section_length + len(line) + 1 > MAX_SECTION_TEXT_LENGTH:
+            sections.append('\n'.join(section_lines))
+            section_lines = []
+            section_length = 0
+            if len(sections) == max_sections:
+                truncated = True
+                break
+        section_lines.append(line)
+        section_length += len(line) + 1
+    if section_lines and not truncated:
+        sections.append('\n'.join(section_lines))
+    if truncated:
+        # 超過上限的品項不顯示，仍可從下拉選單選擇
+        sections[-1] = sections[-1][:MAX_SECTION_TEXT_LENGTH - 2] + "\n…"
+
+    return [
+        {
             "type": "section",
             "text": {
                 "type": "mrkdwn",
-                "text": f"${ order_details[item]['price'] } { item } x{ order_details[item]['amount'] } ({ all_users }) "
-            },
-            "accessory": {
-                "type": "button",
-                "text": {
-                    "type": "plain_text",
-                    "text": "Choose"
-                },
-                "value": item,
-                "action_id": "add_item_action"
+                "text": text
             }
-        })
-    return blocks
+        } for text in sections
+    ] + actions_blocks
 
 
 def ifMessageIsNoneReloadMetadata(body):
-    '''先確認是否全域變數 orders 為空，是的話將其 Message Metadata 讀進全域變數 orders, order_details'''
-    global orders, order_details
+    '''先確認是否全域變數 orders 為空，是的話從 order_store 或 Message Metadata 讀進全域變數 orders, order_details
+
+    返回是否有這個訂單，已結案的訂單不會讀回
+    '''
+    global orders
     ts = getTsFromMessageBody(body)
-    if not orders.get(ts):
-        event_payload = getMetadataEventPayloadFromMessageBody(body)
-        orders[ts] = {
-            "order_name": event_payload["order_name"],
-            "order_creator": event_payload["order_creator"],
-            "order_info": event_payload["order_info"],
-            "order_state": event_payload["order_state"],
-            "order_img": event_payload["order_img"]
-        }
-        order_details[ts] = event_payload["order_details"]
+    if loadOrder(ts):
+        return True
+    event_payload = getMetadataEventPayloadFromMessageBody(body)
+    if isClosedOrderPayload(event_payload):
+        return False
+    with getOrderLock(ts):
+        if not orders.get(ts):
+            loadOrderFromMetadata(getChannelIdFromMessageBody(body), ts, event_payload, source="metadata")
+    return True
+
+
+def loadOrderFromMetadata(channel_id, ts, event_payload, source):
+    '''從 order message 的 metadata 讀進 orders, order_details，呼叫時必須持有 getOrderLock(ts)'''
+    global orders, order_details
+    orders[ts], order_details[ts] = getOrderFromMessageMetadataPayload(event_payload)
+    orders[ts].channel_id = channel_id
+    resetOrderTotals(ts)
+    saveOrder(ts)
+    journalOrderCreated(ts)
+    touchOrder(ts)
+    metrics.inc("slack_order_order_rehydrations_total", source=source)
+
+
+def reloadOrder(channel_id, ts, source="history"):
+    '''view 送出時訂單可能已被移出記憶體 (見 evictOrders)，依序從 order_store 及 order message 的 metadata 讀回，返回是否有這個訂單
+
+    已結案的訂單不會讀回，結案後才送出的 view 不會修改已結案的 order message
+    會呼叫 conversations_history，SLACK_ORDER_ASYNC 模式必須在 event loop 以外的 thread 執行
+    '''
+    global orders
+    if loadOrder(ts):
+        return True
+    response = slack_api_dispatcher.callInline(
+        lambda: app.client.conversations_history(channel=channel_id, latest=ts, inclusive=True, limit=1, include_all_metadata=True),
+        description=f"conversations_history { ts }",
+        method="conversations_history",
+        channel=channel_id
+    )
+    messages = [message for message in response["messages"] if message["ts"] == ts and "metadata" in message]
+    if not messages:
+        logger.warning(f"order message not found: { channel_id } { ts }")
+        return False
+    if isClosedOrderPayload(messages[0]["metadata"]["event_payload"]):
+        logger.info(f"order already closed: { channel_id } { ts }")
+        return False
+    with getOrderLock(ts):
+        if not orders.get(ts):
+            loadOrderFromMetadata(channel_id, ts, messages[0]["metadata"]["event_payload"], source=source)
+    return True
+
+
+def getPinnedOrderMessages(channel_id, bot_id):
+    '''頻道中釘選的 order messages 的 ts (訂單結案時會取消釘選)，pins.list 有分頁時讀取所有頁'''
+    tss = []
+    page = 1
+    while True:
+        response = slack_api_dispatcher.callInline(
+            lambda: app.client.pins_list(channel=channel_id, page=page),
+            description=f"pins_list { channel_id } page { page }",
+            method="pins_list"
+        )
+        for item in response.get("items", []):
+            message = item.get("message")
+            # 只讀取這個 app 送出的 messages
+            if item.get("type") == "message" and message and message.get("bot_id") == bot_id:
+                tss.append(message["ts"])
+        paging = response.get("paging") or {}
+        if page >= paging.get("pages", 1):
+            return tss
+        page += 1
+
+
+def warmStartOrders():
+    '''啟動時在接收 events 之前讀回 WARM_START_CHANNELS 中所有釘選的訂單，返回讀回的訂單數量
+
+    已經在記憶體 (journal) 或 order_store 中的訂單不會再讀取 metadata，其他的以最多 WARM_START_WORKERS 個 threads
+    同時呼叫 conversations_history
+    '''
+    if not WARM_START_CHANNELS:
+        return 0
+    started = time.monotonic()
+    bot_id = app.client.auth_test()["bot_id"]
+    pinned = []
+    for channel_id in WARM_START_CHANNELS:
+        try:
+            tss = getPinnedOrderMessages(channel_id, bot_id)
+        except SlackApiError as error:
+            logger.warning(f"warm start: pins.list failed: { channel_id } { error.response.get('error') }")
+            continue
+        logger.info(f"warm start: { len(tss) } pinned order messages in { channel_id }")
+        pinned.extend((channel_id, ts) for ts in tss)
+
+    loaded = 0
+    failed = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=WARM_START_WORKERS, thread_name_prefix="warm-start") as executor:
+        futures = {executor.submit(reloadOrder, channel_id, ts, "warm_start"): ts for channel_id, ts in pinned}
+        for done, future in enumerate(concurrent.futures.as_completed(futures), start=1):
+            try:
+                if future.result():
+                    loaded += 1
+                else:
+                    failed += 1
+            except Exception:
+                logger.exception(f"warm start: load order failed: { futures[future] }")
+                failed += 1
+            if done % 50 == 0:
+                logger.info(f"warm start: { done }/{ len(pinned) } order messages checked")
+
+    logger.info(f"warm start: loaded { loaded } orders ({ failed } failed) from { len(WARM_START_CHANNELS) } channels in { time.monotonic() - started:.2f} s")
+    return loaded
 
 
 def getAddItemModalBlocks(**kwargs):
@@ -335,9 +811,14 @@ def getAddItemModalBlocks(**kwargs):
                 "text": "品項 :meat_on_bone: :"
             },
             "element": {
-                "type": "plain_text_input",
+                "type": "external_select",
                 "action_id": "item_name_input",
-                "initial_value": item_name
+                "placeholder": {
+                    "type": "plain_text",
+                    "text": "搜尋菜單或輸入新品項"
+                },
+                "min_query_length": 0,
+                **({"initial_option": getMenuOption(item_name)} if item_name else {})
             }
         },
         {
@@ -397,6 +878,7 @@ def getAddItemModalBlocks(**kwargs):
         },
         {
             "type": "section",
+            "block_id": "current_item_users",
             "text": {
                 "type": "plain_text",
                 "text": current_item_users,
@@ -409,6 +891,7 @@ def getAddItemModalBlocks(**kwargs):
         blocks.insert(0, {
             "type": "input",
             "block_id": "item_price",
+            "optional": True,
             "label": {
                 "type": "plain_text",
                 "text": "金額 :heavy_dollar_sign: :"
@@ -417,6 +900,10 @@ def getAddItemModalBlocks(**kwargs):
                 "type": "plain_text_input",
                 "action_id": "item_price_input",
                 "initial_value": item_price
+            },
+            "hint": {
+                "type": "plain_text",
+                "text": "空白時使用菜單的金額"
             }
         })
     else:
@@ -425,25 +912,117 @@ def getAddItemModalBlocks(**kwargs):
             "type": "section",
             "text": {
                 "type": "mrkdwn",
-                "text": f" *金額 :heavy_dollar_sign: : { item_price_mrkdwn }*"
+                "text": getItemPriceMrkdwn(item_price_mrkdwn)
             }
         })
 
     return blocks
 
 
+def getItemPriceMrkdwn(price):
+    return f" *金額 :heavy_dollar_sign: : { price }*"
+
+
+def buildAddItemModal(private_metadata, **kwargs):
+    '''品項設定 modal，只在建立 NEW_ITEM_MODAL_TEMPLATE 及 CHOOSE_ITEM_MODAL_TEMPLATE 時使用'''
+    return {
+        "type": "modal",
+        "callback_id": "add_item",
+        "title": {"type": "plain_text", "text": "新增品項"},
+        "submit": {"type": "plain_text", "text": "送出"},
+        "private_metadata": private_metadata,
+        "blocks": getAddItemModalBlocks(**kwargs)
+    }
+
+
 def getMessageMetadataPayload(kwargs):
-    '''orders 和 order_details 組成 Message metadata'''
-    payload = {}
-    payload["order_name"] = kwargs["order_name"]
-    payload["order_info"] = kwargs["order_info"]
-    payload["order_state"] = kwargs.get("order_state", ORDER_STATE[0])
-    payload["order_creator"] = kwargs["order_creator"]
-    payload["order_img"] = kwargs["order_img"]
-    payload["order_details"] = kwargs.get("order_details", {})
+    '''orders 和 order_details 組成 Message metadata
+
+    版本 METADATA_VERSION 的格式:
+    {
+        "v": 2,
+        "n": "order_name",
+        "i": "order_info",
+        "s": 0,  # ORDER_STATE 的 index
+        "c": "order_creator",
+        "g": "order_img",
+        "r": 3,  # Order.version
+        "u": ["user1_id", "user2_id"],  # 所有品項共用的 Slack 使用者表
+        "d": [
+            # [品項, 金額, [[Slack 使用者 index, 數量], ...], [[使用者, 數量], ...]]
+            ["item_name", 50, [[0, 1], [1, 2]], [["user1", 1]]]
+        ]
+    }
+    JSON 超過 METADATA_COMPRESS_BYTES 時，除了 "v" 以外的欄位以 zlib 壓縮後 base64 存在 "z"
+    結案後的 order message 另外有 "status": "closed" (不壓縮，見 isClosedOrderPayload)
+    '''
+    order_state = kwargs.get("order_state", ORDER_STATE[0])
+    slack_user_indexes = {}
+    items = []
+    for item, item_detail in kwargs.get("order_details", {}).items():
+        items.append([
+            item,
+            item_detail.price,
+            [[slack_user_indexes.setdefault(id, len(slack_user_indexes)), amount] for id, amount in item_detail.slack_users.items()],
+            [[user, amount] for user, amount in item_detail.users.items()]
+        ])
+    payload = {
+        "n": kwargs["order_name"],
+        "i": kwargs["order_info"],
+        "s": ORDER_STATE.index(order_state) if order_state in ORDER_STATE else order_state,
+        "c": kwargs["order_creator"],
+        "g": kwargs["order_img"],
+        "r": kwargs.get("version", 0),
+        "u": list(slack_user_indexes),
+        "d": items
+    }
+    payload_json = json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+    if len(payload_json.encode()) > METADATA_COMPRESS_BYTES:
+        return {
+            "v": METADATA_VERSION,
+            "z": base64.b64encode(zlib.compress(payload_json.encode(), 9)).decode()
+        }
+    payload["v"] = METADATA_VERSION
     return payload
 
 
+def isClosedOrderPayload(event_payload):
+    '''order message 的 metadata 是否為已結案的訂單，已結案的訂單不會再讀回'''
+    return event_payload.get("status") == ORDER_STATUS_CLOSED
+
+
+def getOrderFromMessageMetadataPayload(event_payload):
+    '''讀取 Message metadata 的 event_payload，返回 (Order, {品項: OrderItem})
+
+    支援舊版 (沒有 "v"，直接存放 orders 欄位和 order_details) 的 metadata
+    '''
+    if "v" not in event_payload:
+        order = Order.fromRecord(event_payload)
+        return order, {item: OrderItem.fromRecord(item_detail) for item, item_detail in event_payload["order_details"].items()}
+
+    if "z" in event_payload:
+        event_payload = json.loads(zlib.decompress(base64.b64decode(event_payload["z"])))
+    order_state = event_payload["s"]
+    order = Order(
+        name=event_payload["n"],
+        creator=event_payload["c"],
+        info=event_payload["i"],
+        state=ORDER_STATE[order_state] if isinstance(order_state, int) else order_state,
+        img=event_payload["g"],
+        version=event_payload.get("r", 0)
+    )
+    slack_user_table = event_payload["u"]
+    details = {}
+    for item, price, slack_users, users in event_payload["d"]:
+        details[item] = OrderItem(
+            price=price,
+            amount=sum(amount for _, amount in slack_users) + sum(amount for _, amount in users),
+            slack_users={slack_user_table[index]: amount for index, amount in slack_users},
+            users=dict(users)
+        )
+    return order, details
+
+
 def getMessageMetadata(**kwargs):
     payload = getMessageMetadataPayload(kwargs)
     metadata = {
@@ -453,26 +1032,74 @@ def getMessageMetadata(**kwargs):
     return metadata
 
 
-def checkPermission(channel_id, ts, body, client):
+def getPermissionNotice(ts, user_id):
+    '''已收單且不是訂單建立者時，返回提示文字'''
     global orders
-    if orders[ts]["order_state"] == ORDER_STATE[1] and body['user']['id'] != orders[ts]['order_creator']:
-        client.chat_postMessage(
-            channel=channel_id,
-            thread_ts=ts,
-            text=f"已收單，<@{ body['user']['id'] }>請聯繫訂單建立者(<@{ orders[ts]['order_creator'] }>)"
-        )
+    if orders[ts].state == ORDER_STATE[1] and user_id != orders[ts].creator:
+        return f"已收單，<@{ user_id }>請聯繫訂單建立者(<@{ orders[ts].creator }>)"
+    return None
+
+
+def getOrderCreatorNotice(ts, user_id):
+    '''不是訂單建立者時，返回提示文字'''
+    global orders
+    if user_id != orders[ts].creator:
+        return f"<@{ user_id }> 只有訂單建立者(<@{ orders[ts].creator }>)能修改資訊及結案"
+    return None
+
+
+def getOrderEndedNotice(user_id):
+    '''已結案的訂單的提示文字'''
+    return f"<@{ user_id }> 訂單已結案，無法再修改"
+
+
+def shouldSendNotice(user_id, ts, reason):
+    '''NOTICE_DEDUP_SECONDS 內已經對這個使用者送過相同訂單、相同原因的提示時返回 False'''
+    global notice_times
+    key = (user_id, ts, reason)
+    now = time.monotonic()
+    with notice_times_lock:
+        # 依送出時間排序，移除過期及超過數量上限的紀錄
+        while notice_times:
+            sent = next(iter(notice_times.values()))
+            if now - sent < NOTICE_DEDUP_SECONDS and len(notice_times) < NOTICE_DEDUP_MAX_ENTRIES:
+                break
+            notice_times.popitem(last=False)
+        suppressed = key in notice_times
+        if not suppressed:
+            notice_times[key] = now
+    metrics.inc("slack_order_notices_total", reason=reason, result="suppressed" if suppressed else "sent")
+    return not suppressed
+
+
+def isOrderOpen(body):
+    '''讀回訂單 (見 ifMessageIsNoneReloadMetadata)，已結案時提示使用者並返回 False'''
+    if ifMessageIsNoneReloadMetadata(body):
+        return True
+    channel_id = getChannelIdFromMessageBody(body)
+    ts = getTsFromMessageBody(body)
+    user_id = body['user']['id']
+    if shouldSendNotice(user_id, ts, "order_ended"):
+        submitSlackApiCall(ts, "chat_postEphemeral", priority=SLACK_API_PRIORITY_NOTICE, channel=channel_id, user=user_id, text=getOrderEndedNotice(user_id))
+    return False
+
+
+def checkPermission(channel_id, ts, body):
+    user_id = body['user']['id']
+    notice = getPermissionNotice(ts, user_id)
+    if notice:
+        if shouldSendNotice(user_id, ts, "order_closed"):
+            submitSlackApiCall(ts, "chat_postEphemeral", priority=SLACK_API_PRIORITY_NOTICE, channel=channel_id, user=user_id, text=notice)
         return False
     return True
 
 
-def isOrderCreator(channel_id, ts, body, client):
-    global orders
-    if body['user']['id'] != orders[ts]["order_creator"]:
-        client.chat_postMessage(
-            channel=channel_id,
-            thread_ts=ts,
-            text=f"<@{ body['user']['id'] }> 只有訂單建立者(<@{ orders[ts]['order_creator'] }>)能修改資訊及結案"
-        )
+def isOrderCreator(channel_id, ts, body):
+    user_id = body['user']['id']
+    notice = getOrderCreatorNotice(ts, user_id)
+    if notice:
+        if shouldSendNotice(user_id, ts, "not_creator"):
+            submitSlackApiCall(ts, "chat_postEphemeral", priority=SLACK_API_PRIORITY_NOTICE, channel=channel_id, user=user_id, text=notice)
         return False
     return True
 
@@ -482,306 +1109,2648 @@ def getPrivateMetadataFormatString(body):
 
 
 def getOrderTotalPrice(ts):
-    global order_details
-    total = 0
-    for item in order_details.get(ts, {}):
-        total += (int(order_details[ts][item]["amount"]) * int(order_details[ts][item]["price"]))
-    return str(total)
+    global orders
+    return str(orders[ts].total_price)
 
 
 def getOrderTotalAmount(ts):
-    global order_details
-    amount = 0
-    for item in order_details.get(ts, {}):
-        amount += int(order_details[ts][item]["amount"])
-    return str(amount)
+    global orders
+    return str(orders[ts].total_amount)
 
 
-# Initializes your app with your bot token and socket mode handler
-app = App(token=os.environ.get("SLACK_BOT_TOKEN"))
+def getItemUserAmounts(item_detail):
+    '''品項中每個使用者的數量，Slack 使用者以 <@user_id> 表示'''
+    for id, amount in item_detail.slack_users.items():
+        yield f"<@{ id }>", amount
+    yield from item_detail.users.items()
 
 
-@app.command("/order")
-def open_modal(ack, body, client):
-    '''指令 /order 開啟新訂單的 modal'''
-    ack()
-    client.views_open(
-        trigger_id=body["trigger_id"],
-        view=getOpenNewOrderModal(channel_id=body["channel_id"])
-    )
+def addItemToOrderTotals(ts, item_detail, sign=1):
+    '''將一個品項加入(sign=1)或移出(sign=-1)訂單的總數、總金額及個人小計'''
+    global orders
+    order = orders[ts]
+    price = item_detail.price
+    user_totals = order.user_totals
+    order.total_amount += sign * item_detail.amount
+    order.total_price += sign * item_detail.amount * price
+    for user, amount in getItemUserAmounts(item_detail):
+        user_totals[user] = user_totals.get(user, 0) + sign * amount * price
+        if user_totals[user] == 0:
+            user_totals.pop(user)
+
+
+def computeOrderTotals(ts):
+    '''重新掃過所有品項計算訂單的總數、總金額及個人小計'''
+    global order_details
+    totals = {"total_amount": 0, "total_price": 0, "user_totals": {}}
+    for item_detail in order_details.get(ts, {}).values():
+        price = item_detail.price
+        totals["total_amount"] += item_detail.amount
+        totals["total_price"] += item_detail.amount * price
+        for user, amount in getItemUserAmounts(item_detail):
+            totals["user_totals"][user] = totals["user_totals"].get(user, 0) + amount * price
+    return totals
 
 
-@app.view("open_new_order_modal")
-def handle_submission(ack, say, client, view, body):
-    '''Handle OpenNewOrderModal submission'''
-    global orders, order_details, imgs
-    ack()
-    order_name = getValueFromViewState(view=view, block_id="order_name", action_id="order_name_input")
-    order_info = getValueFromViewState(view=view, block_id="order_info", action_id="order_info_input")
-    order_img = getValueFromViewState(view=view, block_id="order_img", action_id="order_img_input")
-    order_img = order_img if order_img else secrets.choice(imgs)
-    order_creator = getUserIdFromMessageBody(body=body)
+def resetOrderTotals(ts):
+    global orders
+    for key, value in computeOrderTotals(ts).items():
+        setattr(orders[ts], key, value)
 
-    # 將資訊存到 Message metadata > event_payload
-    metadata = getMessageMetadata(
-        order_name=order_name,
-        order_info=order_info,
-        order_state=ORDER_STATE[0],
-        order_creator=order_creator,
-        order_img=order_img,
-        order_details={}
-    )
 
-    message = say(
-        text="order",
-        channel=getChannelIdFromOpenNewOrderModal(view=view),
-        blocks=getOrderMessageBlocksWithItems(
-            order_name=order_name,
-            order_creator=order_creator,
-            order_info=order_info,
-            order_img=order_img,
-            order_state=ORDER_STATE[0]
-        ),
-        metadata=metadata,
-        # 不要自動展開連結
-        unfurl_links=False
-    )
+def checkOrderTotals(ts):
+    '''SLACK_ORDER_DEBUG 模式下比對累計的總數和重新計算的結果'''
+    global orders
+    if not SLACK_ORDER_DEBUG:
+        return
+    totals = computeOrderTotals(ts)
+    for key, value in totals.items():
+        if getattr(orders[ts], key) != value:
+            logger.error(f"order totals mismatch: { ts } { key } { getattr(orders[ts], key) } != { value }")
+            setattr(orders[ts], key, value)
 
-    # 釘選訂單 message
-    client.pins_add(channel=message["channel"], timestamp=message["ts"])
-    # 新增/更新 訂單資訊到全域變數
-    orders[message["ts"]] = {
-        "order_name": order_name,
-        "order_creator": order_creator,
-        "order_info": order_info,
-        "order_img": order_img,
-        "order_state": ORDER_STATE[0]
-    }
-    order_details[message["ts"]] = {}
 
+def setOrderItem(ts, item, item_detail):
+    '''新增/更新/移除(item_detail 為 None) 品項並更新訂單總計'''
+    global order_details
+    details = order_details.setdefault(ts, {})
+    if item in details:
+        addItemToOrderTotals(ts, details.pop(item), sign=-1)
+    if item_detail:
+        details[item] = item_detail
+        addItemToOrderTotals(ts, item_detail)
+    checkOrderTotals(ts)
 
-@app.view("add_item")
-def handle_submission(ack, view):
-    '''監聽訂單新增按鈕開起的 modal view 送出'''
-    global orders, order_details
-    channel_id = getChannelIdFromViewPrivateMetadata(view)
-    message_ts = getMessageTsFromViewPrivateMetadata(view)
-    errors = {}
-    item = getValueFromViewState(view=view, block_id="item_name", action_id="item_name_input")
-    price = getValueFromViewState(view=view, block_id="item_price", action_id="item_price_input") if view['state']['values'].get("item_price", {}) else view["private_metadata"].split(',')[2]
-    amount = getValueFromViewState(view=view, block_id="item_amount", action_id="item_amount_input")
-    slack_users = getSelectedUsersFromViewState(view=view, block_id="item_slack_users", action_id="item_slack_users_input")
-    users = getValueFromViewState(view=view, block_id="item_users", action_id="item_users_input")
 
-    if not isPositiveNumber(price):
-        errors["item_price"] = "金額必須是的數字, 且大於0"
-    if not isNaturalNumber(amount):
-        errors["item_amount"] = "數量必須是數字, 且大於等於0"
+def setOrderItemPrice(ts, item, price):
+    global order_details
+    setOrderItem(ts, item, dataclasses.replace(order_details[ts][item], price=price))
 
-    if not slack_users and not users:
-        errors["item_slack_users"] = "必須有一個使用者"
-        errors["item_users"] = "必須有一個使用者"
 
-    if len(errors) > 0:
-        ack(response_action="errors", errors=errors)
-        return
+class OrderLock:
+    '''訂單的 RLock，記錄 getOrderLock 取得後還沒有釋放的次數 (持有或等待中的 threads)
 
-    ack()
+    次數歸零時才從 order_locks 移除，持有或等待舊的 lock 的 thread 和之後取得新的 lock 的 thread 不會同時修改同一個訂單
+    '''
+    __slots__ = ("ts", "lock", "references")
 
-    # 目前這個品項的使用者
-    current_item_slack_users = {}
-    current_item_users = {}
+    def __init__(self, ts):
+        self.ts = ts
+        self.lock = threading.RLock()
+        self.references = 0
 
-    # get current order_detail if exist
-    if order_details.get(message_ts, {}).get(item, {}).get("slack_users"):
-        current_item_slack_users = order_details[message_ts][item]["slack_users"]
-    if order_details.get(message_ts, {}).get(item, {}).get("users"):
-        current_item_users = order_details[message_ts][item]["users"]
+    def acquire(self, blocking=True):
+        '''blocking=False 且被其他 thread 持有時返回 False，同時釋放 getOrderLock 的參照'''
+        if self.lock.acquire(blocking):
+            return True
+        releaseOrderLock(self)
+        return False
 
-    for slack_user in slack_users:
-        if int(amount) == 0:
-            current_item_slack_users.pop(slack_user, None)
-        else:
-            current_item_slack_users[slack_user] = amount
+    def release(self):
+        self.lock.release()
+        releaseOrderLock(self)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def getOrderLock(ts):
+    '''取得訂單的 lock，同一個訂單的修改依序執行，必須以 with 或 acquire()/release() 使用'''
+    global order_locks
+    with order_locks_lock:
+        order_lock = order_locks.get(ts)
+        if order_lock is None:
+            order_lock = order_locks[ts] = OrderLock(ts)
+        order_lock.references += 1
+        return order_lock
+
+
+def releaseOrderLock(order_lock):
+    '''釋放 getOrderLock 的參照，沒有 thread 使用時從 order_locks 移除'''
+    global order_locks
+    with order_locks_lock:
+        order_lock.references -= 1
+        if not order_lock.references and order_locks.get(order_lock.ts) is order_lock:
+            del order_locks[order_lock.ts]
+
+
+def getOrderMessageUpdate(ts):
+    '''以目前 orders, order_details 產生 order message 的 blocks 和 metadata'''
+    global orders, order_details, order_message_caches
+    with getOrderLock(ts):
+        order = dict(orders[ts].toRecord(), order_details=order_details.get(ts, {}))
+        blocks = getOrderMessageBlocksWithItems(
+            order_total_price=getOrderTotalPrice(ts),
+            order_total_amount=getOrderTotalAmount(ts),
+            cache=order_message_caches.setdefault(ts, {}),
+            **order
+        )
+        metadata = getMessageMetadata(**order)
+    return blocks, metadata
 
-    if users:
-        users = users.split(',')
-        for user in users:
-            if int(amount) == 0:
-                current_item_users.pop(user, None)
-            else:
-                current_item_users[user] = amount
 
-    # 計算總數
-    current_amount = 0
-    for value in list(current_item_slack_users.values()):
-        current_amount += int(value)
-    for value in list(current_item_users.values()):
-        current_amount += int(value)
-    if current_amount == 0:
-        order_details.setdefault(message_ts, {}).pop(item, {})
-    else:
-        order_details.setdefault(message_ts, {})[item] = {
-            "price": price,
-            "amount": current_amount,
-            "slack_users": current_item_slack_users,
-            "users": current_item_users
-        }
+def getOrderMessageFingerprint(blocks, metadata):
+    '''order message 內容的 sha256，每次保存都會改變的 Order.version ("r") 不計入'''
+    payload = metadata["event_payload"]
+    if "z" in payload:
+        payload = json.loads(zlib.decompress(base64.b64decode(payload["z"])))
+    payload = {key: value for key, value in payload.items() if key not in ("r", "v")}
+    content = json.dumps([blocks, metadata["event_type"], payload], ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(content.encode()).hexdigest()
 
-    blocks = getOrderMessageBlocksWithItems(
-        order_name=orders[message_ts]["order_name"],
-        order_creator=orders[message_ts]["order_creator"],
-        order_info=orders[message_ts]["order_info"],
-        order_img=orders[message_ts]["order_img"],
-        order_state=orders[message_ts]["order_state"],
-        order_total_price=getOrderTotalPrice(message_ts),
-        order_total_amount=getOrderTotalAmount(message_ts),
-        order_details=order_details[message_ts]
-    )
 
-    metadata = getMessageMetadata(
-        order_name=orders[message_ts]["order_name"],
-        order_creator=orders[message_ts]["order_creator"],
-        order_info=orders[message_ts]["order_info"],
-        order_img=orders[message_ts]["order_img"],
-        order_state=orders[message_ts]["order_state"],
-        order_details=order_details[message_ts]
-    )
+def getSentOrderMessageFingerprint(ts):
+    '''上次送出的 order message 內容，共享的 order_store 時 order message 可能是其他 replica 更新的，從 order_store 讀取'''
+    global order_message_caches
+    if order_store.shared:
+        return order_store.getMessageFingerprint(ts)
+    return order_message_caches.get(ts, {}).get("fingerprint")
+
 
+def setSentOrderMessageFingerprint(ts, fingerprint):
+    global order_message_caches
+    if order_store.shared:
+        order_store.setMessageFingerprint(ts, fingerprint)
+        return
+    # 訂單已被移出記憶體時不需要記錄
+    cache = order_message_caches.get(ts)
+    if cache is not None:
+        cache["fingerprint"] = fingerprint
+
+
+def getChangedOrderMessageUpdate(ts):
+    '''返回 (blocks, metadata, fingerprint)，內容和上次送出的 order message 相同時返回 None，不需要 chat_update'''
+    blocks, metadata = getOrderMessageUpdate(ts)
+    fingerprint = getOrderMessageFingerprint(blocks, metadata)
+    if fingerprint == getSentOrderMessageFingerprint(ts):
+        metrics.inc("slack_order_order_message_updates_total", result="skipped")
+        return None
+    return blocks, metadata, fingerprint
+
+
+def updateOrderMessage(channel_id, ts):
+    '''立即 chat_update order message，內容沒有改變時不送出'''
+    update = getChangedOrderMessageUpdate(ts)
+    if not update:
+        return
+    blocks, metadata, fingerprint = update
     app.client.chat_update(
         channel=channel_id,
-        ts=message_ts,
+        ts=ts,
         text="updated",
         metadata=metadata,
         blocks=blocks
     )
+    setSentOrderMessageFingerprint(ts, fingerprint)
+    metrics.inc("slack_order_order_message_updates_total", result="sent")
+
+
+def scheduleOrderMessageUpdate(channel_id, ts):
+    '''合併短時間內的更新，ORDER_UPDATE_DEBOUNCE_MS 內沒有新的更新，或距離第一次更新超過 ORDER_UPDATE_MAX_LATENCY_MS 才送出 chat_update'''
+    global pending_order_updates
+    now = time.monotonic()
+    with pending_order_updates_lock:
+        pending = pending_order_updates.get(ts)
+        if pending:
+            pending["timer"].cancel()
+        else:
+            pending = pending_order_updates[ts] = {
+                "channel_id": channel_id,
+                "first_scheduled": now
+            }
+        deadline = pending["first_scheduled"] + ORDER_UPDATE_MAX_LATENCY_MS / 1000
+        delay = max(0, min(ORDER_UPDATE_DEBOUNCE_MS / 1000, deadline - now))
+        pending["timer"] = threading.Timer(delay, flushOrderMessageUpdate, args=(ts,))
+        pending["timer"].daemon = True
+        pending["timer"].start()
+
+
+def cancelOrderMessageUpdate(ts):
+    '''取消尚未送出的 chat_update，返回是否有等待中的更新'''
+    global pending_order_updates
+    with pending_order_updates_lock:
+        pending = pending_order_updates.pop(ts, None)
+    if pending:
+        pending["timer"].cancel()
+    return pending is not None
+
+
+def takePendingOrderMessageUpdates():
+    '''取消所有還在 debounce 中的 chat_update timers，返回 [(channel_id, ts), ...]，關閉前由呼叫者立即送出'''
+    global pending_order_updates
+    with pending_order_updates_lock:
+        pendings = list(pending_order_updates.items())
+        pending_order_updates.clear()
+    for _, pending in pendings:
+        pending["timer"].cancel()
+    return [(pending["channel_id"], ts) for ts, pending in pendings]
+
+
+def flushOrderMessageUpdate(ts):
+    '''送出等待中的 chat_update，blocks 和 metadata 以送出當下的訂單狀態產生'''
+    global orders, pending_order_updates
+    with pending_order_updates_lock:
+        pending = pending_order_updates.pop(ts, None)
+    if not pending or ts not in orders:
+        return
+    try:
+        submitOrderMessageUpdate(pending["channel_id"], ts)
+    except Exception:
+        logger.exception(f"chat_update failed: { ts }")
 
 
-@app.view("modify_order_message_modal")
-def handle_submission(ack, view, client):
-    global orders, order_details, imgs
-    channel_id = getChannelIdFromViewPrivateMetadata(view)
-    ts = getMessageTsFromViewPrivateMetadata(view)
-    new_order_creator = getSelectedUserFromViewState(view=view, block_id="order_creator", action_id="order_creator_select")
+class MemoryOrderStore:
+    '''不保存訂單，只使用全域變數 orders, order_details'''
+    # 是否和其他 replicas 共用，見 updateOrder
+    shared = False
 
-    if orders[ts]["order_creator"] != new_order_creator:
-        client.chat_postMessage(
-            channel=channel_id,
-            thread_ts=ts,
-            text=f"訂單建立者<@{ orders[ts]['order_creator'] }>，已將權限轉給<@{ new_order_creator }>"
-        )
+    def load(self, ts):
+        return None
 
-    orders[ts]["order_creator"] = new_order_creator
-    orders[ts]["order_name"] = getValueFromViewState(view=view, block_id="order_name", action_id="order_name_input")
-    orders[ts]["order_info"] = getValueFromViewState(view=view, block_id="order_info", action_id="order_info_input")
-    orders[ts]["order_img"] = getValueFromViewState(view=view, block_id="order_img", action_id="order_img_input")
-    orders[ts]["order_img"] = orders[ts]["order_img"] if orders[ts]["order_img"] else secrets.choice(imgs)
-    orders[ts]["order_state"] = getSelectedFromViewState(view=view, block_id="order_state", action_id="order_state_selected")
-
-    blocks = getOrderMessageBlocksWithItems(
-        order_name=orders[ts]["order_name"],
-        order_creator=orders[ts]["order_creator"],
-        order_info=orders[ts]["order_info"],
-        order_state=orders[ts]["order_state"],
-        order_img=orders[ts]["order_img"],
-        order_total_price=getOrderTotalPrice(ts),
-        order_total_amount=getOrderTotalAmount(ts),
-        order_details=order_details.get(ts, {})
-    )
+    def expire(self, before, keep=()):
+        return 0
 
-    metadata = getMessageMetadata(
-        order_name=orders[ts]["order_name"],
-        order_creator=orders[ts]["order_creator"],
-        order_info=orders[ts]["order_info"],
-        order_state=orders[ts]["order_state"],
-        order_img=orders[ts]["order_img"],
-        order_details=order_details.get(ts, {})
-    )
+    def save(self, ts, order, details):
+        pass
 
-    client.chat_update(
-        channel=channel_id,
-        ts=ts,
-        text="updated",
-        metadata=metadata,
-        blocks=blocks
-    )
-    ack()
+    def delete(self, ts):
+        pass
 
+    def close(self):
+        pass
 
-@app.view("modify_item_price_modal")
-def handle_submission(ack, view, client):
-    global orders, order_details
-    errors = {}
-    channel_id = getChannelIdFromViewPrivateMetadata(view)
-    ts = getMessageTsFromViewPrivateMetadata(view)
-    item = getSelectedFromViewState(view=view, block_id="modify_item_name", action_id="modify_item_name_select")
-    price = getValueFromViewState(view=view, block_id="modify_item_price", action_id="modify_item_price_input")
 
-    if not isPositiveNumber(price):
-        errors["modify_item_price"] = "金額必須是的數字, 且大於0"
+class SQLiteOrderStore:
+    '''以 SQLite (WAL) 保存訂單，save/delete 先放在 pending，每 ORDER_STORE_FLUSH_MS 批次寫入'''
+    shared = False
+
+    SCHEMA = (
+        """CREATE TABLE IF NOT EXISTS orders (
+            ts TEXT PRIMARY KEY,
+            channel_id TEXT,
+            order_name TEXT NOT NULL,
+            order_creator TEXT NOT NULL,
+            order_info TEXT NOT NULL,
+            order_state TEXT NOT NULL,
+            order_img TEXT NOT NULL,
+            updated_at REAL NOT NULL,
+            version INTEGER NOT NULL DEFAULT 0
+        )""",
+        "CREATE INDEX IF NOT EXISTS orders_order_state ON orders (order_state)",
+        "CREATE INDEX IF NOT EXISTS orders_updated_at ON orders (updated_at)",
+        """CREATE TABLE IF NOT EXISTS order_items (
+            ts TEXT NOT NULL,
+            item TEXT NOT NULL,
+            price INTEGER NOT NULL,
+            PRIMARY KEY (ts, item)
+        ) WITHOUT ROWID""",
+        """CREATE TABLE IF NOT EXISTS order_item_users (
+            ts TEXT NOT NULL,
+            item TEXT NOT NULL,
+            is_slack_user INTEGER NOT NULL,
+            user TEXT NOT NULL,
+            amount INTEGER NOT NULL,
+            PRIMARY KEY (ts, item, is_slack_user, user)
+        ) WITHOUT ROWID""",
+        "CREATE INDEX IF NOT EXISTS order_item_users_user ON order_item_users (user)"
+    )
 
-    if len(errors) > 0:
-        ack(response_action="errors", errors=errors)
-        return
+    def __init__(self, path, flush_interval):
+        self.db = self.connect(path)
+        self.db_lock = threading.Lock()
+        # 尚未寫入的訂單，None 表示刪除
+        # "ts" : (Order.toRecord(), {品項: OrderItem.toRecord()}) | None
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.flush_interval = flush_interval
+        self.closed = threading.Event()
+        self.writer = threading.Thread(target=self.run, name="order-store-writer", daemon=True)
+        self.writer.start()
+
+    @classmethod
+    def connect(cls, path):
+        db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        with db:
+            for statement in cls.SCHEMA:
+                db.execute(statement)
+            # 舊的資料庫沒有 version
+            if "version" not in [row[1] for row in db.execute("PRAGMA table_info(orders)")]:
+                db.execute("ALTER TABLE orders ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        return db
+
+    def load(self, ts):
+        with self.pending_lock:
+            if ts in self.pending:
+                return self.pending[ts] and self.getOrderFromRecords(*self.pending[ts])
+        with self.db_lock:
+            row = self.db.execute(
+                "SELECT channel_id, order_name, order_creator, order_info, order_state, order_img, version FROM orders WHERE ts = ?",
+                (ts,)
+            ).fetchone()
+            if not row:
+                return None
+            items = self.db.execute("SELECT item, price FROM order_items WHERE ts = ?", (ts,)).fetchall()
+            item_users = self.db.execute(
+                "SELECT item, is_slack_user, user, amount FROM order_item_users WHERE ts = ?",
+                (ts,)
+            ).fetchall()
+        return self.getOrderFromRows(row, items, item_users)
+
+    def expire(self, before, keep=()):
+        '''刪除最後修改時間 (time.time()) 早於 before 的訂單，keep 中的訂單 (還在記憶體中) 不刪除，返回刪除的數量'''
+        self.flush()
+        keep = set(keep)
+        with self.db_lock, self.db:
+            tss = [row[0] for row in self.db.execute("SELECT ts FROM orders WHERE updated_at < ?", (before,)) if row[0] not in keep]
+            for ts in tss:
+                self.deleteRows(ts)
+        return len(tss)
+
+    @staticmethod
+    def getOrderFromRows(row, items, item_users):
+        order = Order.fromRecord(dict(zip(("channel_id", "order_name", "order_creator", "order_info", "order_state", "order_img", "version"), row)))
+        details = {item: OrderItem(price=price) for item, price in items}
+        for item, is_slack_user, user, amount in item_users:
+            (details[item].slack_users if is_slack_user else details[item].users)[user] = amount
+            details[item].amount += amount
+        return order, details
+
+    @staticmethod
+    def getOrderFromRecords(order, details):
+        return Order.fromRecord(order), {item: OrderItem.fromRecord(item_detail) for item, item_detail in details.items()}
+
+    def save(self, ts, order, details):
+        '''保存訂單，呼叫時必須持有 getOrderLock(ts)'''
+        records = (order.toRecord(), {item: item_detail.toRecord() for item, item_detail in details.items()})
+        with self.pending_lock:
+            self.pending[ts] = records
+
+    def delete(self, ts):
+        with self.pending_lock:
+            self.pending[ts] = None
+
+    def run(self):
+        while not self.closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("order store flush failed")
+
+    def flush(self):
+        '''將 pending 的訂單以一個 transaction 寫入'''
+        with self.pending_lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        with self.db_lock, self.db:
+            for ts, value in pending.items():
+                if value is None:
+                    self.deleteRows(ts)
+                else:
+                    self.writeRows(ts, *value)
+
+    def deleteRows(self, ts):
+        self.db.execute("DELETE FROM order_item_users WHERE ts = ?", (ts,))
+        self.db.execute("DELETE FROM order_items WHERE ts = ?", (ts,))
+        self.db.execute("DELETE FROM orders WHERE ts = ?", (ts,))
+
+    def writeRows(self, ts, order, details):
+        '''以 toRecord() 格式的訂單取代資料庫中的訂單，呼叫時必須在 transaction 中'''
+        self.db.execute("DELETE FROM order_item_users WHERE ts = ?", (ts,))
+        self.db.execute("DELETE FROM order_items WHERE ts = ?", (ts,))
+        self.db.execute(
+            """INSERT OR REPLACE INTO orders
+            (ts, channel_id, order_name, order_creator, order_info, order_state, order_img, updated_at, version)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (ts, order["channel_id"], order["order_name"], order["order_creator"], order["order_info"],
+             order["order_state"], order["order_img"], time.time(), order["version"])
+        )
+        self.db.executemany(
+            "INSERT INTO order_items VALUES (?, ?, ?)",
+            [(ts, item, item_detail["price"]) for item, item_detail in details.items()]
+        )
+        self.db.executemany(
+            "INSERT INTO order_item_users VALUES (?, ?, ?, ?, ?)",
+            [(ts, item, 1, id, amount) for item, item_detail in details.items() for id, amount in item_detail["slack_users"].items()]
+            + [(ts, item, 0, user, amount) for item, item_detail in details.items() for user, amount in item_detail["users"].items()]
+        )
 
-    order_details[ts][item]["price"] = price
-
-    blocks = getOrderMessageBlocksWithItems(
-        order_name=orders[ts]["order_name"],
-        order_creator=orders[ts]["order_creator"],
-        order_info=orders[ts]["order_info"],
-        order_state=orders[ts]["order_state"],
-        order_total_price=getOrderTotalPrice(ts),
-        order_total_amount=getOrderTotalAmount(ts),
-        order_img=orders[ts]["order_img"],
-        order_details=order_details[ts]
+    def close(self):
+        self.closed.set()
+        self.writer.join()
+        self.flush()
+        with self.db_lock:
+            self.db.close()
+
+
+class SharedSQLiteOrderStore(SQLiteOrderStore):
+    '''多個 replicas 共用的 SQLite 訂單儲存，可以在同一台機器上測試多個 replicas (見 replica_test.py)
+
+    除了 orders 等資料表，另外在 order_states 保存可合併的訂單狀態 (見 mergeOrderStates)。
+    修改以 merge() 在同一個 transaction 中和資料庫的狀態合併後寫回，同時修改的 replicas 不會互相覆蓋，也不需要重試
+    '''
+    shared = True
+    SCHEMA = SQLiteOrderStore.SCHEMA + (
+        """CREATE TABLE IF NOT EXISTS order_states (
+            ts TEXT PRIMARY KEY,
+            state TEXT NOT NULL
+        ) WITHOUT ROWID""",
+        # 最後一次送出的 order message 內容 (見 getOrderMessageFingerprint)
+        """CREATE TABLE IF NOT EXISTS order_message_fingerprints (
+            ts TEXT PRIMARY KEY,
+            fingerprint TEXT NOT NULL
+        ) WITHOUT ROWID""",
+        # 已結案 (delete) 的訂單，和超過 ORDER_CACHE_TTL 被刪除 (expire) 的訂單區分，見 refreshOrder
+        """CREATE TABLE IF NOT EXISTS order_tombstones (
+            ts TEXT PRIMARY KEY,
+            closed_at REAL NOT NULL
+        ) WITHOUT ROWID""",
+        "CREATE INDEX IF NOT EXISTS order_tombstones_closed_at ON order_tombstones (closed_at)",
     )
 
-    metadata = getMessageMetadata(
-        order_name=orders[ts]["order_name"],
-        order_creator=orders[ts]["order_creator"],
-        order_info=orders[ts]["order_info"],
-        order_state=orders[ts]["order_state"],
-        order_img=orders[ts]["order_img"],
-        order_details=order_details[ts]
-    )
+    def __init__(self, path):
+        self.db = self.connect(path)
+        self.db_lock = threading.Lock()
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+
+    def getVersion(self, ts):
+        '''資料庫中訂單的版本，沒有這個訂單時返回 None'''
+        with self.db_lock:
+            row = self.db.execute("SELECT version FROM orders WHERE ts = ?", (ts,)).fetchone()
+        return row and row[0]
+
+    def loadState(self, ts):
+        '''返回 (訂單狀態, 版本)，沒有這個訂單時返回 None'''
+        with self.db_lock:
+            row = self.db.execute(
+                "SELECT order_states.state, orders.version FROM order_states JOIN orders USING (ts) WHERE ts = ?",
+                (ts,)
+            ).fetchone()
+        return row and (json.loads(row[0]), row[1])
+
+    def save(self, ts, order, details):
+        '''還沒有這個訂單時以 order, details 建立初始狀態 (新訂單或從 metadata 讀回)，已經有時以資料庫的為準'''
+        state = getOrderStateFromOrder(order, details)
+        self.transaction(lambda: None if self.db.execute("SELECT 1 FROM order_states WHERE ts = ?", (ts,)).fetchone() else self.writeState(ts, state, order.version))
+
+    def merge(self, ts, state):
+        '''將 state 和資料庫中的狀態合併後寫回，返回 (合併後的狀態, 版本)'''
+        def merge():
+            row = self.db.execute(
+                "SELECT order_states.state, orders.version FROM order_states JOIN orders USING (ts) WHERE ts = ?",
+                (ts,)
+            ).fetchone()
+            merged = mergeOrderStates(json.loads(row[0]), state) if row else state
+            version = (row[1] if row else 0) + 1
+            self.writeState(ts, merged, version)
+            return merged, version
+
+        return self.transaction(merge)
+
+    def getMessageFingerprint(self, ts):
+        with self.db_lock:
+            row = self.db.execute("SELECT fingerprint FROM order_message_fingerprints WHERE ts = ?", (ts,)).fetchone()
+        return row and row[0]
+
+    def setMessageFingerprint(self, ts, fingerprint):
+        with self.db_lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO order_message_fingerprints VALUES (?, ?)", (ts, fingerprint))
+
+    def transaction(self, function):
+        with self.db_lock:
+            # 先取得寫入的 lock，讀取和寫入之間不會有其他 replica 寫入
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                result = function()
+                self.db.commit()
+            except BaseException:
+                self.db.rollback()
+                raise
+        return result
+
+    def writeState(self, ts, state, version):
+        '''寫入訂單狀態及展開後的訂單，呼叫時必須在 transaction 中'''
+        order, details = getOrderFromState(state)
+        order.version = version
+        self.writeRows(ts, order.toRecord(), {item: item_detail.toRecord() for item, item_detail in details.items()})
+        self.db.execute(
+            "INSERT OR REPLACE INTO order_states VALUES (?, ?)",
+            (ts, json.dumps(state, ensure_ascii=False, separators=(",", ":")))
+        )
 
-    client.chat_update(
+    def isClosed(self, ts):
+        with self.db_lock:
+            return bool(self.db.execute("SELECT 1 FROM order_tombstones WHERE ts = ?", (ts,)).fetchone())
+
+    def expire(self, before, keep=()):
+        '''刪除所有 replicas 超過 before 沒有修改的訂單
+
+        keep 只包含這個 replica 記憶體中的訂單，其他 replicas 之後修改時會重新建立 (見 refreshOrder)。
+        結案紀錄多保留一個 ORDER_CACHE_TTL，比它早被使用過的 replicas 都已經將訂單移出記憶體
+        '''
+        expired = super().expire(before, keep)
+        with self.db_lock, self.db:
+            self.db.execute("DELETE FROM order_tombstones WHERE closed_at < ?", (before - ORDER_CACHE_TTL,))
+        return expired
+
+    def delete(self, ts):
+        with self.db_lock, self.db:
+            self.deleteRows(ts)
+            self.db.execute("INSERT OR REPLACE INTO order_tombstones VALUES (?, ?)", (ts, time.time()))
+
+    def deleteRows(self, ts):
+        super().deleteRows(ts)
+        self.db.execute("DELETE FROM order_states WHERE ts = ?", (ts,))
+        self.db.execute("DELETE FROM order_message_fingerprints WHERE ts = ?", (ts,))
+
+    def close(self):
+        with self.db_lock:
+            self.db.close()
+
+
+# 訂單狀態中以 last-writer-wins 合併的訂單欄位
+ORDER_STATE_FIELDS = ("order_name", "order_creator", "order_info", "order_state", "order_img")
+
+
+def getOrderStateFromOrder(order, details):
+    '''以目前的訂單建立初始的訂單狀態
+
+    {
+        "channel_id": "C1",
+        # last-writer-wins registers [clock, replica, value]，clock 為 time.time_ns()
+        "fields": {"order_name": [0, "", "lunch"], ...},
+        "items": {
+            "item_name": {
+                "added": [0, "", 0],  # 第一次加入的 [clock, replica, 順序]，決定品項的排列順序
+                "price": [0, "", 50],
+                # 每個使用者的 PN counter {replica: [增加, 減少]}，"s:" 為 Slack 使用者，"u:" 為手動輸入的使用者
+                "users": {"s:U1": {"": [1, 0]}, "u:amy": {"": [2, 0]}}
+            }
+        }
+    }
+    初始狀態以 "" 作為 replica、0 作為 clock，同一個訂單的初始狀態在每個 replica 都相同
+    '''
+    record = order.toRecord()
+    return {
+        "channel_id": order.channel_id,
+        "fields": {key: [0, "", record[key]] for key in ORDER_STATE_FIELDS},
+        "items": {
+            item: {
+                "added": [0, "", index],
+                "price": [0, "", item_detail.price],
+                "users": {user: {"": [amount, 0]} for user, amount in getItemStateAmounts(item_detail).items()}
+            } for index, (item, item_detail) in enumerate(details.items())
+        }
+    }
+
+
+def getItemStateAmounts(item_detail):
+    '''品項每個使用者的數量，以訂單狀態中的 key 表示'''
+    if not item_detail:
+        return {}
+    return {
+        **{f"s:{ user }": amount for user, amount in item_detail.slack_users.items()},
+        **{f"u:{ user }": amount for user, amount in item_detail.users.items()}
+    }
+
+
+def getCounterAmount(counter):
+    '''PN counter 的數量加總，多個 replicas 同時減少時可能小於 0'''
+    return sum(added - removed for added, removed in counter.values())
+
+
+def getOrderFromState(state):
+    '''展開訂單狀態，返回 (Order, {品項: OrderItem})，數量加總不大於 0 的使用者及沒有使用者的品項不會出現'''
+    fields = state["fields"]
+    order = Order(
+        name=fields["order_name"][2],
+        creator=fields["order_creator"][2],
+        info=fields["order_info"][2],
+        state=fields["order_state"][2],
+        img=fields["order_img"][2],
+        channel_id=state["channel_id"]
+    )
+    details = {}
+    for item, item_state in sorted(state["items"].items(), key=lambda entry: entry[1]["added"]):
+        slack_users = {}
+        users = {}
+        for user, counter in sorted(item_state["users"].items()):
+            amount = getCounterAmount(counter)
+            if amount > 0:
+                (slack_users if user.startswith("s:") else users)[user[2:]] = amount
+        if slack_users or users:
+            details[item] = OrderItem(
+                price=item_state["price"][2],
+                amount=sum(slack_users.values()) + sum(users.values()),
+                slack_users=slack_users,
+                users=users
+            )
+    return order, details
+
+
+def recordOrderChanges(state, before, after, replica, clock):
+    '''將訂單修改前後 (getOrderSnapshot) 的差異記錄到 state: 訂單欄位及金額寫入 register，數量的差異加到這個 replica 的 counter
+
+    數量的差異以 counter 實際的加總計算，不是展開後的數量 (小於 0 時顯示為 0)，
+    修改後 counter 的加總一定是修改後的數量，不會被之前同時減少的修改抵銷
+    '''
+    before_order, before_details = before
+    after_order, after_details = after
+    for key in ORDER_STATE_FIELDS:
+        if before_order[key] != after_order[key]:
+            state["fields"][key] = [clock, replica, after_order[key]]
+
+    for item in before_details.keys() | after_details.keys():
+        before_item = before_details.get(item)
+        after_item = after_details.get(item)
+        # OrderItem 修改時會被取代，相同的物件表示沒有修改
+        if before_item is after_item:
+            continue
+        item_state = state["items"].setdefault(item, {"added": [clock, replica, 0], "price": None, "users": {}})
+        if after_item and (not before_item or before_item.price != after_item.price):
+            item_state["price"] = [clock, replica, after_item.price]
+        before_amounts = getItemStateAmounts(before_item)
+        after_amounts = getItemStateAmounts(after_item)
+        for user in before_amounts.keys() | after_amounts.keys():
+            if after_amounts.get(user, 0) == before_amounts.get(user, 0):
+                continue
+            counters = item_state["users"].setdefault(user, {})
+            delta = after_amounts.get(user, 0) - getCounterAmount(counters)
+            if delta:
+                counter = counters.setdefault(replica, [0, 0])
+                counter[0 if delta > 0 else 1] += abs(delta)
+    return state
+
+
+def mergeRegisters(a, b):
+    '''last-writer-wins register [clock, replica, value]，(clock, replica) 較大的優先'''
+    if a is None or b is None:
+        return a if b is None else b
+    return max(a, b)
+
+
+def mergeCounters(a, b):
+    '''PN counter {replica: [增加, 減少]}，每個 replica 各自取較大的值'''
+    return {
+        replica: [max(a.get(replica, (0, 0))[0], b.get(replica, (0, 0))[0]), max(a.get(replica, (0, 0))[1], b.get(replica, (0, 0))[1])]
+        for replica in a.keys() | b.keys()
+    }
+
+
+def mergeOrderStates(a, b):
+    '''合併兩個訂單狀態，返回新的狀態，結果和合併的順序及次數無關 (commutative, associative, idempotent)'''
+    empty_item = {"added": None, "price": None, "users": {}}
+    items = {}
+    for item in a["items"].keys() | b["items"].keys():
+        a_item = a["items"].get(item, empty_item)
+        b_item = b["items"].get(item, empty_item)
+        items[item] = {
+            # 保留第一次加入的時間
+            "added": min(a_item["added"] or b_item["added"], b_item["added"] or a_item["added"]),
+            "price": mergeRegisters(a_item["price"], b_item["price"]),
+            "users": {
+                user: mergeCounters(a_item["users"].get(user, {}), b_item["users"].get(user, {}))
+                for user in a_item["users"].keys() | b_item["users"].keys()
+            }
+        }
+    return {
+        "channel_id": a["channel_id"] or b["channel_id"],
+        "fields": {key: mergeRegisters(a["fields"].get(key), b["fields"].get(key)) for key in a["fields"].keys() | b["fields"].keys()},
+        "items": items
+    }
+
+
+def getOrderStore():
+    '''依 ORDER_STORE 建立訂單儲存: memory (預設)、sqlite 或 shared'''
+    if ORDER_STORE == "sqlite":
+        return SQLiteOrderStore(ORDER_STORE_PATH, flush_interval=ORDER_STORE_FLUSH_MS / 1000)
+    if ORDER_STORE == "shared":
+        return SharedSQLiteOrderStore(ORDER_STORE_PATH)
+    return MemoryOrderStore()
+
+
+def loadOrder(ts):
+    '''orders 沒有這個訂單時從 order_store 讀取，返回是否有這個訂單'''
+    global orders, order_details
+    if orders.get(ts):
+        touchOrder(ts)
+        return True
+    with getOrderLock(ts):
+        if orders.get(ts):
+            touchOrder(ts)
+            return True
+        stored = order_store.load(ts)
+        if not stored:
+            return False
+        orders[ts], order_details[ts] = stored
+        resetOrderTotals(ts)
+        # 被移出記憶體時 journal 記錄了 evicted
+        journalOrderCreated(ts)
+        touchOrder(ts)
+        metrics.inc("slack_order_order_rehydrations_total", source="store")
+        return True
+
+
+def saveOrder(ts):
+    '''訂單有修改後呼叫，版本加一並將 orders[ts], order_details[ts] 交給 order_store 保存'''
+    global orders, order_details
+    with getOrderLock(ts):
+        orders[ts].version += 1
+        order_store.save(ts, orders[ts], order_details.get(ts, {}))
+
+
+def refreshOrder(ts):
+    '''共享的 order_store: 其他 replica 寫入較新的版本時重新讀取，訂單已結案時從記憶體移除
+
+    訂單超過 ORDER_CACHE_TTL 沒有修改而被 expireStoredOrders 刪除時重新建立 (見 reseedOrder)
+    返回是否有這個訂單，不是共享的 order_store 時只確認 orders 中是否有這個訂單
+    '''
+    global orders, order_details, order_message_caches, order_states
+    with getOrderLock(ts):
+        if not order_store.shared:
+            return ts in orders
+        version = order_store.getVersion(ts)
+        if version is None and ts in orders and not order_store.isClosed(ts):
+            if not reseedOrder(ts):
+                return False
+            version = order_store.getVersion(ts)
+        if version is None:
+            orders.pop(ts, None)
+            order_details.pop(ts, None)
+            order_message_caches.pop(ts, None)
+            order_states.pop(ts, None)
+            return False
+        if ts not in orders or orders[ts].version != version or ts not in order_states:
+            loaded = order_store.loadState(ts)
+            if not loaded:
+                return False
+            setOrderFromState(ts, *loaded)
+        return True
+
+
+def reseedOrder(ts):
+    '''記憶體中的訂單已從共享的 order_store 刪除 (沒有結案)，重新寫入 order_store，返回是否有這個訂單
+
+    優先從 order message 的 metadata 讀回 (包含其他 replicas 最後的修改)，讀取失敗時以記憶體中的訂單建立
+    呼叫時必須持有 getOrderLock(ts)
+    '''
+    global orders, order_details, order_message_caches, order_states
+    order, details = orders.pop(ts), order_details.pop(ts, {})
+    order_message_caches.pop(ts, None)
+    order_states.pop(ts, None)
+    try:
+        return reloadOrder(order.channel_id, ts, source="expired")
+    except Exception:
+        logger.exception(f"reload expired order failed: { ts }")
+    orders[ts], order_details[ts] = order, details
+    order_store.save(ts, order, details)
+    metrics.inc("slack_order_order_rehydrations_total", source="memory")
+    return True
+
+
+def setOrderFromState(ts, state, version):
+    '''以共享的 order_store 的訂單狀態取代記憶體中的訂單'''
+    global orders, order_details, order_states
+    orders[ts], order_details[ts] = getOrderFromState(state)
+    orders[ts].version = version
+    order_states[ts] = state
+    resetOrderTotals(ts)
+
+
+def getOrderSnapshot(ts):
+    '''訂單目前的欄位及品項，OrderItem 修改時會被取代，所以只需要複製 dict'''
+    global orders, order_details
+    return orders[ts].toRecord(), dict(order_details.get(ts, {}))
+
+
+def updateOrder(ts, update):
+    '''在 getOrderLock(ts) 中以 update() 修改訂單並保存，返回 update() 的結果，沒有這個訂單時返回 None
+
+    共享的 order_store 先讀取最新的狀態，將 update() 前後的差異記錄成這個 replica 的修改 (見 recordOrderChanges)，
+    再和 order_store 的狀態合併，同時修改的 replicas 不會互相覆蓋
+    '''
+    global order_states
+    with getOrderLock(ts):
+        if not refreshOrder(ts):
+            return None
+        if not order_store.shared:
+            result = update()
+            saveOrder(ts)
+            return result
+        before = getOrderSnapshot(ts)
+        result = update()
+        recordOrderChanges(order_states[ts], before, getOrderSnapshot(ts), REPLICA_ID, time.time_ns())
+        setOrderFromState(ts, *order_store.merge(ts, order_states[ts]))
+        return result
+
+
+def deleteOrder(ts):
+    '''從 orders, order_details 及 order_store 移除訂單'''
+    global orders, order_details, order_message_caches
+    with getOrderLock(ts):
+        orders.pop(ts, {})
+        order_details.pop(ts, {})
+        order_message_caches.pop(ts, {})
+        order_states.pop(ts, None)
+        order_store.delete(ts)
+    with order_access_lock:
+        order_access_times.pop(ts, None)
+
+
+def touchOrder(ts, accessed=None):
+    '''記錄訂單最後一次被使用的時間 (預設為現在)，超過 ORDER_CACHE_MAX_ORDERS 時移出最久沒有使用的訂單'''
+    global order_access_times
+    with order_access_lock:
+        order_access_times[ts] = time.monotonic() if accessed is None else accessed
+        order_access_times.move_to_end(ts)
+        over_capacity = ORDER_CACHE_MAX_ORDERS and len(order_access_times) > ORDER_CACHE_MAX_ORDERS
+    if over_capacity:
+        evictOrders()
+
+
+def evictOrders():
+    '''將閒置超過 ORDER_CACHE_TTL 或超過 ORDER_CACHE_MAX_ORDERS 的訂單移出記憶體 (不會從 order_store 刪除)
+
+    被移出的訂單在下次操作時由 ifMessageIsNoneReloadMetadata 或 reloadOrder 讀回
+    '''
+    global orders, order_details, order_message_caches, order_access_times
+    now = time.monotonic()
+    with order_access_lock:
+        candidates = []
+        excess = len(order_access_times) - ORDER_CACHE_MAX_ORDERS if ORDER_CACHE_MAX_ORDERS else 0
+        for ts, accessed in order_access_times.items():
+            if len(candidates) < excess:
+                candidates.append((ts, "size"))
+            elif ORDER_CACHE_TTL and now - accessed > ORDER_CACHE_TTL:
+                candidates.append((ts, "ttl"))
+            else:
+                break
+
+    for ts, reason in candidates:
+        # 還有等待中的 chat_update 或正在被使用的訂單之後再處理
+        with pending_order_updates_lock:
+            if ts in pending_order_updates:
+                continue
+        order_lock = getOrderLock(ts)
+        if not order_lock.acquire(blocking=False):
+            continue
+        try:
+            with order_access_lock:
+                if order_access_times.get(ts, now) > now:
+                    continue
+                order_access_times.pop(ts, None)
+            # 重新啟動時不再從 journal 讀回
+            journalOrderEvent("evicted", ts)
+            orders.pop(ts, None)
+            order_details.pop(ts, None)
+            order_message_caches.pop(ts, None)
+            order_states.pop(ts, None)
+        finally:
+            order_lock.release()
+        metrics.inc("slack_order_order_evictions_total", reason=reason)
+
+
+def expireStoredOrders():
+    '''從 order_store 刪除超過 ORDER_CACHE_TTL 沒有修改且已被移出記憶體的訂單 (沒有結案就不再使用的訂單)
+
+    之後再操作這些訂單時從 order message 的 metadata 讀回，共享的 order_store 以所有 replicas 最後一次的修改時間判斷
+    '''
+    global orders
+    expired = order_store.expire(time.time() - ORDER_CACHE_TTL, keep=list(orders))
+    if expired:
+        metrics.inc("slack_order_order_store_expired_total", expired)
+        logger.info(f"expired { expired } idle orders from order store")
+
+
+def runOrderEviction():
+    while True:
+        time.sleep(ORDER_CACHE_SWEEP_INTERVAL)
+        try:
+            evictOrders()
+            expireStoredOrders()
+        except Exception:
+            logger.exception("order eviction failed")
+
+
+def startOrderEviction():
+    '''在背景 thread 定期移出閒置的訂單'''
+    if ORDER_CACHE_TTL:
+        threading.Thread(target=runOrderEviction, name="order-eviction", daemon=True).start()
+
+
+# 訂單最後一次被使用的時間 (time.monotonic)，依使用時間排序
+order_access_times = collections.OrderedDict()
+order_access_lock = threading.Lock()
+# (user_id, ts, reason) : 送出權限提示的時間 (time.monotonic)，依送出時間排序，見 shouldSendNotice
+notice_times = collections.OrderedDict()
+notice_times_lock = threading.Lock()
+
+
+order_store = getOrderStore()
+atexit.register(order_store.close)
+
+
+class MenuCatalog:
+    '''每個頻道的菜單 {品項: 金額}
+
+    搜尋用的 index 是依 casefold 名稱排序的 [(casefold 名稱, 品項), ...]，前綴搜尋以 bisect 找到起點，
+    結果不足時再以子字串比對補足
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # "channel_id" : {"品項": 金額}
+        self.prices = {}
+        # "channel_id" : [(casefold 名稱, 品項), ...]
+        self.indexes = {}
+        # 從結案訂單學到的品項，見 learnOrder
+        self.learned = {}
+
+    def add(self, channel_id, item, price, learned=False):
+        with self.lock:
+            prices = self.prices.setdefault(channel_id, {})
+            if item not in prices:
+                bisect.insort(self.indexes.setdefault(channel_id, []), (item.casefold(), item))
+            prices[item] = price
+            if learned:
+                self.learned.setdefault(channel_id, {})[item] = price
+
+    def getPrice(self, channel_id, item):
+        '''頻道的菜單優先，其次是所有頻道共用的菜單，沒有時返回 None'''
+        with self.lock:
+            for channel in (channel_id, MENU_CATALOG_ALL_CHANNELS):
+                price = self.prices.get(channel, {}).get(item)
+                if price is not None:
+                    return price
+        return None
+
+    def search(self, channel_id, query, limit):
+        '''返回最多 limit 個 [(品項, 金額), ...]，前綴相符的在前'''
+        query = query.strip().casefold()
+        results = {}
+        with self.lock:
+            channels = [(self.indexes.get(channel, []), self.prices.get(channel, {})) for channel in (channel_id, MENU_CATALOG_ALL_CHANNELS)]
+            for index, prices in channels:
+                position = bisect.bisect_left(index, (query,))
+                while position < len(index) and len(results) < limit and index[position][0].startswith(query):
+                    item = index[position][1]
+                    results.setdefault(item, prices[item])
+                    position += 1
+            for index, prices in channels:
+                for key, item in index:
+                    if len(results) >= limit:
+                        break
+                    if query in key:
+                        results.setdefault(item, prices[item])
+        return list(results.items())
+
+    def getLearned(self):
+        with self.lock:
+            return {channel: dict(items) for channel, items in self.learned.items()}
+
+
+def loadMenuCatalog():
+    '''啟動時讀取 MENU_CATALOG_PATH 及 MENU_CATALOG_LEARNED_PATH 的菜單'''
+    started = time.monotonic()
+    if MENU_CATALOG_LEARNED_PATH and os.path.exists(MENU_CATALOG_LEARNED_PATH):
+        with open(MENU_CATALOG_LEARNED_PATH, encoding="utf-8") as f:
+            for channel_id, items in json.load(f).items():
+                for item, price in items.items():
+                    menu_catalog.add(channel_id, item, int(price), learned=True)
+    # 匯入的菜單金額優先
+    if MENU_CATALOG_PATH:
+        for channel_id, item, price in readMenuCatalogFile(MENU_CATALOG_PATH):
+            menu_catalog.add(channel_id or MENU_CATALOG_ALL_CHANNELS, item, price)
+    items = sum(len(prices) for prices in menu_catalog.prices.values())
+    if items:
+        logger.info(f"loaded { items } menu items in { time.monotonic() - started:.3f} s")
+
+
+def readMenuCatalogFile(path):
+    '''讀取 CSV (channel_id,item,price) 或 JSON ({"channel_id": {"品項": 金額}})，產生 (channel_id, 品項, 金額)'''
+    with open(path, encoding="utf-8", newline="") as f:
+        if path.endswith(".json"):
+            for channel_id, items in json.load(f).items():
+                for item, price in items.items():
+                    yield channel_id, item, int(price)
+            return
+        for row in csv.DictReader(f):
+            item = (row.get("item") or "").strip()
+            if not item or not isPositiveNumber(row.get("price") or ""):
+                logger.warning(f"skip menu row: { row }")
+                continue
+            yield (row.get("channel_id") or "").strip(), item, int(float(row["price"]))
+
+
+def learnOrderMenu(channel_id, details):
+    '''結案時將訂單的品項及金額加入頻道的菜單，有設定 MENU_CATALOG_LEARNED_PATH 時寫入檔案'''
+    if not channel_id:
+        return
+    for item, item_detail in details.items():
+        menu_catalog.add(channel_id, item, item_detail.price, learned=True)
+    if MENU_CATALOG_LEARNED_PATH:
+        try:
+            with open(MENU_CATALOG_LEARNED_PATH + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(menu_catalog.getLearned(), f, ensure_ascii=False)
+            os.replace(MENU_CATALOG_LEARNED_PATH + ".tmp", MENU_CATALOG_LEARNED_PATH)
+        except OSError:
+            logger.exception(f"save learned menu failed: { MENU_CATALOG_LEARNED_PATH }")
+
+
+def getMenuOption(item, price=None):
+    '''品項下拉選單的 option，value 為品項名稱'''
+    text = f"{ item } ${ price }" if price is not None else item
+    if len(text) > MAX_OPTION_TEXT_LENGTH:
+        text = text[:MAX_OPTION_TEXT_LENGTH - 1] + "…"
+    return {"text": {"type": "plain_text", "text": text}, "value": item}
+
+
+def getMenuOptions(channel_id, query):
+    '''品項 external_select 的 options: 菜單中相符的品項，輸入的文字不在菜單時放在第一個作為新品項'''
+    query = query.strip()[:MAX_OPTION_VALUE_LENGTH]
+    matches = menu_catalog.search(channel_id, query, limit=MAX_SELECT_OPTIONS)
+    options = [getMenuOption(item, price) for item, price in matches if len(item) <= MAX_OPTION_VALUE_LENGTH]
+    if query and all(item != query for item, _ in matches):
+        options = [getMenuOption(query)] + options[:MAX_SELECT_OPTIONS - 1]
+    return options
+
+
+menu_catalog = MenuCatalog()
+
+
+def getNewOrderFromView(view, body):
+    '''從 OpenNewOrderModal 送出的資料產生新訂單資訊'''
+    global imgs
+    order_img = getValueFromViewState(view=view, block_id="order_img", action_id="order_img_input")
+    return {
+        "order_name": getValueFromViewState(view=view, block_id="order_name", action_id="order_name_input"),
+        "order_creator": getUserIdFromMessageBody(body=body),
+        "order_info": getValueFromViewState(view=view, block_id="order_info", action_id="order_info_input"),
+        "order_img": order_img if order_img else secrets.choice(imgs),
+        "order_state": ORDER_STATE[0]
+    }
+
+
+def getNewOrderMessage(order):
+    '''新訂單 message 的 blocks 和 metadata'''
+    # 將資訊存到 Message metadata > event_payload
+    metadata = getMessageMetadata(order_details={}, **order)
+    blocks = getOrderMessageBlocksWithItems(**order)
+    return blocks, metadata
+
+
+def createOrder(channel_id, ts, order):
+    '''新增訂單資訊到全域變數'''
+    global orders, order_details
+    with getOrderLock(ts):
+        orders[ts] = Order.fromRecord(dict(order, channel_id=channel_id))
+        order_details[ts] = {}
+        saveOrder(ts)
+        journalOrderCreated(ts)
+    touchOrder(ts)
+
+
+def getAddItemSubmission(view):
+    '''讀取品項設定 modal 送出的資料，返回 (errors, submission)'''
+    errors = {}
+    submission = {
+        "channel_id": getChannelIdFromViewPrivateMetadata(view),
+        "ts": getMessageTsFromViewPrivateMetadata(view),
+        "item": getSelectedValueFromViewState(view=view, block_id="item_name", action_id="item_name_input"),
+        "price": getValueFromViewState(view=view, block_id="item_price", action_id="item_price_input") if view['state']['values'].get("item_price", {}) else view["private_metadata"].split(',')[2],
+        "amount": getValueFromViewState(view=view, block_id="item_amount", action_id="item_amount_input"),
+        "slack_users": getSelectedUsersFromViewState(view=view, block_id="item_slack_users", action_id="item_slack_users_input"),
+        "users": getValueFromViewState(view=view, block_id="item_users", action_id="item_users_input")
+    }
+
+    if not submission["item"]:
+        errors["item_name"] = "必須選擇或輸入一個品項"
+    elif not submission["price"]:
+        # 使用菜單的金額
+        submission["price"] = menu_catalog.getPrice(submission["channel_id"], submission["item"])
+        if submission["price"] is None:
+            errors["item_price"] = "菜單沒有這個品項，請輸入金額"
+    if submission["price"] is not None and not isPositiveNumber(submission["price"]):
+        errors["item_price"] = "金額必須是的數字, 且大於0"
+    if not isNaturalNumber(submission["amount"]):
+        errors["item_amount"] = "數量必須是數字, 且大於等於0"
+
+    if not submission["slack_users"] and not submission["users"]:
+        errors["item_slack_users"] = "必須有一個使用者"
+        errors["item_users"] = "必須有一個使用者"
+
+    return errors, submission
+
+
+def applyAddItemSubmission(submission):
+    '''將品項設定寫入訂單，並排程更新 order message'''
+    global orders, order_details
+    message_ts = submission["ts"]
+    item = submission["item"]
+    # 驗證時允許 "2.0" 這類整數值
+    amount = int(float(submission["amount"]))
+
+    if not reloadOrder(submission["channel_id"], message_ts):
+        return
+
+    def update():
+        setOrderItem(message_ts, item, getMergedOrderItem(
+            order_details.get(message_ts, {}).get(item),
+            price=int(float(submission["price"])),
+            amount=amount,
+            slack_users=submission["slack_users"],
+            users=submission["users"].split(',') if submission["users"] else []
+        ))
+        journalOrderEvent("item_set", message_ts, item=item, detail=getJournalItemDetail(order_details[message_ts].get(item)))
+
+    updateOrder(message_ts, update)
+    scheduleOrderMessageUpdate(submission["channel_id"], message_ts)
+
+
+def getMergedOrderItem(current_item, price, amount, slack_users, users):
+    '''將使用者的數量設定到目前的品項 (數量 0 時移除這些使用者)，返回新的 OrderItem，沒有使用者時返回 None'''
+    # 目前這個品項的使用者
+    current_item_slack_users = dict(current_item.slack_users) if current_item else {}
+    current_item_users = dict(current_item.users) if current_item else {}
+
+    for slack_user in slack_users:
+        if amount == 0:
+            current_item_slack_users.pop(slack_user, None)
+        else:
+            current_item_slack_users[slack_user] = amount
+
+    for user in users:
+        if amount == 0:
+            current_item_users.pop(user, None)
+        else:
+            current_item_users[user] = amount
+
+    # 計算總數
+    current_amount = sum(current_item_slack_users.values()) + sum(current_item_users.values())
+    if current_amount == 0:
+        return None
+    return OrderItem(
+        price=price,
+        amount=current_amount,
+        slack_users=current_item_slack_users,
+        users=current_item_users
+    )
+
+
+def applyModifyOrderMessageSubmission(view):
+    '''將修改訂單資訊 modal 送出的資料寫入訂單，返回 (channel_id, ts, 原本的訂單建立者, 新的訂單建立者)'''
+    global orders, imgs
+    channel_id = getChannelIdFromViewPrivateMetadata(view)
+    ts = getMessageTsFromViewPrivateMetadata(view)
+    new_order_creator = getSelectedUserFromViewState(view=view, block_id="order_creator", action_id="order_creator_select")
+
+    if not reloadOrder(channel_id, ts):
+        return channel_id, ts, None, None
+
+    def update():
+        order = orders[ts]
+        old_order_creator = order.creator
+        order.creator = new_order_creator
+        order.name = getValueFromViewState(view=view, block_id="order_name", action_id="order_name_input")
+        order.info = getValueFromViewState(view=view, block_id="order_info", action_id="order_info_input")
+        order.img = getValueFromViewState(view=view, block_id="order_img", action_id="order_img_input")
+        order.img = order.img if order.img else secrets.choice(imgs)
+        order.state = getSelectedFromViewState(view=view, block_id="order_state", action_id="order_state_selected")
+        journalOrderEvent("order_updated", ts, order={key: value for key, value in order.toRecord().items() if key in ("order_name", "order_info", "order_img", "order_state")})
+        if old_order_creator != new_order_creator:
+            journalOrderEvent("creator_transferred", ts, creator=new_order_creator)
+        return old_order_creator
+
+    old_order_creator = updateOrder(ts, update)
+    if old_order_creator is None:
+        return channel_id, ts, None, None
+    scheduleOrderMessageUpdate(channel_id, ts)
+    return channel_id, ts, old_order_creator, new_order_creator
+
+
+def getCreatorTransferredText(old_order_creator, new_order_creator):
+    return f"訂單建立者<@{ old_order_creator }>，已將權限轉給<@{ new_order_creator }>"
+
+
+def getModifyItemPriceSubmission(view):
+    '''讀取修改品項金額 modal 送出的資料，返回 (errors, submission)'''
+    errors = {}
+    submission = {
+        "channel_id": getChannelIdFromViewPrivateMetadata(view),
+        "ts": getMessageTsFromViewPrivateMetadata(view),
+        "item": getSelectedFromViewState(view=view, block_id="modify_item_name", action_id="modify_item_name_select"),
+        "price": getValueFromViewState(view=view, block_id="modify_item_price", action_id="modify_item_price_input")
+    }
+
+    if not isPositiveNumber(submission["price"]):
+        errors["modify_item_price"] = "金額必須是的數字, 且大於0"
+
+    return errors, submission
+
+
+def applyModifyItemPriceSubmission(submission):
+    '''將品項金額寫入訂單，並排程更新 order message'''
+    global order_details
+    ts = submission["ts"]
+    if not reloadOrder(submission["channel_id"], ts):
+        return
+
+    def update():
+        # 品項可能已被其他人移除
+        if submission["item"] in order_details.get(ts, {}):
+            setOrderItemPrice(ts, submission["item"], int(float(submission["price"])))
+            journalOrderEvent("price_changed", ts, item=submission["item"], price=order_details[ts][submission["item"]].price)
+
+    updateOrder(ts, update)
+    scheduleOrderMessageUpdate(submission["channel_id"], ts)
+
+
+def getBulkItemLine(line, channel_id):
+    '''解析批次新增的一行 "品項, 金額, 數量, 使用者1, 使用者2"，返回 (錯誤訊息, 品項設定)
+
+    金額空白時使用菜單的金額
+    '''
+    fields = [field.strip() for field in line.split(',', 3)]
+    if len(fields) < 4:
+        return "格式必須是 品項, 金額, 數量, 使用者", None
+    item, price, amount, users = fields
+    if not item:
+        return "品項不能是空的", None
+    # 品項名稱是下拉選單 option 的 value (新增品項 modal 及品項太多時的選單)
+    if len(item) > MAX_OPTION_VALUE_LENGTH:
+        return f"品項名稱不能超過 { MAX_OPTION_VALUE_LENGTH } 個字", None
+    if not price:
+        price = menu_catalog.getPrice(channel_id, item)
+        if price is None:
+            return "菜單沒有這個品項，請輸入金額", None
+    if not isPositiveNumber(price):
+        return "金額必須是的數字, 且大於0", None
+    if not isNaturalNumber(amount):
+        return "數量必須是數字, 且大於等於0", None
+
+    slack_users = []
+    other_users = []
+    for user in users.split(','):
+        user = user.strip()
+        match = SLACK_USER_MENTION.fullmatch(user)
+        if match:
+            slack_users.append(match.group(1))
+        elif user:
+            other_users.append(user)
+    if not slack_users and not other_users:
+        return "必須有一個使用者", None
+
+    return None, {
+        "item": item,
+        "price": int(float(price)),
+        "amount": int(float(amount)),
+        "slack_users": slack_users,
+        "users": other_users
+    }
+
+
+def getBulkAddItemsSubmission(view):
+    '''讀取批次新增品項 modal 送出的資料並一次驗證所有行，返回 (errors, submission)'''
+    errors = []
+    items = []
+    channel_id = getChannelIdFromViewPrivateMetadata(view)
+    text = getValueFromViewState(view=view, block_id="bulk_items", action_id="bulk_items_input") or ""
+    for number, line in enumerate(text.splitlines(), start=1):
+        if not line.strip():
+            continue
+        error, item = getBulkItemLine(line, channel_id)
+        if error:
+            errors.append(f"第 { number } 行: { error }")
+        else:
+            items.append(item)
+
+    submission = {
+        "channel_id": channel_id,
+        "ts": getMessageTsFromViewPrivateMetadata(view),
+        "items": items
+    }
+    if not errors and not items:
+        errors.append("至少要有一個品項")
+    if len(errors) > MAX_BULK_ITEM_ERRORS:
+        errors = errors[:MAX_BULK_ITEM_ERRORS] + [f"...共 { len(errors) } 行錯誤"]
+    return {"bulk_items": '\n'.join(errors)} if errors else {}, submission
+
+
+def applyBulkAddItemsSubmission(submission):
+    '''將批次新增的所有品項一次寫入訂單，只排程一次 order message 更新'''
+    global order_details
+    ts = submission["ts"]
+    if not reloadOrder(submission["channel_id"], ts):
+        return
+
+    def update():
+        details = {}
+        for line in submission["items"]:
+            item = line["item"]
+            setOrderItem(ts, item, getMergedOrderItem(
+                order_details.get(ts, {}).get(item),
+                price=line["price"],
+                amount=line["amount"],
+                slack_users=line["slack_users"],
+                users=line["users"]
+            ))
+            details[item] = getJournalItemDetail(order_details[ts].get(item))
+        journalOrderEvent("items_set", ts, details=details)
+
+    updateOrder(ts, update)
+    scheduleOrderMessageUpdate(submission["channel_id"], ts)
+
+
+def getBulkAddItemsModal(body):
+    '''批次新增品項 modal'''
+    return BULK_ADD_ITEMS_MODAL_TEMPLATE.patch(private_metadata=getPrivateMetadataFormatString(body=body))
+
+
+def buildBulkAddItemsModal(private_metadata):
+    '''批次新增品項 modal，只在建立 BULK_ADD_ITEMS_MODAL_TEMPLATE 時使用'''
+    return {
+        "type": "modal",
+        "callback_id": "bulk_add_items_modal",
+        "title": {"type": "plain_text", "text": "批次新增品項"},
+        "submit": {"type": "plain_text", "text": "送出"},
+        "private_metadata": private_metadata,
+        "blocks": [
+            {
+                "type": "input",
+                "block_id": "bulk_items",
+                "element": {
+                    "type": "plain_text_input",
+                    "action_id": "bulk_items_input",
+                    "multiline": True,
+                    "placeholder": {
+                        "type": "plain_text",
+                        "text": "雞腿飯, 100, 1, <@U123>, 小明"
+                    }
+                },
+                "label": {
+                    "type": "plain_text",
+                    "text": "每行一個品項:"
+                },
+                "hint": {
+                    "type": "plain_text",
+                    "text": "格式: 品項, 金額, 數量, 使用者 (多個使用者以逗號分隔，Slack 使用者寫成 <@使用者ID>)，金額空白時使用菜單的金額，數量 0 會移除這些使用者"
+                }
+            }
+        ]
+    }
+
+
+def getNewItemModal(body):
+    '''新增 按鈕開啟的品項設定 modal'''
+    return NEW_ITEM_MODAL_TEMPLATE.patch(
+        private_metadata=getPrivateMetadataFormatString(body=body),
+        item_slack_users=[body["user"]["id"]]
+    )
+
+
+def getChooseItemModal(body, ts, item):
+    '''品項 Choose 按鈕開啟的品項設定 modal'''
+    global order_details
+    item_detail = order_details[ts][item]
+    return CHOOSE_ITEM_MODAL_TEMPLATE.patch(
+        private_metadata=getPrivateMetadataFormatString(body=body) + f",{ item_detail.price }",
+        item_price=getItemPriceMrkdwn(item_detail.price),
+        item_name=getMenuOption(item),
+        item_slack_users=[body["user"]["id"]],
+        current_item_users=f"目前的使用者: { ','.join(item_detail.users) }"
+    )
+
+
+def getSelectedItemFromAction(action):
+    '''品項 Choose 按鈕或品項下拉選單選擇的品項'''
+    return action["selected_option"]["value"] if action.get("selected_option") else action['value']
+
+
+def getModifyOrderMessageModal(body, ts):
+    '''修改訂單資訊 modal'''
+    global orders, imgs
+    order = orders[ts]
+    return MODIFY_ORDER_MESSAGE_MODAL_TEMPLATE.patch(
+        private_metadata=getPrivateMetadataFormatString(body=body),
+        order_creator=order.creator,
+        order_name=order.name,
+        order_info=order.info,
+        order_state=ORDER_STATE_OPTIONS[ORDER_STATE.index(order.state)],
+        order_img=order.img if order.img else secrets.choice(imgs)
+    )
+
+
+def buildModifyOrderMessageModal(private_metadata, order):
+    '''修改訂單資訊 modal，只在建立 MODIFY_ORDER_MESSAGE_MODAL_TEMPLATE 時使用'''
+    order_img = order.img
+    order_state = order.state
+    return {
+        "type": "modal",
+        "callback_id": "modify_order_message_modal",
+        "title": {"type": "plain_text", "text": "修改訂單資訊"},
+        "submit": {"type": "plain_text", "text": "修改"},
+        "private_metadata": private_metadata,
+        "blocks": [
+            {
+                "block_id": "order_creator",
+                "type": "section",
+                "text": {
+                    "type": "mrkdwn",
+                    "text": "訂單建立者:"
+                },
+                "accessory": {
+                    "type": "users_select",
+                    "placeholder": {
+                        "type": "plain_text",
+                        "text": "Select a user"
+                    },
+                    "action_id": "order_creator_select",
+                    "initial_user": order.creator
+                }
+            },
+            {
+                "block_id": "order_name",
+                "type": "input",
+                "element": {
+                    "type": "plain_text_input",
+                    "action_id": "order_name_input",
+                    "initial_value": order.name
+                },
+                "label": {"type": "plain_text", "text": "訂單名稱:"}
+            },
+            {
+                "block_id": "order_info",
+                "type": "input",
+                "element": {
+                    "type": "plain_text_input",
+                    "action_id": "order_info_input",
+                    "multiline": True,
+                    "initial_value": order.info
+                },
+                "label": {"type": "plain_text", "text": "請寫下訂單資訊:"},
+            },
+            {
+                "block_id": "order_state",
+                "label": {"type": "plain_text", "text": "訂單狀態:"},
+                "type": "input",
+                "element": {
+                    "type": "static_select",
+                    "action_id": "order_state_selected",
+                    "initial_option": {
+                        "value": str(ORDER_STATE.index(order_state)),
+                        "text": {
+                            "type": "plain_text",
+                            "text": order_state
+                        }
+                    },
+                    "options": [
+                        {
+                            "text": {
+                                "type": "plain_text",
+                                "text": ORDER_STATE[0]
+                            },
+                            "value": "0"
+                        },
+                        {
+                            "text": {
+                                "type": "plain_text",
+                                "text": ORDER_STATE[1]
+                            },
+                            "value": "1"
+                        }
+                    ]
+                }
+            },
+            {
+                "block_id": "order_img",
+                "type": "input",
+                "element": {
+                    "type": "plain_text_input",
+                    "action_id": "order_img_input",
+                    "initial_value": order_img
+                },
+                "label": {"type": "plain_text", "text": "小圖片連結:"},
+                "optional": True
+            },
+        ]
+    }
+
+
+def getModifyItemPriceModal(body, ts):
+    '''修改品項金額 modal，沒有品項時返回 None'''
+    global order_details
+    options = []
+    # 確認是否有存在品項資料
+    if not order_details.get(ts):
+        return None
+    # 產生所有品項的 dictionaries
+    for item in order_details[ts]:
+        options.append({
+            "value": item,
+            "text": {
+                "type": "plain_text",
+                "text": item
+            }
+        })
+    options.sort(key=lambda item: item['value'], reverse=True)
+    private_metadata = getPrivateMetadataFormatString(body=body)
+    if len(options) <= MAX_SELECT_OPTIONS:
+        return MODIFY_ITEM_PRICE_MODAL_TEMPLATE.patch(private_metadata=private_metadata, options=options)
+    # static_select 最多 100 個 options，超過時分組
+    return MODIFY_ITEM_PRICE_MODAL_TEMPLATE.patch(private_metadata=private_metadata, option_groups=[
+        {
+            "label": {"type": "plain_text", "text": f"{ start + 1 }-{ start + len(options[start:start + MAX_SELECT_OPTIONS]) }"},
+            "options": options[start:start + MAX_SELECT_OPTIONS]
+        } for start in range(0, len(options), MAX_SELECT_OPTIONS)
+    ])
+
+
+def buildModifyItemPriceModal(private_metadata, select_options):
+    '''修改品項金額 modal，只在建立 MODIFY_ITEM_PRICE_MODAL_TEMPLATE 時使用'''
+    return {
+        "type": "modal",
+        "callback_id": "modify_item_price_modal",
+        "title": {"type": "plain_text", "text": "修改品項金額"},
+        "submit": {"type": "plain_text", "text": "修改"},
+        "private_metadata": private_metadata,
+        "blocks": [
+            {
+                "type": "input",
+                "block_id": "modify_item_name",
+                "element": {
+                    "type": "static_select",
+                    "placeholder": {
+                        "type": "plain_text",
+                        "text": "品項"
+                    },
+                    **select_options,
+                    "action_id": "modify_item_name_select",
+                },
+                "label": {
+                    "type": "plain_text",
+                    "text": "請選擇一個品項:"
+                }
+            },
+            {
+                "type": "input",
+                "block_id": "modify_item_price",
+                "element": {
+                    "type": "plain_text_input",
+                    "action_id": "modify_item_price_input"
+                },
+                "label": {
+                    "type": "plain_text",
+                    "text": "品項金額:"
+                }
+            }
+        ]
+    }
+
+
+class ModalTemplate:
+    '''在 import 時建立一次的 modal view，每個 request 以 patch() 產生只替換動態欄位的副本
+
+    只複製欄位路徑上的 dict/list，其他部分和 template 共用，所以 patch() 返回的 view 不可以再修改
+    '''
+
+    def __init__(self, view, **fields):
+        '''fields 為 {欄位名稱: 路徑}，"blocks" 之後的字串為 block_id，例如 ("blocks", "item_name", "element", "initial_value")'''
+        self.view = view
+        # 將路徑攤平成 (parent, key, name) 步驟，name 為 None 時複製 nodes[parent][key] 並加入 nodes
+        self.steps = []
+        copied = {(): 0}
+        for name, path in fields.items():
+            keys = list(path)
+            for depth, key in enumerate(keys):
+                if depth > 0 and keys[depth - 1] == "blocks" and isinstance(key, str):
+                    keys[depth] = next(index for index, block in enumerate(view["blocks"]) if block.get("block_id") == key)
+            for depth in range(1, len(keys)):
+                if tuple(keys[:depth]) not in copied:
+                    copied[tuple(keys[:depth])] = len(copied)
+                    self.steps.append((copied[tuple(keys[:depth - 1])], keys[depth - 1], None))
+            self.steps.append((copied[tuple(keys[:-1])], keys[-1], name))
+
+    def patch(self, **values):
+        '''沒有傳入的欄位保留 template 的值 (或不存在)'''
+        nodes = [self.view.copy()]
+        for parent, key, name in self.steps:
+            if name is None:
+                node = nodes[parent][key].copy()
+                nodes[parent][key] = node
+                nodes.append(node)
+            elif name in values:
+                nodes[parent][key] = values[name]
+        return nodes[0]
+
+
+# 每個 modal 在 import 時建立一次，每個 request 只替換動態的欄位
+OPEN_NEW_ORDER_MODAL_TEMPLATE = ModalTemplate(
+    buildOpenNewOrderModal(channel_id=""),
+    private_metadata=("private_metadata",)
+)
+NEW_ITEM_MODAL_TEMPLATE = ModalTemplate(
+    buildAddItemModal("", item_amount="1"),
+    private_metadata=("private_metadata",),
+    item_slack_users=("blocks", "item_slack_users", "element", "initial_users")
+)
+CHOOSE_ITEM_MODAL_TEMPLATE = ModalTemplate(
+    buildAddItemModal("", item_price_mrkdwn="0", item_amount="1"),
+    private_metadata=("private_metadata",),
+    item_price=("blocks", "item_price", "text", "text"),
+    item_name=("blocks", "item_name", "element", "initial_option"),
+    item_slack_users=("blocks", "item_slack_users", "element", "initial_users"),
+    current_item_users=("blocks", "current_item_users", "text", "text")
+)
+MODIFY_ORDER_MESSAGE_MODAL_TEMPLATE = ModalTemplate(
+    buildModifyOrderMessageModal("", Order(name="", creator="", info="", state=ORDER_STATE[0], img="")),
+    private_metadata=("private_metadata",),
+    order_creator=("blocks", "order_creator", "accessory", "initial_user"),
+    order_name=("blocks", "order_name", "element", "initial_value"),
+    order_info=("blocks", "order_info", "element", "initial_value"),
+    order_state=("blocks", "order_state", "element", "initial_option"),
+    order_img=("blocks", "order_img", "element", "initial_value")
+)
+# 訂單狀態下拉選單的 options，和 ORDER_STATE 的順序相同
+ORDER_STATE_OPTIONS = next(
+    block["element"]["options"] for block in MODIFY_ORDER_MESSAGE_MODAL_TEMPLATE.view["blocks"] if block.get("block_id") == "order_state"
+)
+BULK_ADD_ITEMS_MODAL_TEMPLATE = ModalTemplate(
+    buildBulkAddItemsModal(""),
+    private_metadata=("private_metadata",)
+)
+MODIFY_ITEM_PRICE_MODAL_TEMPLATE = ModalTemplate(
+    buildModifyItemPriceModal("", select_options={}),
+    private_metadata=("private_metadata",),
+    options=("blocks", "modify_item_name", "element", "options"),
+    option_groups=("blocks", "modify_item_name", "element", "option_groups")
+)
+
+
+def getOrderLedger(details):
+    '''將 order_details[ts] 轉成每個使用者每個品項一筆的帳目 (使用者, 品項, 金額, 數量, 小計)'''
+    ledger = []
+    append = ledger.append
+    for item, item_detail in details.items():
+        price = item_detail.price
+        for id, amount in item_detail.slack_users.items():
+            append((f"<@{ id }>", item, price, amount, price * amount))
+        for user, amount in item_detail.users.items():
+            append((user, item, price, amount, price * amount))
+    return ledger
+
+
+def getSettlementLines(ledger, user_totals=None):
+    '''依使用者彙整帳目，每個使用者一行: $應付金額 使用者 (品項($金額)*數量、...)
+
+    傳入訂單累計的個人小計 (Order.user_totals) 時直接使用，沒有時 (例如預覽或匯出單獨的帳目) 從帳目加總
+    '''
+    totals = {} if user_totals is None else user_totals
+    items = {}
+    for user, item, price, amount, subtotal in ledger:
+        if user in items:
+            items[user].append(f"{ item }(${ price })*{ amount }")
+        else:
+            items[user] = [f"{ item }(${ price })*{ amount }"]
+        if user_totals is None:
+            totals[user] = totals.get(user, 0) + subtotal
+    for user, user_items in items.items():
+        yield f"${ totals.get(user, 0) } { user } ({ '、'.join(user_items) })"
+
+
+def splitSettlementLine(line):
+    '''超過 section 長度上限的一行切成數段'''
+    for start in range(0, len(line), MAX_SECTION_TEXT_LENGTH):
+        yield line[start:start + MAX_SECTION_TEXT_LENGTH]
+
+
+def getSettlementMessages(lines):
+    '''將統計的每一行依大小分成數個 thread message，產生 (text, blocks)
+
+    每個 section 不超過 MAX_SECTION_TEXT_LENGTH 字，每個 message 不超過 MAX_MESSAGE_BLOCKS 個 blocks，
+    text 不超過 SETTLEMENT_MESSAGE_MAX_BYTES bytes
+    '''
+    title = "統計:"
+    message_lines = [title]
+    message_bytes = len(title.encode()) + 1
+    sections = []
+    section_lines = [title]
+    section_length = len(title) + 1
+
+    for line in itertools.chain.from_iterable(map(splitSettlementLine, lines)):
+        line_bytes = len(line.encode()) + 1
+        # section_length 為目前 section 以換行連接後的長度 + 1
+        new_section = section_length + len(line) > MAX_SECTION_TEXT_LENGTH
+        if message_bytes + line_bytes > SETTLEMENT_MESSAGE_MAX_BYTES or (new_section and len(sections) + 1 == MAX_MESSAGE_BLOCKS):
+            sections.append('\n'.join(section_lines))
+            yield getSettlementMessage(message_lines, sections)
+            title = "統計 (續):"
+            message_lines = [title]
+            message_bytes = len(title.encode()) + 1
+            sections = []
+            section_lines = [title]
+            section_length = len(title) + 1
+            # 加上標題後重新確認 section 的長度
+            new_section = section_length + len(line) > MAX_SECTION_TEXT_LENGTH
+        if new_section:
+            sections.append('\n'.join(section_lines))
+            section_lines = []
+            section_length = 0
+        message_lines.append(line)
+        message_bytes += line_bytes
+        section_lines.append(line)
+        section_length += len(line) + 1
+
+    sections.append('\n'.join(section_lines))
+    yield getSettlementMessage(message_lines, sections)
+
+
+def getSettlementMessage(message_lines, sections):
+    text = '\n'.join(message_lines) + '\n'
+    blocks = [
+        {
+            "type": "section",
+            "text": {
+                "type": "mrkdwn",
+                "text": section
+            }
+        } for section in sections
+    ]
+    return text, blocks
+
+
+def closeOrder(ts):
+    '''結案: 統計個人應付金額，將訂單改成已收單並從全域變數移除
+
+    返回 (統計 thread messages, blocks, metadata)，沒有品項時返回 None
+    '''
+    global orders, order_details
+    with getOrderLock(ts):
+        # 沒有品項
+        if not refreshOrder(ts) or not order_details.get(ts):
+            return None
+
+        def close():
+            # 修改 Message 狀態，不等待合併直接更新
+            cancelOrderMessageUpdate(ts)
+            orders[ts].state = ORDER_STATE[1]
+            return True
+
+        # 共享的 order_store 合併後才統計，包含其他 replicas 同時的修改
+        if not updateOrder(ts, close):
+            return None
+        ledger = getOrderLedger(order_details[ts])
+        # 每次修改時累計的個人小計 (見 addItemToOrderTotals)，不需要從帳目重新加總
+        user_totals = orders[ts].user_totals
+        learnOrderMenu(orders[ts].channel_id, order_details[ts])
+        blocks, metadata = getOrderMessageUpdate(ts)
+        metadata["event_payload"]["status"] = ORDER_STATUS_CLOSED
+
+        # 移除全域變數
+        deleteOrder(ts)
+        journalOrderEvent("closed", ts)
+
+    return getSettlementMessages(getSettlementLines(ledger, user_totals)), blocks, metadata
+
+
+class OrderJournal:
+    '''append-only 的訂單事件紀錄
+
+    事件以 JSON lines 寫入 journal.<segment>.log，每 segment_events 個事件換一個新的 segment，
+    並在背景將舊的 segments 合併進 snapshot.json (見 compactJournal)
+    '''
+
+    def __init__(self, path, segment_events):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        # 同一個目錄只能有一個 process 寫入
+        self.lock_file = open(os.path.join(path, "lock"), "w")
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self.segment_events = segment_events
+        self.lock = threading.Lock()
+        self.compact_lock = threading.Lock()
+        snapshot_segment, _ = readJournalSnapshot(path)
+        self.segment = max([snapshot_segment] + [segment for segment, _ in getJournalSegments(path)]) + 1
+        self.file = open(getJournalSegmentPath(path, self.segment), "a", encoding="utf-8")
+        self.events = 0
+
+    def append(self, event):
+        line = json.dumps(event, ensure_ascii=False, separators=(",", ":")) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+            self.events += 1
+            if self.events < self.segment_events:
+                return
+            # 換一個新的 segment，舊的在背景合併進 snapshot
+            self.file.close()
+            compact_segment = self.segment
+            self.segment += 1
+            self.file = open(getJournalSegmentPath(self.path, self.segment), "a", encoding="utf-8")
+            self.events = 0
+        threading.Thread(target=self.compact, args=(compact_segment,), name="order-journal-compact", daemon=True).start()
+
+    def compact(self, upto):
+        with self.compact_lock:
+            try:
+                compactJournal(self.path, upto=upto)
+            except Exception:
+                logger.exception(f"order journal compaction failed: { self.path }")
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+        self.lock_file.close()
+
+
+def getJournalSegmentPath(path, segment):
+    return os.path.join(path, f"journal.{ segment:08d}.log")
+
+
+def getJournalSegments(path):
+    '''目錄中所有的 journal segments [(segment, 檔案路徑), ...]，依 segment 排序'''
+    segments = []
+    for name in os.listdir(path):
+        match = re.fullmatch(r"journal\.(\d+)\.log", name)
+        if match:
+            segments.append((int(match.group(1)), os.path.join(path, name)))
+    return sorted(segments)
+
+
+def readJournalSnapshot(path):
+    '''返回 (snapshot 包含到的 segment, 訂單狀態)，沒有 snapshot 時返回 (0, {})'''
+    try:
+        with open(os.path.join(path, "snapshot.json"), encoding="utf-8") as f:
+            snapshot = json.load(f)
+    except FileNotFoundError:
+        return 0, {}
+    return snapshot["segment"], snapshot["orders"]
+
+
+def applyJournalEvent(state, event):
+    '''將一個事件套用到訂單狀態 {"ts": {"order": {...}, "details": {...}, "updated_at": 最後一個事件的時間}}'''
+    ts = event["ts"]
+    if event["e"] == "created":
+        state[ts] = {"order": event["order"], "details": event["details"], "updated_at": event.get("t")}
+        return
+    if ts not in state:
+        return
+    # 舊的 journal 沒有 "t"
+    state[ts]["updated_at"] = event.get("t", state[ts].get("updated_at"))
+    if event["e"] in ("closed", "evicted"):
+        state.pop(ts)
+    elif event["e"] == "item_set":
+        if event["detail"]:
+            state[ts]["details"][event["item"]] = event["detail"]
+        else:
+            state[ts]["details"].pop(event["item"], None)
+    elif event["e"] == "items_set":
+        for item, detail in event["details"].items():
+            if detail:
+                state[ts]["details"][item] = detail
+            else:
+                state[ts]["details"].pop(item, None)
+    elif event["e"] == "price_changed":
+        if event["item"] in state[ts]["details"]:
+            state[ts]["details"][event["item"]]["price"] = event["price"]
+    elif event["e"] == "order_updated":
+        state[ts]["order"].update(event["order"])
+    elif event["e"] == "creator_transferred":
+        state[ts]["order"]["order_creator"] = event["creator"]
+    if "r" in event and ts in state:
+        state[ts]["order"]["version"] = event["r"] + 1
+
+
+def replayJournal(path, upto=None):
+    '''讀取 snapshot 後依序套用之後的 segments (到 upto 為止)，返回 (最後套用的 segment, 訂單狀態)'''
+    segment, state = readJournalSnapshot(path)
+    for journal_segment, segment_path in getJournalSegments(path):
+        if journal_segment <= segment or (upto is not None and journal_segment > upto):
+            continue
+        with open(segment_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    # 寫到一半中斷的最後一行
+                    logger.warning(f"skip broken journal line: { segment_path }")
+                    continue
+                applyJournalEvent(state, event)
+        segment = journal_segment
+    return segment, state
+
+
+def compactJournal(path, upto=None):
+    '''將 snapshot 和 segments (到 upto 為止) 合併成新的 snapshot，並刪除已合併的 segments'''
+    segment, state = replayJournal(path, upto=upto)
+    snapshot_path = os.path.join(path, "snapshot.json")
+    with open(snapshot_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"segment": segment, "orders": state}, f, ensure_ascii=False, separators=(",", ":"))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(snapshot_path + ".tmp", snapshot_path)
+    for journal_segment, segment_path in getJournalSegments(path):
+        if journal_segment <= segment:
+            os.remove(segment_path)
+    return segment, state
+
+
+def journalOrderEvent(event_type, ts, **fields):
+    '''有設定 ORDER_JOURNAL_DIR 時記錄訂單事件，呼叫時必須持有 getOrderLock(ts)
+
+    "r" 為保存前的 Order.version，重建時修改後的版本為 "r" + 1，"t" 為事件的時間 (time.time())
+    '''
+    global orders
+    if order_journal:
+        order_journal.append({"e": event_type, "ts": ts, "r": orders[ts].version if ts in orders else 0, "t": int(time.time()), **fields})
+
+
+def getJournalItemDetail(item_detail):
+    return item_detail and item_detail.toRecord()
+
+
+def journalOrderCreated(ts):
+    global orders, order_details
+    journalOrderEvent(
+        "created",
+        ts,
+        order=orders[ts].toRecord(),
+        details={item: getJournalItemDetail(item_detail) for item, item_detail in order_details.get(ts, {}).items()}
+    )
+
+
+def openOrderJournal():
+    '''啟動時從 ORDER_JOURNAL_DIR 的 snapshot 及 journal 重建 orders, order_details，之後的修改寫入新的 segment'''
+    global order_journal, orders, order_details
+    if not ORDER_JOURNAL_DIR:
+        return
+    if order_store.shared:
+        # 共享的 order_store 已經保存所有修改，journal 只屬於單一 process
+        logger.warning("ORDER_JOURNAL_DIR is ignored when ORDER_STORE=shared")
+        return
+    started = time.monotonic()
+    # 先取得目錄的 lock，避免和 compact-journal 同時讀寫
+    journal = OrderJournal(ORDER_JOURNAL_DIR, segment_events=ORDER_JOURNAL_SEGMENT_EVENTS)
+    _, state = replayJournal(ORDER_JOURNAL_DIR)
+    # 讀回時超過 ORDER_CACHE_MAX_ORDERS 而被移出的訂單也要記錄
+    order_journal = journal
+    atexit.register(order_journal.close)
+    # 閒置時間從最後一個事件開始計算，依序加入 order_access_times，超過 ORDER_CACHE_TTL 的訂單不讀回 (見 evictOrders)
+    now = time.time()
+    expired = []
+    for ts, order in sorted(state.items(), key=lambda item: item[1].get("updated_at") or now):
+        idle = now - (order.get("updated_at") or now)
+        if ORDER_CACHE_TTL and idle > ORDER_CACHE_TTL:
+            expired.append(ts)
+            continue
+        with getOrderLock(ts):
+            orders[ts] = Order.fromRecord(order["order"])
+            order_details[ts] = {item: OrderItem.fromRecord(item_detail) for item, item_detail in order["details"].items()}
+            resetOrderTotals(ts)
+        touchOrder(ts, accessed=time.monotonic() - max(0, idle))
+    # 之後合併 segments 時從 snapshot 移除
+    for ts in expired:
+        with getOrderLock(ts):
+            journalOrderEvent("evicted", ts)
+        metrics.inc("slack_order_order_evictions_total", reason="ttl")
+    logger.info(f"restored { len(state) - len(expired) } orders ({ len(expired) } idle orders skipped) from journal in { (time.monotonic() - started) * 1000:.1f} ms")
+
+
+order_journal = None
+
+
+class TokenBucket:
+    '''每秒補充 rate 個 token，最多存 burst 個'''
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        '''預約一個 token，返回需要等待的秒數'''
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return max(0, -self.tokens / self.rate, self.paused_until - now)
+
+    def pause(self, seconds):
+        '''收到 429 時，Retry-After 秒內不再送出'''
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+# 排入 SlackApiDispatcher 的呼叫，依 (priority, sequence) 排序，function 為 None 時停止 worker
+SlackApiJob = collections.namedtuple("SlackApiJob", ("priority", "sequence", "ts", "function", "description", "method", "channel", "attempt", "reserved"))
+
+
+class SlackApiDispatcher:
+    '''在背景 threads 呼叫 Slack Web API
+
+    同一個訂單 (ts) 的呼叫交給同一個 worker；每個 worker 先執行 priority 小的 job，priority 相同時依送出的順序執行。
+    執行前依 method 及 (method, channel) 的 token bucket 預約，收到 429 時依 Retry-After 暫停該 bucket 後重試，
+    其他可重試的錯誤以 exponential backoff 重試。
+    需要等待的 job 不在 worker 中 sleep，放回 worker 的延後佇列，同一個訂單之後的 job 等它完成，其他訂單的 job 繼續執行
+    '''
+
+    def __init__(self, workers, queue_size, max_retries):
+        self.queues = [queue.PriorityQueue(maxsize=queue_size) for _ in range(workers)]
+        self.max_retries = max_retries
+        self.accepting = True
+        self.sequence = itertools.count()
+        self.buckets = {}
+        self.buckets_lock = threading.Lock()
+        # 因 token bucket 等待的次數及收到 429 的次數，key 為 method
+        self.throttled = collections.Counter()
+        self.rate_limited = collections.Counter()
+        # 每個 worker 延後中的 job 數量
+        self.deferred = [0] * workers
+        self.threads = [
+            threading.Thread(target=self.run, args=(index,), name=f"slack-api-{ index }", daemon=True)
+            for index in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, ts, job, description="", method=None, channel=None, priority=SLACK_API_PRIORITY_DEFAULT):
+        '''排入一個呼叫 Web API 的 job (沒有參數的 function)，queue 滿時等待'''
+        if not self.accepting:
+            logger.warning(f"slack api dispatcher is draining, run job inline: { description }")
+            try:
+                self.callInline(job, description, method, channel)
+            except Exception:
+                logger.exception(f"slack api call failed: { description }")
+            return
+        self.queues[zlib.crc32(ts.encode()) % len(self.queues)].put(
+            SlackApiJob(priority, next(self.sequence), ts, job, description, method, channel, attempt=0, reserved=False)
+        )
+
+    def run(self, index):
+        job_queue = self.queues[index]
+        # 延後的 job [(可以執行的時間, job), ...] (heap)
+        delayed = []
+        # ts : 等待同一個訂單延後中的 job 完成的 jobs (heap)
+        waiting = {}
+        stopping = False
+        while not stopping or delayed:
+            now = time.monotonic()
+            if delayed and delayed[0][0] <= now:
+                job = heapq.heappop(delayed)[1]
+            elif stopping:
+                time.sleep(delayed[0][0] - now)
+                continue
+            else:
+                try:
+                    job = job_queue.get(timeout=delayed[0][0] - now if delayed else None)
+                except queue.Empty:
+                    continue
+                job_queue.task_done()
+                if job.function is None:
+                    stopping = True
+                    continue
+                if job.ts in waiting:
+                    heapq.heappush(waiting[job.ts], job)
+                    self.deferred[index] += 1
+                    continue
+                self.deferred[index] += 1
+
+            retry = self.call(job)
+            if retry:
+                delay, job = retry
+                heapq.heappush(delayed, (time.monotonic() + delay, job))
+                waiting.setdefault(job.ts, [])
+                continue
+            self.deferred[index] -= 1
+            # 依序執行同一個訂單等待中的 job
+            if waiting.get(job.ts):
+                heapq.heappush(delayed, (0, heapq.heappop(waiting[job.ts])))
+            else:
+                waiting.pop(job.ts, None)
+
+    def getBuckets(self, method, channel):
+        '''method 的 bucket，及有每個 channel 限制時 (method, channel) 的 bucket'''
+        keys = [method]
+        if channel and method in SLACK_API_CHANNEL_RATE_LIMITS:
+            keys.append((method, channel))
+        with self.buckets_lock:
+            for key in keys:
+                if key not in self.buckets:
+                    per_minute = SLACK_API_CHANNEL_RATE_LIMITS[method] if isinstance(key, tuple) else SLACK_API_RATE_LIMITS.get(method, SLACK_API_DEFAULT_RATE_LIMIT)
+                    self.buckets[key] = TokenBucket(rate=per_minute / 60, burst=max(1, per_minute // 6))
+            return [self.buckets[key] for key in keys]
+
+    def call(self, job):
+        '''執行 job 一次，需要等待 token bucket 或重試時不等待，返回 (延後的秒數, 之後執行的 job)，完成或放棄時返回 None'''
+        buckets = self.getBuckets(job.method, job.channel) if job.method else []
+        if not job.reserved:
+            wait = max([bucket.reserve() for bucket in buckets], default=0)
+            if wait > 0:
+                self.throttled[job.method] += 1
+                return wait, job._replace(reserved=True)
+        try:
+            job.function()
+            return None
+        except Exception as e:
+            if job.attempt == self.max_retries or not isRetryableSlackApiError(e):
+                logger.exception(f"slack api call failed: { job.description }")
+                return None
+            retry_after = getSlackApiRetryAfter(e)
+            if retry_after is not None:
+                self.rate_limited[job.method] += 1
+                logger.warning(f"slack api rate limited, retry in { retry_after }s: { job.description }")
+                for bucket in buckets:
+                    bucket.pause(retry_after)
+                delay = retry_after
+            else:
+                delay = SLACK_API_RETRY_BACKOFF_MS / 1000 * 2 ** job.attempt
+                logger.warning(f"slack api call failed, retry in { delay }s: { job.description } ({ e })")
+            return delay, job._replace(attempt=job.attempt + 1, reserved=False)
+
+    def callInline(self, function, description, method, channel=None):
+        '''在呼叫的 thread 執行並返回 function() 的結果 (需要回應的呼叫，例如 conversations_history)
+
+        和背景的 job 共用 token bucket，需要等待時在呼叫的 thread 中等待，最後一次重試失敗時 raise
+        '''
+        buckets = self.getBuckets(method, channel) if method else []
+        for attempt in range(self.max_retries + 1):
+            wait = max([bucket.reserve() for bucket in buckets], default=0)
+            if wait > 0:
+                self.throttled[method] += 1
+                time.sleep(wait)
+            try:
+                return function()
+            except Exception as e:
+                if attempt == self.max_retries or not isRetryableSlackApiError(e):
+                    raise
+                retry_after = getSlackApiRetryAfter(e)
+                if retry_after is not None:
+                    self.rate_limited[method] += 1
+                    logger.warning(f"slack api rate limited, retry in { retry_after }s: { description }")
+                    for bucket in buckets:
+                        bucket.pause(retry_after)
+                    if not buckets:
+                        time.sleep(retry_after)
+                else:
+                    delay = SLACK_API_RETRY_BACKOFF_MS / 1000 * 2 ** attempt
+                    logger.warning(f"slack api call failed, retry in { delay }s: { description } ({ e })")
+                    time.sleep(delay)
+
+    def getStats(self):
+        '''queue 中等待及延後的 job 數量，以及每個 method 被 token bucket 延後及收到 429 的次數'''
+        return {
+            "queue_depth": sum(job_queue.qsize() for job_queue in self.queues) + sum(self.deferred),
+            "queue_capacity": sum(job_queue.maxsize for job_queue in self.queues),
+            "throttled": dict(self.throttled),
+            "rate_limited": dict(self.rate_limited)
+        }
+
+    def drain(self, timeout=None):
+        '''停止接受新的 job，等待 queue 中及延後的 job 執行完畢'''
+        self.accepting = False
+        deadline = time.monotonic() + timeout if timeout else None
+        for job_queue in self.queues:
+            # priority 最大，排在所有 job 之後
+            job_queue.put(SlackApiJob(float("inf"), next(self.sequence), None, None, "stop", None, None, attempt=0, reserved=False))
+        for thread in self.threads:
+            thread.join(None if deadline is None else max(0, deadline - time.monotonic()))
+        pending = sum(job_queue.qsize() for job_queue in self.queues) + sum(self.deferred)
+        if pending:
+            logger.warning(f"slack api dispatcher stopped with { pending } pending jobs")
+
+
+def isRetryableSlackApiError(e):
+    '''429、5xx 及連線錯誤可以重試'''
+    if isinstance(e, SlackApiError):
+        return e.response.status_code == 429 or e.response.status_code >= 500
+    return isinstance(e, (OSError, TimeoutError))
+
+
+def getSlackApiRetryAfter(e):
+    '''429 回應的 Retry-After (秒)'''
+    if isinstance(e, SlackApiError) and e.response.status_code == 429:
+        return int(e.response.headers.get("Retry-After", 1))
+    return None
+
+
+def submitSlackApiCall(order_ts, method, priority=SLACK_API_PRIORITY_DEFAULT, **kwargs):
+    '''背景呼叫 app.client 的 Web API method，order_ts 相同且 priority 相同的呼叫依序執行'''
+    slack_api_dispatcher.submit(
+        order_ts,
+        lambda: getattr(app.client, method)(**kwargs),
+        description=f"{ method } { order_ts }",
+        method=method,
+        channel=kwargs.get("channel"),
+        priority=priority
+    )
+
+
+def submitOrderMessageUpdate(channel_id, ts):
+    '''背景 chat_update order message，blocks 和 metadata 在執行時才產生'''
+    global orders
+
+    def job():
+        if refreshOrder(ts):
+            updateOrderMessage(channel_id, ts)
+
+    slack_api_dispatcher.submit(
+        ts,
+        job,
+        description=f"chat_update { ts }",
+        method="chat_update",
         channel=channel_id,
-        ts=ts,
-        text="updated",
+        priority=SLACK_API_PRIORITY_UPDATE
+    )
+
+
+def submitOrderClosed(channel_id, ts, settlement_messages, blocks, metadata):
+    '''背景送出結案的統計 thread messages (依序)、更新 order message 及取消釘選'''
+    for text, settlement_blocks in settlement_messages:
+        submitSlackApiCall(ts, "chat_postMessage", channel=channel_id, thread_ts=ts, text=text, blocks=settlement_blocks)
+    submitSlackApiCall(ts, "chat_update", priority=SLACK_API_PRIORITY_UPDATE, channel=channel_id, ts=ts, text="ended", metadata=metadata, blocks=blocks)
+    submitSlackApiCall(ts, "pins_remove", channel=channel_id, timestamp=ts)
+
+
+slack_api_dispatcher = SlackApiDispatcher(
+    workers=SLACK_API_WORKERS,
+    queue_size=SLACK_API_QUEUE_SIZE,
+    max_retries=SLACK_API_MAX_RETRIES
+)
+
+
+class Metrics:
+    '''以 Prometheus text format 輸出的 counters, histograms 及 gauges'''
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.descriptions = {}
+        self.collectors = {}
+        self.counters = collections.defaultdict(float)
+        self.histograms = {}
+
+    def describe(self, name, metric_type, help, collect=None):
+        '''collect 為輸出時才計算數值的函式，返回 {labels tuple: value}'''
+        self.descriptions[name] = (metric_type, help)
+        if collect:
+            self.collectors[name] = collect
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                # 每個 bucket 的數量、+Inf 及總和
+                histogram = self.histograms[key] = [0] * (len(self.buckets) + 2)
+            histogram[bisect.bisect_left(self.buckets, value)] += 1
+            histogram[-1] += value
+
+    def render(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: list(histogram) for key, histogram in self.histograms.items()}
+
+        samples = collections.defaultdict(list)
+        for (name, labels), value in counters.items():
+            samples[name].append(getMetricSample(name, labels, value))
+        for (name, labels), histogram in histograms.items():
+            count = 0
+            for le, bucket_count in zip([*self.buckets, "+Inf"], histogram):
+                count += bucket_count
+                samples[name].append(getMetricSample(f"{ name }_bucket", (*labels, ("le", le)), count))
+            samples[name].append(getMetricSample(f"{ name }_sum", labels, histogram[-1]))
+            samples[name].append(getMetricSample(f"{ name }_count", labels, count))
+        for name, collect in self.collectors.items():
+            for labels, value in collect().items():
+                samples[name].append(getMetricSample(name, labels, value))
+
+        lines = []
+        for name, (metric_type, help) in self.descriptions.items():
+            lines.append(f"# HELP { name } { help }")
+            lines.append(f"# TYPE { name } { metric_type }")
+            lines.extend(samples.get(name, []))
+        return "\n".join(lines) + "\n"
+
+
+def getMetricSample(name, labels, value):
+    if not labels:
+        return f"{ name } { float(value) }"
+    label_text = ",".join(f'{ key }="{ escapeMetricLabel(label) }"' for key, label in labels)
+    return f"{ name }{{{ label_text }}} { float(value) }"
+
+
+def escapeMetricLabel(label):
+    return str(label).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def getListenerLabel(body):
+    '''依 payload 類型及 callback_id/action_id 區分 listener，add_item_select_N 合併成同一個'''
+    if "command" in body:
+        return f"command:{ body['command'] }"
+    if body.get("type") == "view_submission":
+        return f"view:{ body['view']['callback_id'] }"
+    if body.get("type") in ("block_actions", "block_suggestion"):
+        action_id = body["actions"][0]["action_id"] if body.get("actions") else body.get("action_id", "")
+        return f"{ body['type'] }:{ re.sub(r'_[0-9]+$', '_N', action_id) }"
+    return body.get("type", "unknown")
+
+
+def getOrderMetrics():
+    order_states = [order.state for order in list(orders.values())]
+    return {(): sum(1 for order_state in order_states if order_state == ORDER_STATE[0])}
+
+
+def getOrderItemMetrics():
+    return {(): sum(len(order_detail) for order_detail in list(order_details.values()))}
+
+
+def getMemoryMetrics():
+    return {
+        (("dict", "orders"),): len(orders),
+        (("dict", "order_details"),): len(order_details),
+        (("dict", "order_message_caches"),): len(order_message_caches),
+        (("dict", "order_locks"),): len(order_locks),
+        (("dict", "order_access_times"),): len(order_access_times),
+        (("dict", "notice_times"),): len(notice_times)
+    }
+
+
+def getSlackApiDispatcherMetrics(key):
+    stats = slack_api_dispatcher.getStats()
+    if key == "queue_depth":
+        return {(): stats["queue_depth"]}
+    return {(("method", method),): count for method, count in stats[key].items()}
+
+
+metrics = Metrics(buckets=METRICS_BUCKETS)
+metrics.describe("slack_order_requests_total", "counter", "Requests received per listener")
+metrics.describe("slack_order_ack_seconds", "histogram", "Time from receiving a request to ack() per listener")
+metrics.describe("slack_order_listener_seconds", "histogram", "Listener run time per listener")
+metrics.describe("slack_order_listener_errors_total", "counter", "Unhandled listener errors per listener")
+metrics.describe("slack_order_slack_api_call_seconds", "histogram", "Slack Web API call latency per method")
+metrics.describe("slack_order_slack_api_rate_limited_total", "counter", "Slack Web API 429 responses per method")
+metrics.describe("slack_order_slack_api_throttled_total", "counter", "Slack Web API calls delayed by the local rate limit per method",
+                 lambda: getSlackApiDispatcherMetrics("throttled"))
+metrics.describe("slack_order_slack_api_queue_depth", "gauge", "Slack Web API calls waiting in the dispatcher queues",
+                 lambda: getSlackApiDispatcherMetrics("queue_depth"))
+metrics.describe("slack_order_open_orders", "gauge", "Orders in memory that are still taking orders", getOrderMetrics)
+metrics.describe("slack_order_order_items", "gauge", "Items of all orders in memory", getOrderItemMetrics)
+metrics.describe("slack_order_order_evictions_total", "counter", "Orders evicted from memory by reason")
+metrics.describe("slack_order_order_rehydrations_total", "counter", "Orders loaded back into memory by source")
+metrics.describe("slack_order_order_store_expired_total", "counter", "Orders deleted from the order store after ORDER_CACHE_TTL without changes")
+metrics.describe("slack_order_notices_total", "counter", "Permission notices sent, or suppressed as repeats within NOTICE_DEDUP_SECONDS, per reason")
+metrics.describe("slack_order_order_message_updates_total", "counter", "Order message chat_update calls sent, or skipped because the content did not change")
+metrics.describe("slack_order_memory_entries", "gauge", "Entries of the in-memory order dicts", getMemoryMetrics)
+
+
+class InstrumentedWebClient(WebClient):
+    '''記錄每個 Web API method 的延遲及 429 次數的 WebClient'''
+
+    def api_call(self, api_method, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().api_call(api_method, **kwargs)
+        except SlackApiError as e:
+            if e.response.status_code == 429:
+                metrics.inc("slack_order_slack_api_rate_limited_total", method=api_method)
+            raise
+        finally:
+            metrics.observe("slack_order_slack_api_call_seconds", time.perf_counter() - started, method=api_method)
+
+
+class MetricsAck(Ack):
+    '''ack() 時記錄從收到 request 到 ack 的時間'''
+
+    def __init__(self, listener, started):
+        super().__init__()
+        self.listener = listener
+        self.started = started
+
+    def __call__(self, *args, **kwargs):
+        response = super().__call__(*args, **kwargs)
+        metrics.observe("slack_order_ack_seconds", time.perf_counter() - self.started, listener=self.listener)
+        return response
+
+
+class ListenerMetricsExecutor(concurrent.futures.ThreadPoolExecutor):
+    '''記錄 listener 執行時間的 executor
+
+    Bolt 在處理 request 的 thread 上 submit listener，listener 名稱由 recordRequestMetrics 存在 thread local
+    '''
+
+    def submit(self, fn, *args, **kwargs):
+        listener = getattr(listener_metrics_context, "listener", None)
+        if listener is None:
+            return super().submit(fn, *args, **kwargs)
+
+        def run():
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                metrics.observe("slack_order_listener_seconds", time.perf_counter() - started, listener=listener)
+        return super().submit(run)
+
+
+listener_metrics_context = threading.local()
+
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def startMetricsServer():
+    '''在背景 thread 啟動 /metrics endpoint，METRICS_PORT 為 0 時不啟動'''
+    if not METRICS_PORT:
+        return None
+    server = http.server.ThreadingHTTPServer((METRICS_HOST, METRICS_PORT), MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"metrics endpoint listening on http://{ METRICS_HOST }:{ METRICS_PORT }/metrics")
+    return server
+
+
+class ClientTokenWarningFilter(logging.Filter):
+    '''Bolt 在沒有傳入 token 時仍會讀取 SLACK_BOT_TOKEN，傳入 client 時每次啟動都會警告 token 不會被使用，token 已經交給 client'''
+
+    def filter(self, record):
+        return record.getMessage() != warning_client_prioritized_and_token_skipped()
+
+
+logging.getLogger("slack_bolt.App").addFilter(ClientTokenWarningFilter())
+logging.getLogger("slack_bolt.AsyncApp").addFilter(ClientTokenWarningFilter())
+
+# Initializes your app with your bot token and socket mode handler
+app = App(
+    client=InstrumentedWebClient(token=os.environ.get("SLACK_BOT_TOKEN"), base_url=SLACK_API_URL),
+    listener_executor=ListenerMetricsExecutor(max_workers=5)
+)
+
+
+@app.middleware
+def recordRequestMetrics(body, context, next):
+    '''記錄每個 listener 的 request 數量、ack 延遲及執行時間，並改用 InstrumentedWebClient
+
+    listener 中直接呼叫的 Web API (views_open 等) 收到 429 時依 Retry-After 重試，背景呼叫由 slack_api_dispatcher 處理
+    '''
+    listener = getListenerLabel(body)
+    metrics.inc("slack_order_requests_total", listener=listener)
+    context["ack"] = MetricsAck(listener, time.perf_counter())
+    client = context.client
+    context["client"] = InstrumentedWebClient(
+        token=client.token,
+        base_url=client.base_url,
+        timeout=client.timeout,
+        ssl=client.ssl,
+        proxy=client.proxy,
+        headers=client.headers,
+        team_id=client.default_params.get("team_id"),
+        logger=client.logger,
+        retry_handlers=client.retry_handlers + [RateLimitErrorRetryHandler(max_retry_count=SLACK_API_MAX_RETRIES)]
+    )
+    # say 在注入 middleware 參數時就以原本的 client 建立，移除後讓 listener 重新建立
+    context.pop("say", None)
+    listener_metrics_context.listener = listener
+    next()
+
+
+@app.error
+def handleListenerError(error, body):
+    metrics.inc("slack_order_listener_errors_total", listener=getListenerLabel(body))
+    logger.exception(f"Failed to run listener function (error: { error })")
+
+
+@app.command("/order")
+def open_modal(ack, body, client):
+    '''指令 /order 開啟新訂單的 modal'''
+    ack()
+    client.views_open(
+        trigger_id=body["trigger_id"],
+        view=getOpenNewOrderModal(channel_id=body["channel_id"])
+    )
+
+
+@app.view("open_new_order_modal")
+def handle_submission(ack, say, view, body):
+    '''Handle OpenNewOrderModal submission'''
+    ack()
+    order = getNewOrderFromView(view=view, body=body)
+    blocks, metadata = getNewOrderMessage(order)
+
+    message = say(
+        text="order",
+        channel=getChannelIdFromOpenNewOrderModal(view=view),
+        blocks=blocks,
         metadata=metadata,
-        blocks=blocks
+        # 不要自動展開連結
+        unfurl_links=False
     )
+
+    # 新增/更新 訂單資訊到全域變數
+    createOrder(message["channel"], message["ts"], order)
+    # 釘選訂單 message
+    submitSlackApiCall(message["ts"], "pins_add", channel=message["channel"], timestamp=message["ts"])
+
+
+@app.view("add_item")
+def handle_submission(ack, view):
+    '''監聽訂單新增按鈕開起的 modal view 送出'''
+    errors, submission = getAddItemSubmission(view)
+    if len(errors) > 0:
+        ack(response_action="errors", errors=errors)
+        return
+
+    ack()
+    applyAddItemSubmission(submission)
+
+
+@app.view("modify_order_message_modal")
+def handle_submission(ack, view):
     ack()
+    channel_id, ts, old_order_creator, new_order_creator = applyModifyOrderMessageSubmission(view)
+
+    if old_order_creator != new_order_creator:
+        submitSlackApiCall(
+            ts,
+            "chat_postMessage",
+            priority=SLACK_API_PRIORITY_NOTICE,
+            channel=channel_id,
+            thread_ts=ts,
+            text=getCreatorTransferredText(old_order_creator, new_order_creator)
+        )
+
+
+@app.view("modify_item_price_modal")
+def handle_submission(ack, view):
+    errors, submission = getModifyItemPriceSubmission(view)
+    if len(errors) > 0:
+        ack(response_action="errors", errors=errors)
+        return
+
+    ack()
+    applyModifyItemPriceSubmission(submission)
+
+
+@app.view("bulk_add_items_modal")
+def handle_submission(ack, view):
+    '''批次新增品項，所有行都正確時才寫入'''
+    errors, submission = getBulkAddItemsSubmission(view)
+    if len(errors) > 0:
+        ack(response_action="errors", errors=errors)
+        return
+
+    ack()
+    applyBulkAddItemsSubmission(submission)
+
+
+@app.options("item_name_input")
+def item_name_options(ack, body):
+    '''品項 external_select 搜尋菜單'''
+    ack(options=getMenuOptions(body["view"]["private_metadata"].split(',')[0], body.get("value", "")))
 
 
 # 新增 按鈕
 @app.action("new_item")
 def new_item_clicked(ack, body, client):
     ack()
-    global orders
-    ifMessageIsNoneReloadMetadata(body=body)
+    if not isOrderOpen(body):
+        return
     ts = getTsFromMessageBody(body)
     channel_id = getChannelIdFromMessageBody(body)
 
     # 確認是否點餐中，或是否為訂單建立者
-    if not checkPermission(channel_id=channel_id, ts=ts, body=body, client=client):
+    if not checkPermission(channel_id=channel_id, ts=ts, body=body):
         return
 
     client.views_open(
         trigger_id=body["trigger_id"],
-        view={
-            "type": "modal",
-            "callback_id": "add_item",
-            "title": {"type": "plain_text", "text": "新增品項"},
-            "submit": {"type": "plain_text", "text": "送出"},
-            "private_metadata": getPrivateMetadataFormatString(body=body),
-            "blocks": getAddItemModalBlocks(
-                item_slack_users=[f"{ body['user']['id'] }"],
-                item_amount="1"
-                )
-        }
+        view=getNewItemModal(body)
     )
 
 
@@ -789,294 +3758,340 @@ def new_item_clicked(ack, body, client):
 def handle_some_action(ack, client, body, action):
     '''修改訂單資訊按鈕'''
     ack()
-    global orders, order_details, imgs
-    ifMessageIsNoneReloadMetadata(body)
+    if not isOrderOpen(body):
+        return
     channel_id = getChannelIdFromMessageBody(body)
     ts = getTsFromMessageBody(body)
-    order_img = orders[ts]["order_img"] if orders[ts]["order_img"] else secrets.choice(imgs)
-    order_state = getOrderStateFromMessageBody(body)
 
     if action["selected_option"]["value"] == "modify_order_info":
         # 判斷是否是訂單建立者
-        if not isOrderCreator(channel_id=channel_id, ts=ts, body=body, client=client):
+        if not isOrderCreator(channel_id=channel_id, ts=ts, body=body):
             return
 
         client.views_open(
             trigger_id=body["trigger_id"],
-            view={
-                "type": "modal",
-                "callback_id": "modify_order_message_modal",
-                "title": {"type": "plain_text", "text": "修改訂單資訊"},
-                "submit": {"type": "plain_text", "text": "修改"},
-                "private_metadata": getPrivateMetadataFormatString(body=body),
-                "blocks": [
-                    {
-                        "block_id": "order_creator",
-                        "type": "section",
-                        "text": {
-                            "type": "mrkdwn",
-                            "text": "訂單建立者:"
-                        },
-                        "accessory": {
-                            "type": "users_select",
-                            "placeholder": {
-                                "type": "plain_text",
-                                "text": "Select a user"
-                            },
-                            "action_id": "order_creator_select",
-                            "initial_user": orders[ts]["order_creator"]
-                        }
-                    },
-                    {
-                        "block_id": "order_name",
-                        "type": "input",
-                        "element": {
-                            "type": "plain_text_input",
-                            "action_id": "order_name_input",
-                            "initial_value": orders[ts]["order_name"]
-                        },
-                        "label": {"type": "plain_text", "text": "訂單名稱:"}
-                    },
-                    {
-                        "block_id": "order_info",
-                        "type": "input",
-                        "element": {
-                            "type": "plain_text_input",
-                            "action_id": "order_info_input",
-                            "multiline": True,
-                            "initial_value": orders[ts]["order_info"]
-                        },
-                        "label": {"type": "plain_text", "text": "請寫下訂單資訊:"},
-                    },
-                    {
-                        "block_id": "order_state",
-                        "label": {"type": "plain_text", "text": "訂單狀態:"},
-                        "type": "input",
-                        "element": {
-                            "type": "static_select",
-                            "action_id": "order_state_selected",
-                            "initial_option": {
-                                "value": str(ORDER_STATE.index(order_state)),
-                                "text": {
-                                    "type": "plain_text",
-                                    "text": order_state
-                                }
-                            },
-                            "options": [
-                                {
-                                    "text": {
-                                        "type": "plain_text",
-                                        "text": ORDER_STATE[0]
-                                    },
-                                    "value": "0"
-                                },
-                                {
-                                    "text": {
-                                        "type": "plain_text",
-                                        "text": ORDER_STATE[1]
-                                    },
-                                    "value": "1"
-                                }
-                            ]
-                        }
-                    },
-                    {
-                        "block_id": "order_img",
-                        "type": "input",
-                        "element": {
-                            "type": "plain_text_input",
-                            "action_id": "order_img_input",
-                            "initial_value": order_img
-                        },
-                        "label": {"type": "plain_text", "text": "小圖片連結:"},
-                        "optional": True
-                    },
-                ]
-            }
+            view=getModifyOrderMessageModal(body, ts)
         )
     elif action["selected_option"]["value"] == "modify_item_price":
-        options = []
         # 確認是否點餐中，或是否為訂單建立者
-        if not checkPermission(channel_id=channel_id, ts=ts, body=body, client=client):
+        if not checkPermission(channel_id=channel_id, ts=ts, body=body):
             return
-        # 確認是否有存在品項資料
-        if not order_details.get(ts):
+        view = getModifyItemPriceModal(body, ts)
+        if not view:
             return
-        # 產生所有品項的 dictionaries
-        for item in order_details[ts]:
-            options.append({
-                "value": item,
-                "text": {
-                    "type": "plain_text",
-                    "text": item
-                }
-            })
-        options.sort(key=lambda item: item['value'], reverse=True)
         client.views_open(
             trigger_id=body["trigger_id"],
-            view={
-                "type": "modal",
-                "callback_id": "modify_item_price_modal",
-                "title": {"type": "plain_text", "text": "修改品項金額"},
-                "submit": {"type": "plain_text", "text": "修改"},
-                "private_metadata": getPrivateMetadataFormatString(body=body),
-                "blocks": [
-                    {
-                        "type": "input",
-                        "block_id": "modify_item_name",
-                        "element": {
-                            "type": "static_select",
-                            "placeholder": {
-                                "type": "plain_text",
-                                "text": "品項"
-                            },
-                            "options": options,
-                            "action_id": "modify_item_name_select",
-                        },
-                        "label": {
-                            "type": "plain_text",
-                            "text": "請選擇一個品項:"
-                        }
-                    },
-                    {
-                        "type": "input",
-                        "block_id": "modify_item_price",
-                        "element": {
-                            "type": "plain_text_input",
-                            "action_id": "modify_item_price_input"
-                        },
-                        "label": {
-                            "type": "plain_text",
-                            "text": "品項金額:"
-                        }
-                    }
-                ]
-            }
+            view=view
+        )
+    elif action["selected_option"]["value"] == "bulk_add_items":
+        # 確認是否點餐中，或是否為訂單建立者
+        if not checkPermission(channel_id=channel_id, ts=ts, body=body):
+            return
+        client.views_open(
+            trigger_id=body["trigger_id"],
+            view=getBulkAddItemsModal(body)
         )
 
 
 @app.action("add_item_action")
+@app.action(re.compile("^add_item_select_"))
 def choose_bt_clicked(ack, client, body, action):
-    '''品項 Choose 按鈕 action'''
+    '''品項 Choose 按鈕及品項下拉選單 action'''
     ack()
-    ifMessageIsNoneReloadMetadata(body)
-    global orders, order_details
-    item = action['value']
+    if not isOrderOpen(body):
+        return
+    item = getSelectedItemFromAction(action)
     ts = getTsFromMessageBody(body)
     channel_id = getChannelIdFromMessageBody(body)
 
     # 確認是否點餐中，或是否為訂單建立者
-    if not checkPermission(channel_id=channel_id, ts=ts, body=body, client=client):
+    if not checkPermission(channel_id=channel_id, ts=ts, body=body):
         return
 
     client.views_open(
         trigger_id=body["trigger_id"],
-        view={
-            "type": "modal",
-            "callback_id": "add_item",
-            "title": {"type": "plain_text", "text": "新增品項"},
-            "submit": {"type": "plain_text", "text": "送出"},
-            "private_metadata": getPrivateMetadataFormatString(body=body) + f",{ order_details[ts][item]['price'] }",
-            "blocks": getAddItemModalBlocks(
-                item_price_mrkdwn=order_details[ts][item]["price"],
-                item_name=item,
-                item_amount="1",
-                item_slack_users=[body["user"]["id"]],
-                current_item_users=f"目前的使用者: { ','.join(order_details[ts][item]['users']) }"
-                )
-        }
+        view=getChooseItemModal(body, ts, item)
     )
 
 
 @app.action("end_order")
-def end(ack, body, client):
+def end(ack, body):
     ack()
-    global orders, order_details
-    ifMessageIsNoneReloadMetadata(body)
+    if not isOrderOpen(body):
+        return
     channel = getChannelIdFromMessageBody(body)
     ts = getTsFromMessageBody(body)
 
-    if not isOrderCreator(channel_id=channel, ts=ts, body=body, client=client):
+    if not isOrderCreator(channel_id=channel, ts=ts, body=body):
         return
-    # 沒有品項
-    if not order_details[ts]:
+    closed = closeOrder(ts)
+    if not closed:
         return
+    submitOrderClosed(channel, ts, *closed)
+
+
+def createAsyncApp(session):
+    '''SLACK_ORDER_ASYNC 模式: 以 AsyncApp 註冊和上面相同的 listeners，Web API 透過共用 aiohttp session 的 AsyncWebClient 呼叫'''
+    from slack_bolt.async_app import AsyncApp
+    from slack_bolt.context.ack.async_ack import AsyncAck
+    from slack_sdk.http_retry.builtin_async_handlers import AsyncRateLimitErrorRetryHandler
+    from slack_sdk.web.async_client import AsyncWebClient
+
+    class InstrumentedAsyncWebClient(AsyncWebClient):
+        async def api_call(self, api_method, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await super().api_call(api_method, **kwargs)
+            except SlackApiError as e:
+                if e.response.status_code == 429:
+                    metrics.inc("slack_order_slack_api_rate_limited_total", method=api_method)
+                raise
+            finally:
+                metrics.observe("slack_order_slack_api_call_seconds", time.perf_counter() - started, method=api_method)
+
+    class MetricsAsyncAck(AsyncAck):
+        def __init__(self, listener, started):
+            super().__init__()
+            self.listener = listener
+            self.started = started
+
+        async def __call__(self, *args, **kwargs):
+            response = await super().__call__(*args, **kwargs)
+            metrics.observe("slack_order_ack_seconds", time.perf_counter() - self.started, listener=self.listener)
+            return response
+
+    async_app = AsyncApp(client=InstrumentedAsyncWebClient(token=os.environ.get("SLACK_BOT_TOKEN"), base_url=SLACK_API_URL, session=session))
+
+    @async_app.middleware
+    async def recordRequestMetrics(body, context, next):
+        listener = getListenerLabel(body)
+        metrics.inc("slack_order_requests_total", listener=listener)
+        context["ack"] = MetricsAsyncAck(listener, time.perf_counter())
+        client = context.client
+        context["client"] = InstrumentedAsyncWebClient(
+            token=client.token,
+            base_url=client.base_url,
+            timeout=client.timeout,
+            ssl=client.ssl,
+            proxy=client.proxy,
+            session=client.session,
+            headers=client.headers,
+            team_id=client.default_params.get("team_id"),
+            logger=client.logger,
+            retry_handlers=client.retry_handlers + [AsyncRateLimitErrorRetryHandler(max_retry_count=SLACK_API_MAX_RETRIES)]
+        )
+        # say 在注入 middleware 參數時就以原本的 client 建立，移除後讓 listener 重新建立
+        context.pop("say", None)
+        await next()
+
+    @async_app.error
+    async def handleListenerError(error, body):
+        metrics.inc("slack_order_listener_errors_total", listener=getListenerLabel(body))
+        logger.exception(f"Failed to run listener function (error: { error })")
+
+    # 讀回訂單會讀取 order_store 及取得 order lock，提示和背景的 Web API 呼叫一樣交給 slack_api_dispatcher (queue 滿時會等待)，
+    # 都不在 event loop 中執行
+    async def isOrderOpenAsync(body):
+        return await asyncio.to_thread(isOrderOpen, body)
+
+    async def checkPermissionAsync(channel_id, ts, body):
+        return await asyncio.to_thread(checkPermission, channel_id, ts, body)
+
+    async def isOrderCreatorAsync(channel_id, ts, body):
+        return await asyncio.to_thread(isOrderCreator, channel_id, ts, body)
+
+    @async_app.command("/order")
+    async def open_modal(ack, body, client):
+        await ack()
+        await client.views_open(
+            trigger_id=body["trigger_id"],
+            view=getOpenNewOrderModal(channel_id=body["channel_id"])
+        )
 
-    users_total_aggegations = ""  # 統計個人應付金額及所有品項資訊
-    users_total_amount = {}  # 計算個人應付金額
-    users_total_items = {}  # 個人所點的所有品項
-    for item in order_details[ts]:
-
-        item_price = order_details[ts][item].get("price", 0)
-
-        for id in order_details[ts][item].get('slack_users', {}):
-            user_item_amount = int(order_details[ts][item]["slack_users"][id])
-            user = f"<@{ id }>"
-            users_total_amount.setdefault(user, 0)
-            users_total_items.setdefault(user, "")
-            users_total_amount[user] += (int(item_price) * user_item_amount)
-            if users_total_items[user]:
-                users_total_items[user] += f"、{ item }(${ item_price })*{ user_item_amount }"
-            else:
-                users_total_items[user] += f"{ item }(${ item_price })*{ user_item_amount }"
-
-        for user in order_details[ts][item].get('users', {}):
-            user_item_amount = int(order_details[ts][item]["users"][user])
-            users_total_amount.setdefault(user, 0)
-            users_total_items.setdefault(user, "")
-            users_total_amount[user] += (int(item_price) * int(user_item_amount))
-            if users_total_items[user]:
-                users_total_items[user] += f"、{ item }(${ item_price })*{ user_item_amount }"
-            else:
-                users_total_items[user] += f"{ item }(${ item_price })*{ user_item_amount }"
-
-    for user in users_total_items:
-        users_total_aggegations += f"${ users_total_amount[user] } { user } ({ users_total_items[user] })\n"
-
-    client.chat_postMessage(
-        channel=channel,
-        thread_ts=ts,
-        text=f"統計:\n{ users_total_aggegations }"
-    )
-
-    # 修改 Message 狀態
-    blocks = getOrderMessageBlocksWithItems(
-        order_name=orders[ts]["order_name"],
-        order_creator=orders[ts]["order_creator"],
-        order_info=orders[ts]["order_info"],
-        order_img=orders[ts]["order_img"],
-        order_total_price=getOrderTotalPrice(ts),
-        order_total_amount=getOrderTotalAmount(ts),
-        order_state=ORDER_STATE[1],
-        order_details=order_details[ts]
-    )
-
-    metadata = getMessageMetadata(
-        order_name=orders[ts]["order_name"],
-        order_creator=orders[ts]["order_creator"],
-        order_info=orders[ts]["order_info"],
-        order_img=orders[ts]["order_img"],
-        order_state=ORDER_STATE[1],
-        order_details=order_details[ts]
-    )
+    @async_app.view("open_new_order_modal")
+    async def handle_submission(ack, say, client, view, body):
+        await ack()
+        order = getNewOrderFromView(view=view, body=body)
+        blocks, metadata = getNewOrderMessage(order)
+        message = await say(
+            text="order",
+            channel=getChannelIdFromOpenNewOrderModal(view=view),
+            blocks=blocks,
+            metadata=metadata,
+            unfurl_links=False
+        )
+        await asyncio.to_thread(createOrder, message["channel"], message["ts"], order)
+        await asyncio.to_thread(submitSlackApiCall, message["ts"], "pins_add", channel=message["channel"], timestamp=message["ts"])
+
+    @async_app.view("add_item")
+    async def handle_add_item_submission(ack, view):
+        errors, submission = getAddItemSubmission(view)
+        if len(errors) > 0:
+            await ack(response_action="errors", errors=errors)
+            return
+        await ack()
+        # reloadOrder 可能呼叫 conversations_history，不在 event loop 中執行
+        await asyncio.to_thread(applyAddItemSubmission, submission)
+
+    @async_app.view("modify_order_message_modal")
+    async def handle_modify_order_message_submission(ack, view):
+        await ack()
+        channel_id, ts, old_order_creator, new_order_creator = await asyncio.to_thread(applyModifyOrderMessageSubmission, view)
+        if old_order_creator != new_order_creator:
+            await asyncio.to_thread(
+                submitSlackApiCall,
+                ts,
+                "chat_postMessage",
+                priority=SLACK_API_PRIORITY_NOTICE,
+                channel=channel_id,
+                thread_ts=ts,
+                text=getCreatorTransferredText(old_order_creator, new_order_creator)
+            )
+
+    @async_app.view("modify_item_price_modal")
+    async def handle_modify_item_price_submission(ack, view):
+        errors, submission = getModifyItemPriceSubmission(view)
+        if len(errors) > 0:
+            await ack(response_action="errors", errors=errors)
+            return
+        await ack()
+        # reloadOrder 可能呼叫 conversations_history，不在 event loop 中執行
+        await asyncio.to_thread(applyModifyItemPriceSubmission, submission)
+
+    @async_app.view("bulk_add_items_modal")
+    async def handle_bulk_add_items_submission(ack, view):
+        errors, submission = getBulkAddItemsSubmission(view)
+        if len(errors) > 0:
+            await ack(response_action="errors", errors=errors)
+            return
+        await ack()
+        # reloadOrder 可能呼叫 conversations_history，不在 event loop 中執行
+        await asyncio.to_thread(applyBulkAddItemsSubmission, submission)
+
+    @async_app.options("item_name_input")
+    async def item_name_options(ack, body):
+        await ack(options=getMenuOptions(body["view"]["private_metadata"].split(',')[0], body.get("value", "")))
+
+    @async_app.action("new_item")
+    async def new_item_clicked(ack, body, client):
+        await ack()
+        if not await isOrderOpenAsync(body):
+            return
+        ts = getTsFromMessageBody(body)
+        channel_id = getChannelIdFromMessageBody(body)
+        if not await checkPermissionAsync(channel_id, ts, body):
+            return
+        await client.views_open(trigger_id=body["trigger_id"], view=getNewItemModal(body))
 
-    client.chat_update(
-        channel=channel,
-        ts=ts,
-        text="ended",
-        metadata=metadata,
-        blocks=blocks
-    )
+    @async_app.action("order_message_modify")
+    async def handle_some_action(ack, client, body, action):
+        await ack()
+        if not await isOrderOpenAsync(body):
+            return
+        channel_id = getChannelIdFromMessageBody(body)
+        ts = getTsFromMessageBody(body)
+        if action["selected_option"]["value"] == "modify_order_info":
+            if not await isOrderCreatorAsync(channel_id, ts, body):
+                return
+            await client.views_open(trigger_id=body["trigger_id"], view=getModifyOrderMessageModal(body, ts))
+        elif action["selected_option"]["value"] == "modify_item_price":
+            if not await checkPermissionAsync(channel_id, ts, body):
+                return
+            view = getModifyItemPriceModal(body, ts)
+            if view:
+                await client.views_open(trigger_id=body["trigger_id"], view=view)
+        elif action["selected_option"]["value"] == "bulk_add_items":
+            if not await checkPermissionAsync(channel_id, ts, body):
+                return
+            await client.views_open(trigger_id=body["trigger_id"], view=getBulkAddItemsModal(body))
+
+    @async_app.action("add_item_action")
+    @async_app.action(re.compile("^add_item_select_"))
+    async def choose_bt_clicked(ack, client, body, action):
+        await ack()
+        if not await isOrderOpenAsync(body):
+            return
+        ts = getTsFromMessageBody(body)
+        channel_id = getChannelIdFromMessageBody(body)
+        if not await checkPermissionAsync(channel_id, ts, body):
+            return
+        await client.views_open(trigger_id=body["trigger_id"], view=getChooseItemModal(body, ts, getSelectedItemFromAction(action)))
 
-    # 移除全域變數
-    orders.pop(ts, {})
-    order_details.pop(ts, {})
+    @async_app.action("end_order")
+    async def end(ack, body):
+        await ack()
+        if not await isOrderOpenAsync(body):
+            return
+        channel = getChannelIdFromMessageBody(body)
+        ts = getTsFromMessageBody(body)
+        if not await isOrderCreatorAsync(channel, ts, body):
+            return
+        # 結案會寫入 order_store、journal 及學習的菜單，不在 event loop 中執行
+        closed = await asyncio.to_thread(closeOrder, ts)
+        if not closed:
+            return
+        await asyncio.to_thread(submitOrderClosed, channel, ts, *closed)
+
+    return async_app
+
+
+async def startAsyncApp():
+    '''以 AsyncApp 和 aiohttp 的 AsyncSocketModeHandler 啟動
+
+    listeners 在 event loop 中執行，合併後的 chat_update 及其他背景 Web API 呼叫和同步模式一樣交給 slack_api_dispatcher
+    '''
+    import aiohttp
+    from slack_bolt.adapter.socket_mode.aiohttp import AsyncSocketModeHandler
+
+    openOrderJournal()
+    loadMenuCatalog()
+    warmStartOrders()
+    startOrderEviction()
+    startMetricsServer()
+    async with aiohttp.ClientSession() as session:
+        async_app = createAsyncApp(session)
+        try:
+            await AsyncSocketModeHandler(async_app, os.environ["SLACK_APP_TOKEN"]).start_async()
+        finally:
+            # timer threads 是 daemon threads，還在 debounce 中的更新交給 dispatcher 後一起等待完成
+            for channel_id, ts in takePendingOrderMessageUpdates():
+                submitOrderMessageUpdate(channel_id, ts)
+            await asyncio.to_thread(slack_api_dispatcher.drain, timeout=SLACK_API_DRAIN_TIMEOUT)
+
+
+def startApp():
+    '''啟動 SocketModeHandler，結束時等待背景 Web API 呼叫完成'''
+    openOrderJournal()
+    loadMenuCatalog()
+    warmStartOrders()
+    startOrderEviction()
+    metrics_server = startMetricsServer()
+    handler = SocketModeHandler(app, os.environ["SLACK_APP_TOKEN"])
+    # docker stop 送出 SIGTERM 時正常結束
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     try:
-        client.pins_remove(channel=channel, timestamp=ts)
-    except Exception:
-        pass
+        handler.start()
+    finally:
+        handler.close()
+        # timer threads 是 daemon threads，還在 debounce 中的更新交給 dispatcher 後一起等待完成
+        for channel_id, ts in takePendingOrderMessageUpdates():
+            submitOrderMessageUpdate(channel_id, ts)
+        slack_api_dispatcher.drain(timeout=SLACK_API_DRAIN_TIMEOUT)
+        if metrics_server:
+            metrics_server.shutdown()
 
 
 # Start your app
 if __name__ == "__main__":
-    SocketModeHandler(app, os.environ["SLACK_APP_TOKEN"]).start()
+    logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    if sys.argv[1:2] == ["compact-journal"]:
+        # python slack_order.py compact-journal [ORDER_JOURNAL_DIR]，需先停止使用同一個目錄的 app
+        journal_dir = sys.argv[2] if len(sys.argv) > 2 else ORDER_JOURNAL_DIR
+        with open(os.path.join(journal_dir, "lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            segment, state = compactJournal(journal_dir)
+        print(f"compacted journal to segment { segment }, { len(state) } open orders")
+    elif SLACK_ORDER_ASYNC:
+        asyncio.run(startAsyncApp())
+    else:
+        startApp()